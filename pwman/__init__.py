@@ -19,55 +19,66 @@
 # Copyright (C) 2006 Ivan Kelly <ivan@ivankelly.net>
 # ============================================================================
 import argparse
-import urllib.request
+import functools
+import importlib.util
 import os
-import pkg_resources
 import re
-import string
 import shutil
 import sys
+import threading
+import time
 from pwman.util import config
-from pwman.data.factory import check_db_version
 
-try:
-    import cryptography  # noqa
-    has_cryptography = True
-except ImportError:
-    has_cryptography = False
+# found without importing it, it is imported with the crypto engine
+has_cryptography = importlib.util.find_spec('cryptography') is not None
 
 
 appname = "pwman3"
 
-try:
-    version = pkg_resources.get_distribution('pwman3').version
-except pkg_resources.DistributionNotFound:  # pragma: no cover
-    version = "0.9.5"
+# used when the package metadata can not be read, e.g. while installing
+_default_metadata = {
+    'version': "0.9.5",
+    'website': 'http://pwman3.github.io/pwman3/',
+    'author': 'Oz Nahum Tiram',
+    'authoremail': 'nahumoz@gmail.com',
+    'description': ("a command line password manager with support for "
+                    "multiple databases."),
+    'long_description': '',
+}
 
 
-class PkgMetadata(object):
-
-    def __init__(self):
-        p = pkg_resources.get_distribution('pwman3')
-        f = open(os.path.join(p.location+'-info', 'PKG-INFO'))
-        lines = f.readlines()
-        self.summary = lines[3].split(':')[-1].strip()
-        self.description = ''.join(map(string.strip, lines[9:14]))
-        self.author_email = lines[6].split(':')[-1].strip()
-        self.author = lines[5].split(':')[-1].strip()
-        self.home_page = lines[4].split(':')[-1].strip()
-
-
-try:
-    pkg_meta = PkgMetadata()
-    website = pkg_meta.home_page
-    author = pkg_meta.author
-    authoremail = pkg_meta.author_email
-    description = pkg_meta.summary
-    long_description = pkg_meta.description
-except IOError as E:
-    # this should only happen once when installing the package
-    description = "a command line password manager with support for multiple databases."  # noqa
-    website = 'http://pwman3.github.io/pwman3/'
+def _read_metadata():
+    try:
+        from importlib.metadata import metadata
+    except ImportError:  # pragma: no cover
+        import pkg_resources
+        try:
+            return {'version':
+                    pkg_resources.get_distribution('pwman3').version}
+        except pkg_resources.DistributionNotFound:
+            return {}
+    try:
+        meta = metadata('pwman3')
+    except Exception:  # pragma: no cover
+        return {}
+    return {'version': meta['Version'],
+            'website': meta['Home-page'],
+            'author': meta['Author'],
+            'authoremail': meta['Author-email'],
+            'description': meta['Summary'],
+            'long_description': meta['Description']}
+
+
+@functools.lru_cache(maxsize=None)
+def metadata():
+    """
+    Return the version, website, author, authoremail, description and
+    long_description of the package. They are read on the first call.
+    """
+    meta = dict(_default_metadata)
+    meta.update((key, value) for key, value in _read_metadata().items()
+                if value)
+    return meta
 
 
 config_dir = os.path.expanduser("~/.pwman")
@@ -75,7 +86,8 @@ config_dir = os.path.expanduser("~/.pwman")
 
 def parser_options(formatter_class=argparse.HelpFormatter):  # pragma: no cover
     parser = argparse.ArgumentParser(prog='pwman3',
-                                     description=description,
+                                     description=_default_metadata[
+                                         'description'],
                                      formatter_class=formatter_class)
     parser.add_argument('-c', '--config', dest='cfile',
                         default=os.path.expanduser("~/.pwman/config"),
@@ -83,6 +95,47 @@ def parser_options(formatter_class=argparse.HelpFormatter):  # pragma: no cover
     parser.add_argument('-d', '--database', dest='dbase')
     parser.add_argument('-i', '--import', nargs=2, dest='file_delim',
                         help="Specify the file name and the delimeter type")
+    parser.add_argument('-l', '--lookup', dest='lookup', metavar='DOMAIN',
+                        help="List the nodes of a domain and exit")
+
+    # commands which run without the interactive loop and write JSON
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('--ndjson', action='store_true',
+                        help="write one JSON object per line")
+    output.add_argument('--password-file', metavar='FILE',
+                        help="read the master password from the first line "
+                        "of FILE, unless pwman3-agent runs")
+    output.add_argument('--password-fd', type=int, metavar='FD',
+                        help="read the master password from the file "
+                        "descriptor FD, unless pwman3-agent runs")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    get = commands.add_parser('get', parents=[output],
+                              help="print nodes with their passwords")
+    get.add_argument('ids', nargs='+', metavar='ID',
+                     help="node ids or ranges of ids, e.g. 1-3")
+    ls = commands.add_parser('ls', parents=[output],
+                             help="list nodes, without their passwords")
+    ls.add_argument('tag', nargs='?')
+    ls.add_argument('--limit', type=int, metavar='N',
+                    help="list at most N nodes")
+    ls.add_argument('--page', type=int, metavar='N',
+                    help="list the Nth page of --limit nodes")
+    ls.add_argument('--after', type=int, metavar='ID',
+                    help="list the nodes following node ID, e.g. the "
+                    "last node of the previous page")
+    add = commands.add_parser('add', parents=[output],
+                              help="add a node, the password is read "
+                              "from stdin")
+    add.add_argument('--username', default='')
+    add.add_argument('--url', default='')
+    add.add_argument('--notes', default='')
+    add.add_argument('--tags', nargs='*', default=[])
+    rm = commands.add_parser('rm', parents=[output], help="remove nodes")
+    rm.add_argument('ids', nargs='+', metavar='ID',
+                    help="node ids or ranges of ids, e.g. 1-3")
+    commands.add_parser('tags', parents=[output], help="list the tags")
+    commands.add_parser('export', parents=[output],
+                        help="print all nodes with their passwords")
     return parser
 
 
@@ -130,10 +183,44 @@ def get_conf_options(args, OSX):
 
 
 def get_db_version(config, args):
+    from pwman.data.factory import check_db_version
     dburi = check_db_version(config.get_value("Database", "dburi"))
     return dburi
 
 
+def get_crypto_engine(config):
+    """
+    Create the crypto engine with the options of the Global and Crypto
+    sections of the configuration.
+    """
+    from pwman.util.crypto_engine import CryptoEngine
+    timeout = int(config.get_value('Global', 'lock_timeout'))
+    ce = CryptoEngine.get(timeout)
+    ce.workers = int(config.get_value('Crypto', 'workers') or 0) or None
+    ce.pool = config.get_value('Crypto', 'pool') or 'thread'
+    ce.kdf_name = config.get_value('Crypto', 'kdf') or ce.kdf_name
+    ce.unlock_time = float(config.get_value('Crypto', 'unlock_time') or 0)
+    return ce
+
+
+def open_database(config):
+    """
+    Open the database of the configuration and unlock it. The database
+    is opened while the master password is typed, see Database.bootstrap.
+    The crypto engine needs a callback to read the password.
+    """
+    from pwman.data import factory
+    from pwman.data.database import __DB_FORMAT__
+    from pwman.util.crypto_engine import CryptoEngine
+    ce = CryptoEngine.get()
+    db = factory.createdb(config.get_value('Database', 'dburi'),
+                          __DB_FORMAT__)
+    db.configure(dict(config.parser.items('Database')))
+    db.bootstrap(lambda: ce.callback.getsecret(
+        "Please type in your master password"))
+    return db
+
+
 def calculate_client_info():  # pragma: no cover
     import hashlib
     import socket
@@ -149,6 +236,7 @@ def is_latest_version(version, client_info):  # pragma: no cover
         url = ("https://pwman.tiram.it/is_latest/?"
                "current_version={}&os={}&hash={}".format(
                 version, sys.platform, client_info))
+        import urllib.request
         res = urllib.request.urlopen(url, timeout=0.5)
         data = res.read()  # This will return entire content.
 
@@ -160,3 +248,39 @@ def is_latest_version(version, client_info):  # pragma: no cover
             return None, True
     except Exception as E:
         return E, True
+
+
+def check_version(config, version):
+    """
+    Return False if an earlier check found a newer version. The result is
+    kept in the Updater section for check_interval seconds. When it is
+    older, the check runs in a background thread, which saves its result
+    for the next start, so starting never waits for the network. The time
+    of the attempt is saved before, a run may end before the thread does.
+    """
+    client_info = config.get_value('Updater', 'client_info')
+    if not client_info:
+        client_info = calculate_client_info()
+        config.set_value('Updater', 'client_info', client_info)
+
+    last_check = float(config.get_value('Updater', 'last_check') or 0)
+    interval = float(config.get_value('Updater', 'check_interval') or 0)
+    checked = config.get_value('Updater', 'checked_version') == version
+    if not checked or time.time() - last_check > interval:
+        if not checked:
+            # the result of another version does not apply
+            config.set_value('Updater', 'is_latest', '')
+        config.set_value('Updater', 'checked_version', version)
+        config.set_value('Updater', 'last_check', str(int(time.time())))
+        config.save()
+
+        def check():
+            error, latest = is_latest_version(version, client_info)
+            if error is None:
+                config.set_value('Updater', 'is_latest',
+                                 'yes' if latest else 'no')
+                config.save()
+
+        threading.Thread(target=check, daemon=True).start()
+
+    return not checked or config.get_value('Updater', 'is_latest') != 'no'
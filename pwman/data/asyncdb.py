@@ -0,0 +1,113 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+An asyncio interface of the databases, for front ends which serve many
+clients from one event loop, e.g.::
+
+    db = AsyncDatabase(open_database(config))
+    ids = await db.listnodes(limit=50)
+    nodes = await db.getnodes(ids)
+
+The operations run in threads, as many at the same time as the driver
+allows: PostgreSQL and MySQL take a connection from their pool for each
+operation, MongoDB shares its thread safe client, and SQLite runs one
+operation after the other on its connection. Encryption and decryption
+run in a thread of their own, so the event loop never waits for them.
+The blind indexes of tags and URLs are computed by the database
+operations, in their threads; the session cache of the crypto engine
+is safe to share between threads.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from pwman.data.nodes import Node
+from pwman.util.crypto_engine import CryptoEngine
+
+
+class AsyncDatabase(object):
+
+    def __init__(self, db, workers=None):
+        self.db = db
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or db.max_threads)
+        # the crypto engine spreads bulk work over its own workers, one
+        # thread to drive it is enough
+        self._crypto_executor = ThreadPoolExecutor(max_workers=1)
+
+    def _run(self, executor, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(executor,
+                                    functools.partial(func, *args, **kwargs))
+
+    async def getnodes(self, ids):
+        return await self._run(self._executor, self.db.getnodes, ids)
+
+    async def listnodes(self, filter=None, limit=None, after_id=None):
+        return await self._run(self._executor, self.db.listnodes, filter,
+                               limit=limit, after_id=after_id)
+
+    async def lookup(self, url):
+        return await self._run(self._executor, self.db.lookup, url)
+
+    async def listtags(self):
+        return await self._run(self._executor, self.db.listtags)
+
+    async def add_node(self, node):
+        return await self._run(self._executor, self.db.add_node, node)
+
+    async def add_nodes(self, nodes, batch_size=500):
+        return await self._run(self._executor, self.db.add_nodes,
+                               list(nodes), batch_size=batch_size)
+
+    async def new_node(self, **fields):
+        """
+        Encrypt the clear text fields of a node, add it and return its id
+        """
+        node = await self._run(self._crypto_executor, Node, clear_text=True,
+                               **fields)
+        return await self.add_node(node)
+
+    async def editnode(self, nid, **kwargs):
+        return await self._run(self._executor, self.db.editnode, nid,
+                               **kwargs)
+
+    async def removenodes(self, nid=(), ranges=(), tags=()):
+        return await self._run(self._executor, self.db.removenodes, nid,
+                               ranges=ranges, tags=tags)
+
+    async def encrypt_many(self, texts, return_exceptions=False):
+        return await self._run(self._crypto_executor,
+                               CryptoEngine.get().encrypt_many, list(texts),
+                               return_exceptions=return_exceptions)
+
+    async def decrypt_many(self, cipher_texts, return_exceptions=False):
+        return await self._run(self._crypto_executor,
+                               CryptoEngine.get().decrypt_many,
+                               list(cipher_texts),
+                               return_exceptions=return_exceptions)
+
+    async def close(self):
+        """
+        Wait for the running operations and close the database
+        """
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+        self._crypto_executor.shutdown(wait=False)
+        self.db.close()
@@ -19,6 +19,7 @@
 from __future__ import print_function
 import os
 import shutil
+import threading
 import time
 from pwman.util.crypto_engine import CryptoEngine
 import pwman.data.factory
@@ -123,3 +124,48 @@ class PwmanConvertKey(DBConverter):
         enc = CryptoEngine.get(0.5)
         self.oldkey = enc.get_cryptedkey()
         self.newdb.savekey(self.oldkey)
+
+
+class RecordMigrator(threading.Thread):
+    """
+    Convert the records of an opened database to the current record
+    format in the background, using a connection of its own.
+
+    The migrator waits until the vault is unlocked, and stops when it is
+    locked again, the next run continues with the rows left. When a
+    whole pass finds nothing to convert, on_migrated is called, so the
+    caller can remember not to run the migrator again.
+    """
+
+    def __init__(self, db, batch_size=500, pause=0.05, on_migrated=None):
+        super(RecordMigrator, self).__init__(name='pwman-record-migrator')
+        self.daemon = True
+        self.db = db
+        self.batch_size = batch_size
+        self.pause = pause
+        self.on_migrated = on_migrated
+        self.converted = 0
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        enc = CryptoEngine.get()
+        while enc.unlocked_cipher() is None:
+            if self._stop_event.wait(1):
+                return
+
+        db = self.db._background_db()
+        try:
+            for converted in db.migrate_records(self.batch_size):
+                self.converted += converted
+                if self._stop_event.wait(self.pause):
+                    return
+            # migrate_records also ends when the vault is locked
+            if (not self.converted and enc.unlocked_cipher() is not None and
+                    self.on_migrated is not None):
+                self.on_migrated()
+        finally:
+            if db is not self.db:
+                db.close()
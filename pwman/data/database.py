@@ -18,16 +18,352 @@
 # ============================================================================
 # Copyright (C) 2006 Ivan Kelly <ivan@ivankelly.net>
 # ============================================================================
-from pwman.util.crypto_engine import CryptoEngine
-__DB_FORMAT__ = 0.6
+import functools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit
+
+from pwman.util.crypto_engine import (CryptoEngine, is_record_v2,
+                                      encode_record, decode_record)
+__DB_FORMAT__ = 0.7
 
 
 class DatabaseException(Exception):
     pass  # pragma: no cover
 
 
+def _bytes(value):
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+
+def _chunks(items, size=500):
+    """
+    Split items into lists of at most size items, to keep the number of
+    parameters of an IN (...) clause below the limits of the databases
+    """
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def hostname(url):
+    """
+    Return the normalized host name of an URL, e.g.
+    'https://WWW.Example.com:8080/login' becomes 'example.com'.
+    Return an empty string if url has no host name.
+    """
+    if isinstance(url, bytes):
+        url = url.decode('utf8', 'replace')
+    url = url.strip()
+    if '//' not in url:
+        url = '//' + url
+    try:
+        host = urlsplit(url).hostname or ''
+    except ValueError:
+        return ''
+    host = host.rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    return host
+
+
+# second level domains under which anyone can register a domain, so
+# 'evil.co.uk' does not match the entries of every site under 'co.uk'
+PUBLIC_SUFFIXES = frozenset("""
+    ac.uk co.uk gov.uk ltd.uk me.uk net.uk nhs.uk org.uk plc.uk sch.uk
+    asn.au com.au edu.au gov.au id.au net.au org.au
+    ac.nz co.nz geek.nz gen.nz govt.nz net.nz org.nz school.nz
+    ac.jp co.jp go.jp ne.jp or.jp ac.kr co.kr go.kr or.kr
+    ac.za co.za gov.za net.za org.za ac.in co.in gov.in net.in org.in
+    ac.il co.il org.il ac.id co.id or.id ac.th co.th in.th
+    com.ar com.br com.cn com.co com.hk com.mx com.my com.pe com.ph
+    com.pk com.sg com.tr com.tw com.ua com.vn edu.cn gov.cn net.br
+    net.cn org.br org.cn org.hk org.mx org.tw
+""".split())
+
+
+def parent_domains(host):
+    """
+    Return host and the domains above it, down to the registered domain,
+    e.g. 'a.b.example.com', 'b.example.com' and 'example.com'. Top level
+    domains and the known PUBLIC_SUFFIXES are never returned, and an IP
+    address has no parents.
+    """
+    if not host:
+        return []
+    labels = host.split('.')
+    if all(label.isdigit() for label in labels):
+        return [host]
+    domains = [host]
+    for i in range(1, len(labels) - 1):
+        parent = '.'.join(labels[i:])
+        if parent in PUBLIC_SUFFIXES:
+            break
+        domains.append(parent)
+    return domains
+
+
+def pooled(method):
+    """
+    Run a method of a PooledDatabase with a connection borrowed from its
+    pool and a new cursor, which _con and _cur return in the calling
+    thread. Databases without a pool, and methods called by a pooled
+    method, use the connection they already have.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._pool is None or \
+                getattr(self._local, 'con', None) is not None:
+            return method(self, *args, **kwargs)
+        with self._pool.connection() as con:
+            self._local.con, self._local.cur = con, con.cursor()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._local.cur.close()
+                self._local.con = self._local.cur = None
+    return wrapper
+
+
+class ConnectionPool(object):
+    """
+    Keep between minsize and maxsize connections made by connect.
+
+    A connection which was idle for more than check_after seconds is
+    checked with a query before it is handed out, broken connections are
+    replaced. Connecting is tried tries times, waiting backoff seconds
+    after the first failure and twice as long after each further one.
+    """
+
+    def __init__(self, connect, minsize=1, maxsize=5, timeout=30, tries=5,
+                 backoff=0.1, check_after=5):
+        self._connect = connect
+        self.maxsize = max(maxsize, 1)
+        self.timeout = timeout
+        self.tries = max(tries, 1)
+        self.backoff = backoff
+        self.check_after = check_after
+        self._idle = []
+        self._size = 0
+        self._lock = threading.Condition()
+        for _ in range(min(minsize, self.maxsize)):
+            self._idle.append((self.connect(), time.time()))
+            self._size += 1
+
+    def connect(self):
+        delay = self.backoff
+        for attempt in range(self.tries):
+            try:
+                return self._connect()
+            except Exception as e:
+                if attempt == self.tries - 1:
+                    raise DatabaseException(
+                        "Could not connect after %d tries: %s" %
+                        (self.tries, e))
+                time.sleep(delay)
+                delay *= 2
+
+    @staticmethod
+    def is_alive(con):
+        try:
+            # end a failed transaction first, it would fail the query
+            con.rollback()
+            cur = con.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            cur.close()
+            con.rollback()
+            return True
+        except Exception:
+            return False
+
+    def get(self):
+        """
+        Return a working connection, wait up to timeout seconds if all
+        the connections are in use
+        """
+        deadline = time.time() + self.timeout
+        with self._lock:
+            while not self._idle and self._size >= self.maxsize:
+                if not self._lock.wait(deadline - time.time()):
+                    raise DatabaseException(
+                        "No free connection after %s seconds" % self.timeout)
+            if self._idle:
+                con, since = self._idle.pop()
+            else:
+                con, since = None, None
+                self._size += 1
+        try:
+            if con is not None and time.time() - since > self.check_after \
+                    and not self.is_alive(con):
+                self._close(con)
+                con = None
+            if con is None:
+                con = self.connect()
+        except Exception:
+            self._discard()
+            raise
+        return con
+
+    def put(self, con):
+        """
+        Return a connection to the pool, its transaction is rolled back,
+        a connection which does not work anymore is dropped
+        """
+        try:
+            con.rollback()
+        except Exception:
+            self._close(con)
+            self._discard()
+            return
+        with self._lock:
+            self._idle.append((con, time.time()))
+            self._lock.notify()
+
+    def _discard(self):
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+
+    @staticmethod
+    def _close(con):
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        con = self.get()
+        broken = False
+        try:
+            yield con
+        except Exception:
+            # keep the connection only if the error was not its fault
+            broken = not self.is_alive(con)
+            raise
+        finally:
+            # a generator which is not exhausted returns it here, too
+            if broken:
+                self._close(con)
+                self._discard()
+            else:
+                self.put(con)
+
+    def close(self):
+        with self._lock:
+            for con, _ in self._idle:
+                self._close(con)
+                self._size -= 1
+            self._idle = []
+
+
+class RowCache(object):
+    """
+    A bounded LRU mapping of the encrypted rows of nodes and of lists of
+    node ids, which the Database fills as it reads them.
+
+    Entries expire ttl seconds after they were read, so the changes of
+    other processes show up eventually. hits and misses count the reads
+    which were answered from the cache and those which were not.
+    """
+
+    def __init__(self, size=1000, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                self.misses += 1
+                return None
+            self._data[key] = value, expires
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, time.time() + self.ttl
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def discard_lists(self):
+        """
+        Drop the lists of node ids, e.g. after nodes were added
+        """
+        with self._lock:
+            for key in [k for k in self._data if k[0] == 'ids']:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
 class Database(object):
 
+    # the type of the columns holding blind indexes, see _tag_index
+    _index_type = 'TEXT'
+    # columns holding blind indexes rather than records
+    _index_columns = ('IDX', 'URLIDX')
+    _tags_indexed = False
+    _urls_indexed = False
+    # appended to the SELECT which reads the tags other connections
+    # created meanwhile, see _get_or_create_tags
+    _locking_read = ''
+    _opened = False
+    # the pool of the connections of a PooledDatabase
+    _pool = None
+    # how many threads may use the database at the same time, one
+    # connection and cursor serve one thread
+    max_threads = 1
+    # the RowCache of the nodes read, if the row_cache_size is set
+    _cache = None
+    # the callbacks of subscribe
+    _subscribers = ()
+
+    _node_columns = ("NODE.ID, NODE.USERNAME, NODE.PASSWORD, NODE.URL, "
+                     "NODE.NOTES")
+    # the tags of a node in one column, as comma separated hex strings
+    _tags_aggregate = "GROUP_CONCAT(HEX(TAG.DATA) ORDER BY TAG.ID)"
+
+    def configure(self, options):
+        """
+        Apply the options of the Database section of the configuration,
+        drivers which have options of their own extend this.
+        """
+        try:
+            size = int(options.get('row_cache_size') or 0)
+            ttl = float(options.get('row_cache_ttl') or 30)
+        except ValueError:
+            raise DatabaseException("Invalid row_cache_size or "
+                                    "row_cache_ttl")
+        self._cache = RowCache(size, ttl) if size > 0 else None
+
     def open(self, dbver=None):
         """
         Open the database, by calling the _open method of the
@@ -36,14 +372,57 @@ class Database(object):
         encryption key, by calling
         enc = CryptoEngine.get()
         key = self.loadkey()
+        A database opened by bootstrap is not opened again.
         """
+        if self._opened:
+            return
         self._open()
+        self._set_key(self.loadkey())
+
+    def bootstrap(self, read_password):
+        """
+        Open the database and unlock it with the password returned by
+        read_password. Connecting, checking the tables and loading the key
+        all use one connection, in a background thread, while the password
+        is typed. The key derivation needs the salt stored with the key, so
+        it runs when both are done.
+        """
+        loaded = {}
+
+        def connect():
+            try:
+                self._open()
+                loaded['key'] = self.loadkey()
+            except Exception as e:
+                loaded['error'] = e
+
+        thread = threading.Thread(target=connect)
+        thread.start()
+        try:
+            password = read_password()
+        finally:
+            thread.join()
+        if 'error' in loaded:
+            raise loaded['error']
+        if not isinstance(password, bytes):
+            password = password.encode()
+        self._set_key(loaded['key'], password)
+
+    def _set_key(self, key, password=None):
+        """
+        Set the key loaded from the database, or create the key of a new
+        database. If password is given, it unlocks the vault or becomes
+        the password of a new database, instead of asking for it.
+        """
         enc = CryptoEngine.get()
-        key = self.loadkey()
         if key is not None:
             enc.set_cryptedkey(key)
+            if password is not None and not enc.authenticate(password):
+                # the password is asked again when the vault is used
+                enc.callback.error("You entered a wrong password...")
         else:
-            self.get_user_password()
+            self.get_user_password(password)
+        self._opened = True
 
     def _check_tables(self):
         try:
@@ -59,20 +438,23 @@ class Database(object):
             return
         try:
             self._cur.execute("CREATE TABLE NODE(ID SERIAL PRIMARY KEY, "
-                              "USERNAME TEXT NOT NULL, "
-                              "PASSWORD TEXT NOT NULL, "
-                              "URL TEXT NOT NULL, "
-                              "NOTES TEXT NOT NULL"
-                              ")")
+                              "USERNAME BLOB NOT NULL, "
+                              "PASSWORD BLOB NOT NULL, "
+                              "URL BLOB NOT NULL, "
+                              "NOTES BLOB NOT NULL, "
+                              "URLIDX {}"
+                              ")".format(self._index_type))
+
+            self._cur.execute("CREATE INDEX NODE_URLIDX ON NODE(URLIDX)")
 
             self._cur.execute("CREATE TABLE TAG"
                               "(ID  SERIAL PRIMARY KEY,"
-                              "DATA TEXT NOT NULL)")
+                              "DATA BLOB NOT NULL,"
+                              "IDX {})".format(self._index_type))
 
-            self._cur.execute("CREATE TABLE LOOKUP ("
-                              "nodeid INTEGER NOT NULL REFERENCES NODE(ID),"
-                              "tagid INTEGER NOT NULL REFERENCES TAG(ID)"
-                              ")")
+            self._cur.execute("CREATE UNIQUE INDEX TAG_IDX ON TAG(IDX)")
+
+            self._create_lookup_table()
 
             self._cur.execute("CREATE TABLE CRYPTO "
                               "(SEED TEXT, DIGEST TEXT)")
@@ -87,125 +469,565 @@ class Database(object):
         except Exception:  # pragma: no cover
             self._con.rollback()
 
-    def get_user_password(self):
+    def _create_lookup_table(self, name='LOOKUP'):
+        """
+        Create the table linking nodes to their tags. The primary key
+        finds the tags of a node, the index on tagid the nodes of a tag.
+        """
+        self._cur.execute("CREATE TABLE {} ("
+                          "nodeid INTEGER NOT NULL "
+                          "REFERENCES NODE(ID) ON DELETE CASCADE, "
+                          "tagid INTEGER NOT NULL "
+                          "REFERENCES TAG(ID) ON DELETE CASCADE, "
+                          "PRIMARY KEY (nodeid, tagid))".format(name))
+        self._cur.execute("CREATE INDEX LOOKUP_TAGID ON {}(tagid)".format(
+            name))
+
+    def _get_db_version(self):
+        try:
+            self._cur.execute("SELECT VERSION FROM DBVERSION")
+            row = self._cur.fetchone()
+        except Exception:
+            self._con.rollback()
+            row = None
+        try:
+            return float(row[0])
+        except (TypeError, ValueError):
+            return 0
+
+    def _set_db_version(self, version):
+        self._cur.execute("DELETE FROM DBVERSION")
+        self._cur.execute("INSERT INTO DBVERSION VALUES({})".format(
+            self._sub), (str(version),))
+
+    def _upgrade_schema(self):
+        """
+        Upgrade the tables of a database of an older format in place,
+        this is called by _open.
+        """
+        if self._get_db_version() >= __DB_FORMAT__:
+            return
+        self._add_index_columns()
+        self._upgrade_lookup()
+        self._set_db_version(__DB_FORMAT__)
+        self._con.commit()
+
+    def _upgrade_lookup(self):
         """
-        get the databases password from the user
+        Copy the LOOKUP table of a database of format 0.6 to a table with
+        a primary key, an index on tagid and cascading foreign keys.
+        Duplicate rows and rows of removed nodes or tags are dropped.
+        """
+        self._cur.execute("DELETE FROM LOOKUP WHERE "
+                          "nodeid NOT IN (SELECT ID FROM NODE) OR "
+                          "tagid NOT IN (SELECT ID FROM TAG)")
+        self._create_lookup_table('LOOKUP_NEW')
+        self._cur.execute("INSERT INTO LOOKUP_NEW(nodeid, tagid) "
+                          "SELECT DISTINCT nodeid, tagid FROM LOOKUP")
+        self._cur.execute("DROP TABLE LOOKUP")
+        self._cur.execute("ALTER TABLE LOOKUP_NEW RENAME TO LOOKUP")
+
+    def _add_index_columns(self):
+        """
+        Add the blind index columns to the tables of older databases,
+        the indexes of existing rows are computed by _index_tags and
+        _index_urls.
+        """
+        for table, column, unique in (('TAG', 'IDX', 'UNIQUE '),
+                                      ('NODE', 'URLIDX', '')):
+            try:
+                self._cur.execute("SELECT {} FROM {} WHERE 1 = 0".format(
+                    column, table))
+                self._cur.fetchall()
+            except Exception:
+                self._con.rollback()
+                self._cur.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table, column, self._index_type))
+                self._cur.execute("CREATE {2}INDEX {0}_{1} ON {0}({1})".format(
+                    table, column, unique))
+                self._con.commit()
+
+    def _index_tags(self):
+        """
+        Compute the blind index of tags which were stored without one.
+        This is needed only once for older databases. The index is
+        unique, the nodes of duplicate tags are moved to one of them.
+        """
+        if self._tags_indexed:
+            return
+        self._cur.execute("SELECT ID, DATA FROM TAG WHERE IDX IS NULL")
+        rows = [(tid, _bytes(data)) for tid, data in self._cur.fetchall()]
+        if rows:
+            ce = CryptoEngine.get()
+            clear = ce.decrypt_many([data for _, data in rows],
+                                    return_exceptions=True)
+            indexes = []
+            for (tid, data), tag in zip(rows, clear):
+                if isinstance(tag, Exception):
+                    tag = data
+                indexes.append((ce.blind_index(tag), tid))
+            tids = self._select_tags(set(index for index, _ in indexes))
+            updates, duplicates = [], []
+            for index, tid in indexes:
+                if index in tids:
+                    duplicates.append((tid, tids[index]))
+                else:
+                    tids[index] = tid
+                    updates.append((index, tid))
+            sql = "UPDATE TAG SET IDX = {0} WHERE ID = {0}".format(self._sub)
+            self._cur.executemany(sql, updates)
+            for tid, into in duplicates:
+                self._merge_tag(tid, into)
+            self._con.commit()
+        self._tags_indexed = True
+
+    def _merge_tag(self, tid, into):
+        """
+        Move the nodes of the tag tid to the tag into and remove tid
+        """
+        self._cur.execute("SELECT nodeid FROM LOOKUP WHERE tagid = {0} AND "
+                          "nodeid NOT IN (SELECT nodeid FROM LOOKUP "
+                          "WHERE tagid = {0})".format(self._sub), (tid, into))
+        nodes = [(nid, into) for nid, in self._cur.fetchall()]
+        self._cur.executemany("INSERT INTO LOOKUP(nodeid, tagid) "
+                              "VALUES({0}, {0})".format(self._sub), nodes)
+        self._cur.execute("DELETE FROM LOOKUP WHERE tagid = {}".format(
+            self._sub), (tid,))
+        self._cur.execute("DELETE FROM TAG WHERE ID = {}".format(self._sub),
+                          (tid,))
+
+    def _index_urls(self):
+        """
+        Compute the host name index of nodes which were stored without one.
+        Nodes without a host name get an empty index.
+        """
+        if self._urls_indexed:
+            return
+        self._cur.execute("SELECT ID, URL FROM NODE WHERE URLIDX IS NULL")
+        rows = [(nid, _bytes(url)) for nid, url in self._cur.fetchall()]
+        if rows:
+            ce = CryptoEngine.get()
+            ce.decrypt_many([url for _, url in rows], return_exceptions=True)
+            updates = [(self._url_index(url), nid) for nid, url in rows]
+            sql = "UPDATE NODE SET URLIDX = {0} WHERE ID = {0}".format(
+                self._sub)
+            self._cur.executemany(sql, updates)
+            self._con.commit()
+        self._urls_indexed = True
+
+    @staticmethod
+    def _url_index(urlcipher):
+        """
+        Return the blind index of the host name of an encrypted URL
+        """
+        ce = CryptoEngine.get()
+        try:
+            host = hostname(ce.decrypt_cached(urlcipher))
+        except Exception:
+            return ''
+        return ce.blind_index(host, purpose='url') if host else ''
+
+    @staticmethod
+    def _tag_index(tagcipher):
+        """
+        Return the blind index of an encrypted tag. Tags which are not
+        encrypted are indexed as they are.
+        """
+        ce = CryptoEngine.get()
+        try:
+            tag = ce.decrypt_cached(tagcipher)
+        except Exception:
+            tag = tagcipher
+        return ce.blind_index(tag)
+
+    def get_user_password(self, password=None):
+        """
+        get the databases password from the user, unless it is given
         """
         enc = CryptoEngine.get()
-        newkey = enc.changepassword()
+        newkey = enc.changepassword(password=password)
         return self.savekey(newkey)
 
-    def _clean_orphans(self):
+    @pooled
+    def clean_orphans(self):
+        """
+        Remove all the tags which no node uses. This scans the TAG table
+        and is meant for maintenance only, editnode and removenodes remove
+        the tags they leave unused.
+        """
         clean = ("delete from TAG where not exists "
                  "(select 'x' from LOOKUP l where l.TAGID = TAG.ID)")
         self._cur.execute(clean)
         self._con.commit()
 
-    def _get_node_tags(self, node):
-        sql = "SELECT tagid FROM LOOKUP WHERE NODEID = {}".format(self._sub)
-        self._cur.execute(sql, (str(node[0]),))
-        tagids = self._cur.fetchall()
-        if tagids:
-            sql = ("SELECT DATA FROM TAG WHERE ID IN"
-                   " ({})".format(','.join([self._sub]*len(tagids))))
-            tagids = [str(id[0]) for id in tagids]
-            self._cur.execute(sql, (tagids))
-            tags = self._cur.fetchall()
-            for t in tags:
-                yield t[0]
+    def _node_tag_ids(self, nodeids):
+        """
+        Return the ids of the tags of the nodes nodeids
+        """
+        tids = set()
+        for chunk in _chunks(nodeids):
+            sql = "SELECT DISTINCT tagid FROM LOOKUP WHERE nodeid IN ({})"
+            self._cur.execute(sql.format(','.join([self._sub] * len(chunk))),
+                              chunk)
+            tids.update(row[0] for row in self._cur.fetchall())
+        return list(tids)
+
+    def _remove_orphan_tags(self, tids):
+        """
+        Remove the tags of tids which no node uses anymore. Only the tags
+        of edited or removed nodes are checked, using the index on
+        LOOKUP.tagid.
+        """
+        for chunk in _chunks(tids):
+            sql = ("DELETE FROM TAG WHERE ID IN ({}) AND NOT EXISTS "
+                   "(SELECT 1 FROM LOOKUP WHERE LOOKUP.TAGID = TAG.ID)"
+                   ).format(','.join([self._sub] * len(chunk)))
+            self._cur.execute(sql, chunk)
 
     def _setnodetags(self, nodeid, tags):
-        for tag in tags:
-            tid = self._get_or_create_tag(tag)
-            self._update_tag_lookup(nodeid, tid)
+        tids = self._get_or_create_tags(tags)
+        self._insert_lookups([(nodeid, tags)], tids)
+
+    def _insert_lookups(self, nodes, tids):
+        """
+        Link the nodes of the (nodeid, tags) pairs to their tags with one
+        executemany, tids maps the blind index of the tags to their ids,
+        see _get_or_create_tags
+        """
+        lookups = dict.fromkeys((nodeid, tids[self._tag_index(t)])
+                                for nodeid, tags in nodes for t in tags)
+        if not lookups:
+            return
+        sql = "INSERT INTO LOOKUP(nodeid, tagid) VALUES({0}, {0})".format(
+            self._sub)
+        self._cur.executemany(sql, list(lookups))
+
+    def _get_tag_by_index(self, index):
+        self._index_tags()
+        sql = "SELECT ID FROM TAG WHERE IDX = {}".format(self._sub)
+        self._cur.execute(sql, (index,))
+        row = self._cur.fetchone()
+        if row:
+            return row[0]
 
     def _get_tag(self, tagcipher):
-        sql_search = "SELECT * FROM TAG"
-        self._cur.execute(sql_search)
-        ce = CryptoEngine.get()
+        return self._get_tag_by_index(self._tag_index(tagcipher))
+
+    def _get_or_create_tag(self, tagcipher):
+        tids = self._get_or_create_tags([tagcipher])
+        return tids[self._tag_index(tagcipher)]
+
+    def _select_tags(self, indexes, lock=''):
+        """
+        Return a dictionary of the blind indexes to the ids of the tags
+        which have them, with one query per 500 indexes
+        """
+        tids = {}
+        for chunk in _chunks(indexes):
+            sql = "SELECT IDX, ID FROM TAG WHERE IDX IN ({}){}".format(
+                ','.join([self._sub] * len(chunk)), lock)
+            self._cur.execute(sql, chunk)
+            tids.update(self._cur.fetchall())
+        return tids
+
+    def _get_or_create_tags(self, tagciphers):
+        """
+        Return a dictionary of the blind index of each tag to its id.
+        The existing tags are found with one query per 500 tags, the
+        missing tags are created. Another connection may create the same
+        tag meanwhile: the unique index keeps one of them, which
+        _insert_tag_sql ignores, and it is read with the created ones.
+        """
+        self._index_tags()
+        ciphers = {}
+        for tagcipher in tagciphers:
+            ciphers.setdefault(self._tag_index(tagcipher), tagcipher)
+        tids = self._select_tags(list(ciphers))
+        missing = [index for index in ciphers if index not in tids]
+        if missing:
+            self._cur.executemany(self._insert_tag_sql, [
+                (self._data_wrapper(ciphers[index]), index)
+                for index in missing])
+            tids.update(self._select_tags(missing, self._locking_read))
+        return tids
 
+    def _inserted_id(self):
+        """
+        Return the id of the row inserted last, drivers which support it
+        return the id from the INSERT statement.
+        """
         try:
-            tag = ce.decrypt(tagcipher)
-            encrypted = True
-        except Exception:
-            tag = tagcipher
-            encrypted = False
+            return self._cur.fetchone()[0]
+        except TypeError:
+            return self._cur.lastrowid
 
-        rv = self._cur.fetchall()
-        for idx, cipher in rv:
-            if encrypted and tag == ce.decrypt(cipher):
-                return idx
-            elif tag == cipher:
-                return idx
+    def _split_tags(self, tags):
+        """
+        Return the tags aggregated by _tags_aggregate as a list
+        """
+        if not tags:
+            return []
+        if isinstance(tags, bytes):
+            tags = tags.decode()
+        return [bytes.fromhex(t) for t in tags.split(',')]
 
-    def _get_or_create_tag(self, tagcipher):
-        rv = self._get_tag(tagcipher)
-        if rv:
-            return rv
-        else:
-            self._cur.execute(self._insert_tag_sql, list(map(self._data_wrapper, (tagcipher,))))  # noqa
-            try:
-                return self._cur.fetchone()[0]
-            except TypeError:
-                return self._cur.lastrowid
-
-    def _update_tag_lookup(self, nodeid, tid):
-        sql_lookup = "INSERT INTO LOOKUP(nodeid, tagid) VALUES({}, {})".format(
-            self._sub, self._sub)
-        self._cur.execute(sql_lookup, (nodeid, tid))
-        self._con.commit()
+    def _node_row(self, row):
+        return list(row[:5]) + self._split_tags(row[5])
 
-    def getnodes(self, ids):
+    def _nodes_query(self, ids):
+        """
+        Return the query of the nodes with the given ids and their tags,
+        and its parameters, all the nodes if ids is empty
+        """
+        sql = ("SELECT {}, {} FROM NODE "
+               "LEFT JOIN LOOKUP ON LOOKUP.NODEID = NODE.ID "
+               "LEFT JOIN TAG ON TAG.ID = LOOKUP.TAGID".format(
+                   self._node_columns, self._tags_aggregate))
         if ids:
-            sql = ("SELECT * FROM NODE WHERE ID IN ({})"
-                   "".format(','.join(self._sub for i in ids)))
-        else:
-            sql = "SELECT * FROM NODE"
-        self._cur.execute(sql, (ids))
-        nodes = self._cur.fetchall()
-        if not nodes:
-            return []
-        # sqlite returns nodes as bytes, postgresql returns them as str
-        if isinstance(nodes[0][1], str):
-            nodes = [node for node in nodes]
-        nodes_w_tags = []
-        for node in nodes:
-            tags = [t for t in self._get_node_tags(node)]
-            nodes_w_tags.append(list(node) + tags)
-
-        return nodes_w_tags
-
-    def listnodes(self, filter=None):
-        """return a list of node ids"""
-        if not filter:
-            sql_all = "SELECT ID FROM NODE"
-            self._cur.execute(sql_all)
-            ids = self._cur.fetchall()
-            return [id[0] for id in ids]
+            sql += " WHERE NODE.ID IN ({})".format(
+                ','.join([self._sub] * len(ids)))
+        sql += " GROUP BY NODE.ID ORDER BY NODE.ID"
+        return sql, list(ids or [])
+
+    @pooled
+    def getnodes(self, ids):
+        """
+        Return the nodes as lists of id, user, password, url and notes
+        followed by the tags. All the nodes and their tags are read with
+        one query, the nodes found in the row cache are not read.
+        """
+        if self._cache is None or not ids:
+            return self._fetch_nodes(ids)
+        self.poll_changes()
+        rows, missing = {}, []
+        for nid in map(int, ids):
+            row = self._cache.get(('node', nid))
+            if row is None:
+                missing.append(nid)
+            else:
+                rows[nid] = row
+        if missing:
+            for row in self._fetch_nodes(missing):
+                rows[row[0]] = tuple(row)
+                self._cache.put(('node', row[0]), rows[row[0]])
+        return [list(rows[nid]) for nid in sorted(rows)]
+
+    def _fetch_nodes(self, ids):
+        self._cur.execute(*self._nodes_query(ids))
+        return [self._node_row(row) for row in self._cur.fetchall()]
+
+    def subscribe(self, callback):
+        """
+        Call callback when poll_changes finds nodes which other processes
+        changed, with the list of their ids, or with None if the driver
+        cannot tell which nodes changed.
+        """
+        self._subscribers = list(self._subscribers) + [callback]
+
+    def poll_changes(self):
+        """
+        Check whether other processes changed nodes, drop them from the
+        row cache and call the subscribers. Return the ids of the changed
+        nodes, None if any node may have changed, or an empty list.
+        The cached reads poll before they look into the cache.
+        """
+        changed = self._changes()
+        if changed == []:
+            return changed
+        if self._cache is not None:
+            if changed is None:
+                self._cache.clear()
+            else:
+                self._forget_nodes(changed)
+        for callback in self._subscribers:
+            callback(changed)
+        return changed
+
+    def _changes(self):
+        """
+        Return what poll_changes returns, drivers which learn about the
+        changes of other processes override this. Without it, cached
+        rows are read again once they expire.
+        """
+        return []
+
+    def _forget_nodes(self, ids, lists=True):
+        """
+        Drop the cached rows of the nodes which changed, and the cached
+        lists of ids if nodes were added, removed or tagged differently
+        """
+        if self._cache is None:
+            return
+        self._cache.discard(('node', int(nid)) for nid in ids)
+        if lists:
+            self._cache.discard_lists()
+
+    def _background_db(self):
+        """
+        Return the database a background thread of this process uses,
+        e.g. the RecordMigrator. Drivers whose connection cannot be
+        shared between threads return another instance, connected to the
+        same database.
+        """
+        return self
+
+    @contextmanager
+    def _stream_connection(self):
+        """
+        Yield the connection which iternodes reads from until it is done
+        """
+        yield self._con
+
+    def _stream_cursor(self, con, batch_size):
+        """
+        Return a cursor of con which fetches the rows of a query in
+        batches. SQLite steps through the result as it is fetched, the
+        server drivers return a server side cursor.
+        """
+        cur = con.cursor()
+        cur.arraysize = batch_size
+        return cur
+
+    def iternodes(self, ids=None, batch_size=500):
+        """
+        Yield the nodes like getnodes, all of them if ids is None, while
+        reading batch_size rows at a time. Unlike getnodes, the memory
+        used does not grow with the size of the vault.
+        """
+        if ids is not None and not len(ids):
+            return
+        with self._stream_connection() as con:
+            cur = self._stream_cursor(con, batch_size)
+            try:
+                cur.execute(*self._nodes_query(ids))
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield self._node_row(row)
+            finally:
+                cur.close()
+
+    @pooled
+    def listnodes(self, filter=None, limit=None, after_id=None):
+        """
+        Return a list of node ids in ascending order. With limit, return
+        at most limit ids greater than after_id: the last id of a page is
+        the after_id of the next one, so each page is found with the
+        primary key, however far into the vault it is.
+        """
+        index = None
+        if filter:
+            self._index_tags()
+            index = self._tag_index(filter)
+        if self._cache is None:
+            return self._list_ids(index, limit, after_id)
+        self.poll_changes()
+        key = ('ids', index, limit, after_id)
+        ids = self._cache.get(key)
+        if ids is None:
+            ids = tuple(self._list_ids(index, limit, after_id))
+            self._cache.put(key, ids)
+        return list(ids)
+
+    def _list_ids(self, index, limit, after_id):
+        """
+        Return the ids listnodes returns, of the nodes which have the tag
+        of the blind index, or of all nodes if index is None
+        """
+        conditions, params = [], []
+        if index is None:
+            column = "ID"
+            sql = "SELECT ID FROM NODE"
         else:
-            tagid = self._get_tag(filter)
-            if not tagid:
-                return []  # pragma: no cover
+            column = "LOOKUP.NODEID"
+            sql = ("SELECT LOOKUP.NODEID FROM LOOKUP JOIN TAG ON "
+                   "LOOKUP.TAGID = TAG.ID")
+            conditions.append("TAG.IDX = {}".format(self._sub))
+            params.append(index)
+        if after_id is not None:
+            conditions.append("{} > {}".format(column, self._sub))
+            params.append(int(after_id))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY {}".format(column)
+        if limit is not None:
+            sql += " LIMIT {}".format(int(limit))
+        self._cur.execute(sql, params)
+        return [row[0] for row in self._cur.fetchall()]
 
-            # will this work for many nodes??? with the same tag?
-            self._cur.execute(self._list_nodes_sql, (tagid,))
-            self._con.commit()
-            ids = self._cur.fetchall()
-            return [id[0] for id in ids]
+    @pooled
+    def lookup(self, url):
+        """
+        Return the ids of the nodes whose URL has the host name of url, or
+        one of its parent domains.
+        """
+        domains = parent_domains(hostname(url))
+        if not domains:
+            return []
+        self._index_urls()
+        ce = CryptoEngine.get()
+        sql = "SELECT ID FROM NODE WHERE URLIDX IN ({})".format(
+            ','.join([self._sub] * len(domains)))
+        self._cur.execute(sql, [ce.blind_index(d, purpose='url')
+                                for d in domains])
+        return [row[0] for row in self._cur.fetchall()]
 
     def add_node(self, node):
-        node_tags = list(node)
-        node, tags = node_tags[:4], node_tags[-1]
-        self._cur.execute(self._add_node_sql, list(map(self._data_wrapper, (node))))  # noqa
+        return self.add_nodes([node])[0]
+
+    @pooled
+    def add_nodes(self, nodes, batch_size=500):
+        """
+        Add the nodes of an iterable and return their ids. Each batch of
+        nodes is written in one transaction: the tags of the batch are
+        found or created once, and the nodes and their tags are inserted
+        with executemany.
+        """
+        ids = []
+        batch = []
+        for node in nodes:
+            batch.append(node)
+            if len(batch) == batch_size:
+                ids.extend(self._add_nodes_batch(batch))
+                batch = []
+        if batch:
+            ids.extend(self._add_nodes_batch(batch))
+        return ids
+
+    def _add_nodes_batch(self, nodes):
+        rows = []
+        tags = []
+        for node in nodes:
+            fields = list(node)
+            rows.append(list(map(self._data_wrapper, fields[:4])) +
+                        [self._url_index(fields[2])])
+            tags.append(fields[4])
         try:
-            nid = self._cur.fetchone()[0]
-        except TypeError:
-            nid = self._cur.lastrowid
-        self._setnodetags(nid, tags)
+            tids = self._get_or_create_tags([t for ts in tags for t in ts])
+            ids = self._insert_nodes(rows)
+            self._insert_lookups(list(zip(ids, tags)), tids)
+        except Exception:
+            self._con.rollback()
+            raise
         self._con.commit()
+        self._forget_nodes(ids)
+        return ids
+
+    def _insert_nodes(self, rows):
+        """
+        Insert rows of the encrypted fields and the URL index of nodes,
+        and return their ids.
+        """
+        ids = []
+        for row in rows:
+            self._cur.execute(self._add_node_sql, row)
+            ids.append(self._inserted_id())
+        return ids
 
+    @pooled
     def listtags(self):
-        self._clean_orphans()
         get_tags = "select DATA from TAG"
         self._cur.execute(get_tags)
         tags = self._cur.fetchall()
@@ -214,37 +1036,167 @@ class Database(object):
         return []  # pragma: no cover
 
     # TODO: add this to test of postgresql and mysql!
+    @pooled
     def editnode(self, nid, **kwargs):
         tags = kwargs.pop('tags', None)
+        if 'url' in kwargs:
+            kwargs['urlidx'] = self._url_index(kwargs['url'])
         sql = ("UPDATE NODE SET {} WHERE ID = {} ".format(
             ','.join(['{}={}'.format(k, self._sub) for k in list(kwargs)]),
             self._sub))
 
         self._cur.execute(sql, (list(kwargs.values()) + [nid]))
         if tags:
-            # update all old node entries in lookup
-            # create new entries
-            # clean all old tags
+            # replace the entries of the node in lookup, and remove the
+            # old tags which are not used anymore
+            old_tids = self._node_tag_ids([nid])
             sql_clean = "DELETE FROM LOOKUP WHERE NODEID={}".format(self._sub)
             self._cur.execute(sql_clean, (str(nid),))
             self._setnodetags(nid, tags)
+            self._remove_orphan_tags(old_tids)
 
         self._con.commit()
+        self._forget_nodes([nid], lists=bool(tags))
 
-    def removenodes(self, nid):
-        # shall we do this also in the sqlite driver?
-        sql_clean = "DELETE FROM LOOKUP WHERE NODEID={}".format(self._sub)
-        self._cur.execute(sql_clean, nid)
-        sql_rm = "delete from NODE where ID = {}".format(self._sub)
-        self._cur.execute(sql_rm, nid)
+    def _match_nodes(self, nid=(), ranges=(), tags=()):
+        """
+        Return the sorted ids of the existing nodes whose id is in nid or
+        in one of the inclusive ranges (begin, end), or which have one of
+        the encrypted tags.
+        """
+        ids = set()
+        for chunk in _chunks(nid):
+            sql = "SELECT ID FROM NODE WHERE ID IN ({})".format(
+                ','.join([self._sub] * len(chunk)))
+            self._cur.execute(sql, chunk)
+            ids.update(row[0] for row in self._cur.fetchall())
+        for begin, end in ranges:
+            sql = "SELECT ID FROM NODE WHERE ID BETWEEN {0} AND {0}".format(
+                self._sub)
+            self._cur.execute(sql, (begin, end))
+            ids.update(row[0] for row in self._cur.fetchall())
+        if tags:
+            self._index_tags()
+        for chunk in _chunks(set(self._tag_index(t) for t in tags)):
+            sql = ("SELECT LOOKUP.NODEID FROM LOOKUP JOIN TAG ON "
+                   "LOOKUP.TAGID = TAG.ID WHERE TAG.IDX IN ({})").format(
+                       ','.join([self._sub] * len(chunk)))
+            self._cur.execute(sql, chunk)
+            ids.update(row[0] for row in self._cur.fetchall())
+        return sorted(ids)
+
+    @pooled
+    def removenodes(self, nid=(), ranges=(), tags=()):
+        """
+        Remove the nodes whose id is in nid or in one of the inclusive
+        ranges (begin, end), or which have one of the encrypted tags.
+        The nodes are removed in one transaction with one statement per
+        500 nodes, return the ids of the removed nodes.
+        """
+        try:
+            ids = self._match_nodes(nid, ranges, tags)
+            tids = self._node_tag_ids(ids)
+            for chunk in _chunks(ids):
+                params = ','.join([self._sub] * len(chunk))
+                # LOOKUP cascades, but older MySQL tables ignore foreign keys
+                self._cur.execute("DELETE FROM LOOKUP WHERE NODEID IN "
+                                  "({})".format(params), chunk)
+                self._cur.execute("DELETE FROM NODE WHERE ID IN "
+                                  "({})".format(params), chunk)
+            self._remove_orphan_tags(tids)
+        except Exception:
+            self._con.rollback()
+            raise
         self._con.commit()
+        self._forget_nodes(ids)
+        return ids
+
+    @pooled
+    def _migrate_table(self, table, after, batch_size, cipher):
+        """
+        Convert the records of the rows following the row after to the
+        current record format, return the last row id and the number of
+        converted rows.
+
+        A row is only written if it still holds the records read, so an
+        edit made meanwhile is not overwritten; the rows from the first
+        one edited on are read again by the next call.
+        """
+        sql = "SELECT * FROM {} WHERE ID > {} ORDER BY ID LIMIT {}".format(
+            table, self._sub, int(batch_size))
+        self._cur.execute(sql, (after,))
+        rows = self._cur.fetchall()
+        if not rows:
+            return None, 0
+        columns = [d[0] for d in self._cur.description]
+        records = [i for i, c in enumerate(columns)
+                   if i and c.upper() not in self._index_columns]
+        columns = [columns[i] for i in records]
+        updates = []
+        for row in rows:
+            old = [row[i] for i in records]
+            values = list(old)
+            for i, value in enumerate(values):
+                if value is None or is_record_v2(value):
+                    continue
+                try:
+                    values[i] = encode_record(cipher,
+                                              decode_record(cipher, value))
+                except Exception:  # not a record, leave it as it is
+                    continue
+            if values != old:
+                updates.append((row[0], old, values))
+        assignments = ','.join('{}={}'.format(c, self._sub) for c in columns)
+        converted, edited = [], []
+        for nid, old, values in updates:
+            # = never matches NULL
+            where = ' AND '.join(
+                '{} IS NULL'.format(c) if v is None else
+                '{}={}'.format(c, self._sub) for c, v in zip(columns, old))
+            sql = "UPDATE {} SET {} WHERE ID = {} AND {}".format(
+                table, assignments, self._sub, where)
+            self._cur.execute(sql, list(map(self._data_wrapper, values)) +
+                              [nid] + [self._data_wrapper(v) for v in old
+                                       if v is not None])
+            (converted if self._cur.rowcount == 1 else edited).append(nid)
         self._con.commit()
+        if converted and table == 'NODE':
+            self._forget_nodes(converted, lists=False)
+        elif converted and self._cache is not None:
+            # the tags of cached rows changed
+            self._cache.clear()
+        if edited:
+            return edited[0] - 1, len(converted)
+        return rows[-1][0], len(converted)
+
+    def migrate_records(self, batch_size=500):
+        """
+        Convert all records stored in an older format to the current
+        record format, one batch at a time. This is a generator which
+        yields the number of rows converted in each batch, so it can be
+        run in the background and stopped between batches.
+        The conversion stops when the vault is locked.
+        """
+        ce = CryptoEngine.get()
+        for table in ('NODE', 'TAG'):
+            after = 0
+            while True:
+                cipher = ce.unlocked_cipher()
+                if cipher is None:
+                    return
+                after, converted = self._migrate_table(table, after,
+                                                       batch_size, cipher)
+                if after is None:
+                    break
+                yield converted
 
+    @pooled
     def fetch_crypto_info(self):
         self._cur.execute("SELECT * FROM CRYPTO")
         row = self._cur.fetchone()
         return row
 
+    @pooled
     def save_crypto_info(self, seed, digest):
         """save the random seed and the digested key"""
         self._cur.execute("DELETE  FROM CRYPTO")
@@ -254,6 +1206,7 @@ class Database(object):
                           list(map(self._data_wrapper, (seed, digest))))
         self._con.commit()
 
+    @pooled
     def loadkey(self):
         """
         return _keycrypted
@@ -266,6 +1219,7 @@ class Database(object):
         except TypeError:  # pragma: no cover
             return None
 
+    @pooled
     def savekey(self, key):
         salt, digest = key.split('$6$')
         sql = "INSERT INTO CRYPTO(SEED, DIGEST) VALUES({},{})".format(self._sub,  # noqa
@@ -277,6 +1231,76 @@ class Database(object):
         self._con.commit()
 
     def close(self):  # pragma: no cover
-        self._clean_orphans()
         self._cur.close()
         self._con.close()
+
+
+class PooledDatabase(Database):
+    """
+    A database server, whose connections are kept in a ConnectionPool.
+
+    Each operation borrows a connection and a new cursor, so one instance
+    can serve many threads. Outside of an operation, _con and _cur are the
+    connection which created the tables.
+    Drivers define _connect, which returns a new connection.
+    """
+    pool_options = (('pool_min', 1), ('pool_max', 5), ('pool_timeout', 30),
+                    ('reconnect_tries', 5))
+
+    _local = None
+
+    @property
+    def max_threads(self):
+        return self._pool.maxsize if self._pool is not None else 1
+
+    @property
+    def _con(self):
+        con = getattr(self._local, 'con', None)
+        return self._default_con if con is None else con
+
+    @property
+    def _cur(self):
+        cur = getattr(self._local, 'cur', None)
+        return self._default_cur if cur is None else cur
+
+    def configure(self, options):
+        super(PooledDatabase, self).configure(options)
+        self._pool_options = dict(self.pool_options)
+        for name in self._pool_options:
+            if options.get(name):
+                try:
+                    self._pool_options[name] = int(options[name])
+                except ValueError:
+                    raise DatabaseException("Invalid value %s for %s" %
+                                            (options[name], name))
+
+    def _connect(self):  # pragma: no cover
+        raise NotImplementedError
+
+    def _background_db(self):
+        # every thread borrows connections of its own
+        return self
+
+    def _stream_connection(self):
+        """
+        A stream keeps its connection until it is done, it is borrowed
+        from the pool, so the other operations can go on meanwhile.
+        """
+        return self._pool.connection()
+
+    def _open_pool(self):
+        options = getattr(self, '_pool_options', dict(self.pool_options))
+        self._local = threading.local()
+        self._pool = ConnectionPool(self._connect,
+                                    minsize=options['pool_min'],
+                                    maxsize=options['pool_max'],
+                                    timeout=options['pool_timeout'],
+                                    tries=options['reconnect_tries'])
+        # the tables are created and upgraded outside of the pool
+        self._default_con = self._pool.connect()
+        self._default_cur = self._default_con.cursor()
+
+    def close(self):  # pragma: no cover
+        self._default_cur.close()
+        self._default_con.close()
+        self._pool.close()
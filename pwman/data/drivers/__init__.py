@@ -1,21 +1,30 @@
-try:
-    from .sqlite import SQLite
-except ImportError:
-    SQLite = None
+"""
+The database drivers are imported when they are used, so opening a SQLite
+database does not import the modules of PostgreSQL, MySQL and MongoDB.
+Use load to get a driver, it is None if its dependency is not installed.
+"""
+import importlib
 
-try:
-    from .postgresql import PostgresqlDatabase
-except ImportError:
-    PostgresqlDatabase = None
+# driver class -> module
+_drivers = {'SQLite': 'sqlite',
+            'PostgresqlDatabase': 'postgresql',
+            'MySQLDatabase': 'mysql',
+            'MongoDB': 'mongodb'}
 
-try:
-    from .mysql import MySQLDatabase
-except ImportError:
-    MySQLDatabase = None
+# driver class -> class, or None
+_loaded = {}
 
-try:
-    from .mongodb import MongoDB
-except ImportError:
-    MongoDB = None
+__all__ = ['load']
 
-__all__ = [SQLite, PostgresqlDatabase, MySQLDatabase, MongoDB]
+
+def load(name):
+    """
+    Return the driver class name, or None if it can not be imported
+    """
+    if name not in _loaded:
+        try:
+            module = importlib.import_module('.' + _drivers[name], __name__)
+            _loaded[name] = getattr(module, name)
+        except ImportError:
+            _loaded[name] = None
+    return _loaded[name]
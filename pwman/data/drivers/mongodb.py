@@ -17,10 +17,16 @@
 # Copyright (C) 2015 Oz Nahum Tiram <nahumoz@gmail.com>
 # ============================================================================
 
-from pwman.data.database import Database, __DB_FORMAT__
-from pwman.util.crypto_engine import CryptoEngine
+from pwman.data.database import (Database, DatabaseException,
+                                 __DB_FORMAT__, hostname, parent_domains)
+from pwman.util.crypto_engine import (CryptoEngine, is_record_v2,
+                                      encode_record, decode_record)
+
+import threading
+import time
 
 import pymongo
+from pymongo import ReturnDocument, UpdateOne
 
 
 class MongoDB(Database):
@@ -29,75 +35,304 @@ class MongoDB(Database):
     def check_db_version(cls, dburi):
         return __DB_FORMAT__
 
+    # the options of the Database section and of MongoClient
+    pool_options = (('pool_min', 'minPoolSize', 1),
+                    ('pool_max', 'maxPoolSize', 5),
+                    ('pool_timeout', 'waitQueueTimeoutMS', 30))
+
+    # the node ids reserved at once, see _next_node_ids
+    id_block_size = 100
+    # the seconds between two reads of the change counter
+    changes_interval = 1
+
     def __init__(self, mongodb_uri, dbformat=__DB_FORMAT__):
         self.uri = mongodb_uri.geturl()
+        self._client_options = {}
+        # the reserved ids which were not handed out yet
+        self._next_id = self._end_id = 0
+        self._ids_lock = threading.Lock()
+        # the last value of the changes counter and when it was read
+        self._changes_seen = self._changes_checked = 0
+
+    def configure(self, options):
+        """
+        MongoClient keeps its own pool of connections, which is sized by
+        the pool options
+        """
+        super(MongoDB, self).configure(options)
+        for name, option, default in self.pool_options:
+            try:
+                value = int(options.get(name) or default)
+            except ValueError:
+                raise DatabaseException("Invalid value %s for %s" %
+                                        (options[name], name))
+            if option.endswith('MS'):
+                value *= 1000
+            self._client_options[option] = value
+
+    @property
+    def max_threads(self):
+        # MongoClient is thread safe, each thread uses a connection
+        return self._client_options.get('maxPoolSize', 5)
 
     def _open(self):
-        self._con = pymongo.Connection(self.uri)
+        self._con = pymongo.MongoClient(self.uri, **self._client_options)
         self._db = self._con.get_default_database()
 
-        counters = self._db.counters.find()
-        if not counters.count():
-            self._db.counters.insert({'_id': 'nodeid', 'seq': 0})
+        for counter in ('nodeid', 'changes'):
+            self._db.counters.update_one({'_id': counter},
+                                         {'$setOnInsert': {'seq': 0}},
+                                         upsert=True)
+        self._changes_seen = self._get_changes()
+        self._changes_checked = time.time()
+        self._db.nodes.create_index('tag_idx')
+        self._db.nodes.create_index('url_idx')
 
-    def _get_next_node_id(self):
-        # for newer pymongo versions ...
-        # return_document=ReturnDocument.AFTER
-        nodeid = self._db.counters.find_and_modify(
-            {'_id': 'nodeid'}, {'$inc': {'seq': 1}}, new=True,
-            fields={'seq': 1, '_id': 0})
+    def _get_next_node_id(self, count=1):
+        """
+        Reserve count node ids and return the last one
+        """
+        nodeid = self._db.counters.find_one_and_update(
+            {'_id': 'nodeid'}, {'$inc': {'seq': count}},
+            projection={'seq': 1, '_id': 0},
+            return_document=ReturnDocument.AFTER)
         return nodeid['seq']
 
-    def getnodes(self, ids):
-        if ids:
-            ids = list(map(int, ids))
-            node_dicts = self._db.nodes.find({'_id': {'$in': ids}})
-        else:
-            node_dicts = self._db.nodes.find({})
-        nodes = []
-        for node in node_dicts:
-            n = [node['_id'],
-                 node['user'],
-                 node['password'],
-                 node['url'],
-                 node['notes']]
-
-            [n.append(t) for t in node['tags']]
-            nodes.append(n)
-
-        return nodes
-
-    def listnodes(self, filter_=None):
-        if not filter_:
-            nodes = self._db.nodes.find({}, {'_id': 1})
-            return [node["_id"] for node in nodes]
-        else:
-            matching = []
-            ce = CryptoEngine.get()
-            nodes = list(self._db.nodes.find({}, {'_id': 1, 'tags': 1}))
-            for node in nodes:
-                node['tags'] = [ce.decrypt(t) for t in node['tags']]
-                if filter_ in node['tags']:
-                    matching.append(node)
-            return [node["_id"] for node in matching]
+    def _get_changes(self):
+        return self._db.counters.find_one({'_id': 'changes'})['seq']
+
+    def _count_change(self):
+        """
+        Count a write in the changes counter, which other processes poll
+        """
+        seq = self._db.counters.find_one_and_update(
+            {'_id': 'changes'}, {'$inc': {'seq': 1}},
+            projection={'seq': 1, '_id': 0},
+            return_document=ReturnDocument.AFTER)['seq']
+        # a gap is a change of another process, which is left for
+        # _changes to find
+        if seq == self._changes_seen + 1:
+            self._changes_seen = seq
+
+    def _changes(self):
+        # the counter does not tell which nodes changed, it is read at
+        # most every changes_interval seconds
+        now = time.time()
+        if now - self._changes_checked < self.changes_interval:
+            return []
+        self._changes_checked = now
+        seq = self._get_changes()
+        if seq == self._changes_seen:
+            return []
+        self._changes_seen = seq
+        return None
+
+    def _next_node_ids(self, count):
+        """
+        Return count new node ids. Ids are reserved from the counter in
+        blocks of at least id_block_size with one atomic increment, and
+        handed out from the block, so writers rarely touch the counter
+        and never wait for each other. The ids left in a block when the
+        database is closed are not used.
+        """
+        with self._ids_lock:
+            take = min(count, self._end_id - self._next_id)
+            ids = list(range(self._next_id, self._next_id + take))
+            self._next_id += take
+            need = count - take
+            if need:
+                size = max(need, self.id_block_size)
+                first = self._get_next_node_id(size) - size + 1
+                ids.extend(range(first, first + need))
+                self._next_id, self._end_id = first + need, first + size
+        return ids
+
+    def _find_nodes(self, ids):
+        query = {'_id': {'$in': list(map(int, ids))}} if ids else {}
+        # the blind indexes stay on the server
+        return self._db.nodes.find(query, {'tag_idx': 0, 'url_idx': 0}).sort(
+            '_id')
+
+    @staticmethod
+    def _node_list(node):
+        return [node['_id'], node['user'], node['password'], node['url'],
+                node['notes']] + list(node['tags'])
+
+    def _fetch_nodes(self, ids):
+        return [self._node_list(node) for node in self._find_nodes(ids)]
+
+    def iternodes(self, ids=None, batch_size=500):
+        if ids is not None and not len(ids):
+            return
+        for node in self._find_nodes(ids).batch_size(batch_size):
+            yield self._node_list(node)
+
+    def listnodes(self, filter_=None, limit=None, after_id=None):
+        return Database.listnodes(self, filter_, limit, after_id)
+
+    def _list_ids(self, index, limit, after_id):
+        query = {}
+        if index is not None:
+            query['tag_idx'] = index
+        if after_id is not None:
+            query['_id'] = {'$gt': int(after_id)}
+        nodes = self._db.nodes.find(query, {'_id': 1}).sort('_id')
+        if limit is not None:
+            nodes = nodes.limit(int(limit))
+        return [node["_id"] for node in nodes]
+
+    def _index_tags(self):
+        """
+        Compute the blind indexes of the tags of nodes which were stored
+        without them.
+        """
+        if self._tags_indexed:
+            return
+        nodes = self._db.nodes.find({'tag_idx': {'$exists': False}},
+                                    {'_id': 1, 'tags': 1})
+        self._bulk_update(
+            (node['_id'], {'tag_idx': [self._tag_index(t)
+                                       for t in node['tags']]})
+            for node in nodes)
+        self._tags_indexed = True
+
+    def _index_urls(self):
+        if self._urls_indexed:
+            return
+        nodes = self._db.nodes.find({'url_idx': {'$exists': False}},
+                                    {'_id': 1, 'url': 1})
+        self._bulk_update((node['_id'],
+                           {'url_idx': self._url_index(node['url'])})
+                          for node in nodes)
+        self._urls_indexed = True
+
+    def _bulk_update(self, updates, batch_size=500, old=None):
+        """
+        Set the fields of the nodes of (id, fields) pairs, with one
+        bulk write per batch, and return the number of nodes matched.
+        If old maps the ids to the fields read before, nodes whose
+        fields changed since are left as they are.
+        """
+        requests = []
+        matched = 0
+        for nid, fields in updates:
+            query = {'_id': nid}
+            if old is not None:
+                query.update(old[nid])
+            requests.append(UpdateOne(query, {'$set': fields}))
+            if len(requests) == batch_size:
+                matched += self._db.nodes.bulk_write(
+                    requests, ordered=False).matched_count
+                requests = []
+        if requests:
+            matched += self._db.nodes.bulk_write(
+                requests, ordered=False).matched_count
+        return matched
+
+    def lookup(self, url):
+        domains = parent_domains(hostname(url))
+        if not domains:
+            return []
+        self._index_urls()
+        ce = CryptoEngine.get()
+        indexes = [ce.blind_index(d, purpose='url') for d in domains]
+        nodes = self._db.nodes.find({'url_idx': {'$in': indexes}}, {'_id': 1})
+        return [node["_id"] for node in nodes]
 
     def add_node(self, node):
-        nid = self._get_next_node_id()
-        node = node.to_encdict()
-        node['_id'] = nid
-        self._db.nodes.insert(node)
-        return nid
+        return self.add_nodes([node])[0]
+
+    def add_nodes(self, nodes, batch_size=500):
+        nodes = list(nodes)
+        ids = []
+        for i in range(0, len(nodes), batch_size):
+            batch = nodes[i:i + batch_size]
+            docs = []
+            for nid, node in zip(self._next_node_ids(len(batch)), batch):
+                doc = node.to_encdict()
+                doc['_id'] = nid
+                doc['tag_idx'] = [self._tag_index(t) for t in doc['tags']]
+                doc['url_idx'] = self._url_index(doc['url'])
+                docs.append(doc)
+            self._db.nodes.insert_many(docs)
+            ids.extend(doc['_id'] for doc in docs)
+            self._count_change()
+        self._forget_nodes(ids)
+        return ids
 
     def listtags(self):
         tags = self._db.nodes.distinct('tags')
         return tags
 
     def editnode(self, nid, **kwargs):
-        self._db.nodes.find_and_modify({'_id': nid}, kwargs)
+        if 'tags' in kwargs:
+            kwargs['tag_idx'] = [self._tag_index(t) for t in kwargs['tags']]
+        if 'url' in kwargs:
+            kwargs['url_idx'] = self._url_index(kwargs['url'])
+        self._db.nodes.update_one({'_id': int(nid)}, {'$set': kwargs})
+        self._count_change()
+        self._forget_nodes([nid], lists='tags' in kwargs)
 
-    def removenodes(self, nid):
-        nid = list(map(int, nid))
-        self._db.nodes.remove({'_id': {'$in': nid}})
+    def clean_orphans(self):
+        # the tags are stored in their nodes
+        pass
+
+    def removenodes(self, nid=(), ranges=(), tags=()):
+        query = [{'_id': {'$in': list(map(int, nid))}}]
+        query += [{'_id': {'$gte': int(begin), '$lte': int(end)}}
+                  for begin, end in ranges]
+        if tags:
+            self._index_tags()
+            query.append({'tag_idx': {'$in': [self._tag_index(t)
+                                              for t in tags]}})
+        query = {'$or': query}
+        ids = sorted(node['_id'] for node in
+                     self._db.nodes.find(query, {'_id': 1}))
+        self._db.nodes.delete_many({'_id': {'$in': ids}})
+        self._count_change()
+        self._forget_nodes(ids)
+        return ids
+
+    def migrate_records(self, batch_size=500):
+        ce = CryptoEngine.get()
+        after = 0
+
+        def convert(cipher, value):
+            if value is None or is_record_v2(value):
+                return value
+            try:
+                return encode_record(cipher, decode_record(cipher, value))
+            except Exception:  # not a record, leave it as it is
+                return value
+
+        while True:
+            cipher = ce.unlocked_cipher()
+            if cipher is None:
+                return
+            nodes = list(self._db.nodes.find(
+                {'_id': {'$gt': after}},
+                {'tag_idx': 0, 'url_idx': 0}).sort(
+                    '_id', pymongo.ASCENDING).limit(batch_size))
+            if not nodes:
+                return
+            updates, old = [], {}
+            for node in nodes:
+                fields = {k: convert(cipher, node[k]) for k in
+                          ('user', 'password', 'url', 'notes')}
+                fields['tags'] = [convert(cipher, t) for t in node['tags']]
+                if any(fields[k] != node[k] for k in fields):
+                    updates.append((node['_id'], fields))
+                    old[node['_id']] = {k: node[k] for k in fields}
+            matched = len(updates)
+            if updates:
+                # nodes edited meanwhile are not overwritten
+                matched = self._bulk_update(updates, old=old)
+                self._count_change()
+            self._forget_nodes([nid for nid, _ in updates], lists=False)
+            if matched == len(updates):
+                after = nodes[-1]['_id']
+            # else the batch is read again, the converted nodes are skipped
+            yield matched
 
     def fetch_crypto_info(self):
         pass
@@ -105,7 +340,7 @@ class MongoDB(Database):
     def savekey(self, key):
         coll = self._db['crypto']
         salt, digest = key.split('$6$')
-        coll.insert({'salt': salt, 'key': digest})
+        coll.replace_one({}, {'salt': salt, 'key': digest}, upsert=True)
 
     def loadkey(self):
         coll = self._db['crypto']
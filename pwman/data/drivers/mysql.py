@@ -22,14 +22,15 @@
 # grant all on pwmantest.* to 'pwman'@'localhost';
 
 """MySQL Database implementation."""
-from pwman.data.database import Database, __DB_FORMAT__
+from pwman.data.database import PooledDatabase, __DB_FORMAT__
 
 import pymysql
 import pymysql as mysql
+from pymysql.cursors import SSCursor
 mysql.install_as_MySQLdb()
 
 
-class MySQLDatabase(Database):
+class MySQLDatabase(PooledDatabase):
 
     @classmethod
     def check_db_version(cls, dburi):
@@ -57,16 +58,19 @@ class MySQLDatabase(Database):
         self.dburi = mysqluri
         self.dbversion = dbformat
         self._sub = "%s"
-        self._list_nodes_sql = "SELECT NODEID FROM LOOKUP WHERE TAGID = %s "
         self._add_node_sql = ("INSERT INTO NODE(USERNAME, PASSWORD, URL, "
-                              "NOTES) "
-                              "VALUES(%s, %s, %s, %s)")
-        self._insert_tag_sql = "INSERT INTO TAG(DATA) VALUES(%s)"
+                              "NOTES, URLIDX) "
+                              "VALUES(%s, %s, %s, %s, %s)")
+        self._insert_tag_sql = ("INSERT IGNORE INTO TAG(DATA, IDX) "
+                                "VALUES(%s, %s)")
+        # InnoDB reads the snapshot of the transaction, a locking read
+        # sees the tags committed since
+        self._locking_read = ' LOCK IN SHARE MODE'
+        self._index_type = 'VARCHAR(64)'
         self._data_wrapper = lambda x: x
         self.ProgrammingError = mysql.ProgrammingError
 
-    def _open(self):
-
+    def _connect(self):
         port = 3306
         credentials, host = self.dburi.netloc.split('@')
         user, passwd = credentials.split(':')
@@ -74,11 +78,81 @@ class MySQLDatabase(Database):
             host, port = host.split(':')
             port = int(port)
 
-        self._con = mysql.connect(host=host, port=port, user=user,
-                                  passwd=passwd,
-                                  db=self.dburi.path.lstrip('/'))
-        self._cur = self._con.cursor()
+        con = mysql.connect(host=host, port=port, user=user, passwd=passwd,
+                            db=self.dburi.path.lstrip('/'))
+        # getnodes concatenates the tags of a node, the default limit of
+        # 1024 bytes is too short for nodes with many tags
+        with con.cursor() as cur:
+            cur.execute("SET SESSION group_concat_max_len = 1048576")
+        return con
+
+    def _open(self):
+        self._open_pool()
         try:
             self._create_tables()
         except pymysql.err.InternalError:
             pass
+        self._binary_columns()
+        self._upgrade_schema()
+        self._lookup_foreign_keys()
+
+    def _stream_cursor(self, con, batch_size):
+        # an unbuffered cursor reads the rows as they are fetched
+        return con.cursor(SSCursor)
+
+    def _insert_nodes(self, rows):
+        # one multi row INSERT, as executemany sends it, but never split
+        # into several statements: the ids of a simple INSERT are
+        # consecutive, and LAST_INSERT_ID is the first of them
+        values = ','.join(['(%s, %s, %s, %s, %s)'] * len(rows))
+        self._cur.execute("INSERT INTO NODE(USERNAME, PASSWORD, URL, NOTES, "
+                          "URLIDX) VALUES " + values,
+                          [value for row in rows for value in row])
+        self._cur.execute("SELECT LAST_INSERT_ID(), "
+                          "@@SESSION.auto_increment_increment")
+        first, step = self._cur.fetchone()
+        return [first + i * step for i in range(len(rows))]
+
+    def _create_lookup_table(self, name='LOOKUP'):
+        # MySQL ignores REFERENCES in a column definition, the foreign
+        # keys are declared for the table. Their columns must have the
+        # type of the ids, SERIAL is BIGINT UNSIGNED.
+        self._cur.execute("CREATE TABLE {} ("
+                          "nodeid BIGINT UNSIGNED NOT NULL, "
+                          "tagid BIGINT UNSIGNED NOT NULL, "
+                          "PRIMARY KEY (nodeid, tagid), "
+                          "INDEX LOOKUP_TAGID (tagid), "
+                          "FOREIGN KEY (nodeid) REFERENCES NODE(ID) "
+                          "ON DELETE CASCADE, "
+                          "FOREIGN KEY (tagid) REFERENCES TAG(ID) "
+                          "ON DELETE CASCADE) ENGINE=InnoDB".format(name))
+
+    def _lookup_foreign_keys(self):
+        """
+        LOOKUP tables of format 0.7 which were created with column
+        REFERENCES have no foreign keys, copy them to a table which has.
+        """
+        self._cur.execute("SELECT COUNT(*) FROM information_schema."
+                          "REFERENTIAL_CONSTRAINTS WHERE "
+                          "CONSTRAINT_SCHEMA = DATABASE() AND "
+                          "TABLE_NAME = 'LOOKUP'")
+        if self._cur.fetchone()[0] < 2:
+            self._upgrade_lookup()
+            self._con.commit()
+
+    def _binary_columns(self):
+        """
+        Records are binary, older databases store them in TEXT columns.
+        """
+        self._cur.execute("SELECT DATA_TYPE FROM information_schema.COLUMNS "
+                          "WHERE TABLE_SCHEMA = DATABASE() AND "
+                          "TABLE_NAME = 'NODE' AND COLUMN_NAME = 'USERNAME'")
+        row = self._cur.fetchone()
+        if row and row[0].lower() == 'text':
+            self._cur.execute("ALTER TABLE NODE "
+                              "MODIFY USERNAME BLOB NOT NULL, "
+                              "MODIFY PASSWORD BLOB NOT NULL, "
+                              "MODIFY URL BLOB NOT NULL, "
+                              "MODIFY NOTES BLOB NOT NULL")
+            self._cur.execute("ALTER TABLE TAG MODIFY DATA BLOB NOT NULL")
+            self._con.commit()
@@ -20,13 +20,42 @@
 # ============================================================================
 
 """Postgresql Database implementation."""
+import threading
+import uuid
+
 import psycopg2 as pg
+from psycopg2.extras import execute_values
+
+from pwman.data.database import PooledDatabase, __DB_FORMAT__, pooled
+
+# the channel of the ids of changed nodes
+NOTIFY_CHANNEL = 'pwman_nodes'
 
-from pwman.data.database import Database, __DB_FORMAT__
-from pwman.util.crypto_engine import CryptoEngine
+# notify the id of each node which is added, changed or removed, and of
+# each node whose tags change
+NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION PWMAN_NOTIFY() RETURNS TRIGGER AS $$
+DECLARE
+    nid INTEGER;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        IF TG_TABLE_NAME = 'lookup' THEN
+            nid := OLD.NODEID;
+        ELSE
+            nid := OLD.ID;
+        END IF;
+    ELSIF TG_TABLE_NAME = 'lookup' THEN
+        nid := NEW.NODEID;
+    ELSE
+        nid := NEW.ID;
+    END IF;
+    PERFORM pg_notify('{}', nid::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql""".format(NOTIFY_CHANNEL)
 
 
-class PostgresqlDatabase(Database):
+class PostgresqlDatabase(PooledDatabase):
 
     """
     Postgresql Database implementation
@@ -40,6 +69,8 @@ class PostgresqlDatabase(Database):
     Encryption and decryption are happening on your localhost, not on
     the Postgresql server.
     """
+    # the connection which listens on NOTIFY_CHANNEL, see _listen
+    _listen_con = None
 
     @classmethod
     def check_db_version(cls, dburi):
@@ -65,38 +96,81 @@ class PostgresqlDatabase(Database):
         self._pgsqluri = pgsqluri
         self.dbversion = dbformat
         self._sub = "%s"
-        self._list_nodes_sql = "SELECT NODEID FROM LOOKUP WHERE TAGID = %s "
         self._add_node_sql = ('INSERT INTO NODE(USERNAME, PASSWORD, URL, '
-                              'NOTES) VALUES(%s, %s, %s, %s) RETURNING ID')
-        self._insert_tag_sql = "INSERT INTO TAG(DATA) VALUES(%s) RETURNING ID"
+                              'NOTES, URLIDX) VALUES(%s, %s, %s, %s, %s) '
+                              'RETURNING ID')
+        self._insert_tag_sql = ("INSERT INTO TAG(DATA, IDX) VALUES(%s, %s) "
+                                "ON CONFLICT DO NOTHING")
         self.ProgrammingError = pg.ProgrammingError
         self._data_wrapper = lambda x: pg.Binary(x)
+        self._tags_aggregate = "array_agg(TAG.DATA ORDER BY TAG.ID)"
+        # the pooled threads poll the listening connection in turn
+        self._listen_lock = threading.Lock()
 
-    def _open(self):
+    def _connect(self):
+        return pg.connect(self._pgsqluri.geturl())
 
-        self._con = pg.connect(self._pgsqluri.geturl())
-        self._cur = self._con.cursor()
+    def _open(self):
+        self._open_pool()
         self._create_tables()
+        self._upgrade_schema()
+        self._create_triggers()
 
-    def _get_tag(self, tagcipher):
-        sql_search = "SELECT * FROM TAG"
-        self._cur.execute(sql_search)
-        ce = CryptoEngine.get()
+    def _create_triggers(self):
+        """
+        Create the triggers which notify the changed nodes, other
+        processes may listen even if this one does not
+        """
+        self._cur.execute("SELECT COUNT(*) FROM pg_trigger WHERE tgname IN "
+                          "('node_notify', 'lookup_notify')")
+        if self._cur.fetchone()[0] == 2:
+            return
+        self._cur.execute(NOTIFY_FUNCTION)
+        for table in ('NODE', 'LOOKUP'):
+            self._cur.execute("DROP TRIGGER IF EXISTS {0}_NOTIFY "
+                              "ON {0}".format(table))
+            self._cur.execute("CREATE TRIGGER {0}_NOTIFY AFTER INSERT OR "
+                              "UPDATE OR DELETE ON {0} FOR EACH ROW "
+                              "EXECUTE PROCEDURE PWMAN_NOTIFY()".format(table))
+        self._con.commit()
 
-        try:
-            tag = ce.decrypt(tagcipher)
-            encrypted = True
-        except Exception:
-            tag = tagcipher
-            encrypted = False
-
-        rv = self._cur.fetchall()
-        for idx, cipher in rv:
-            cipher = cipher.tobytes()
-            if encrypted and tag == ce.decrypt(cipher):
-                return idx
-            elif tag == cipher:
-                return idx
+    def _listen(self):
+        """
+        Open the connection which receives the ids of changed nodes,
+        the notifications arrive while no query runs on it
+        """
+        self._listen_con = self._pool.connect()
+        self._listen_con.autocommit = True
+        self._listen_con.cursor().execute("LISTEN " + NOTIFY_CHANNEL)
+
+    def _changes(self):
+        # the server keeps the notifications until the listener reads
+        # them, so it listens only while someone uses them
+        if self._cache is None and not self._subscribers:
+            return []
+        with self._listen_lock:
+            if self._listen_con is None:
+                # nothing was cached before the first poll
+                self._listen()
+                return []
+            try:
+                self._listen_con.poll()
+            except pg.Error:
+                # notifications may have been lost with the connection
+                self._listen_con.close()
+                self._listen()
+                return None
+            ids = set()
+            while self._listen_con.notifies:
+                ids.add(int(self._listen_con.notifies.pop(0).payload))
+        return sorted(ids)
+
+    def close(self):  # pragma: no cover
+        with self._listen_lock:
+            if self._listen_con is not None:
+                self._listen_con.close()
+                self._listen_con = None
+        super(PostgresqlDatabase, self).close()
 
     def _create_tables(self):
         if self._check_tables():
@@ -106,17 +180,20 @@ class PostgresqlDatabase(Database):
                               "USERNAME BYTEA NOT NULL, "
                               "PASSWORD BYTEA NOT NULL, "
                               "URL BYTEA NOT NULL, "
-                              "NOTES BYTEA NOT NULL"
+                              "NOTES BYTEA NOT NULL, "
+                              "URLIDX TEXT"
                               ")")
 
+            self._cur.execute("CREATE INDEX NODE_URLIDX ON NODE(URLIDX)")
+
             self._cur.execute("CREATE TABLE TAG"
                               "(ID  SERIAL PRIMARY KEY,"
-                              "DATA BYTEA NOT NULL)")
+                              "DATA BYTEA NOT NULL,"
+                              "IDX TEXT)")
 
-            self._cur.execute("CREATE TABLE LOOKUP ("
-                              "nodeid INTEGER NOT NULL REFERENCES NODE(ID),"
-                              "tagid INTEGER NOT NULL REFERENCES TAG(ID)"
-                              ")")
+            self._cur.execute("CREATE UNIQUE INDEX TAG_IDX ON TAG(IDX)")
+
+            self._create_lookup_table()
 
             self._cur.execute("CREATE TABLE CRYPTO "
                               "(SEED BYTEA, DIGEST BYTEA)")
@@ -131,6 +208,7 @@ class PostgresqlDatabase(Database):
         except Exception:  # pragma: no cover
             self._con.rollback()
 
+    @pooled
     def savekey(self, key):
         salt, digest = key.split('$6$')
         try:
@@ -146,6 +224,7 @@ class PostgresqlDatabase(Database):
         self._salt = salt
         self._con.commit()
 
+    @pooled
     def loadkey(self):
         """
         return _keycrypted
@@ -158,26 +237,24 @@ class PostgresqlDatabase(Database):
         except TypeError:  # pragma: no cover
             return None
 
-    def getnodes(self, ids):
-        if ids:
-            sql = ("SELECT * FROM NODE WHERE ID IN ({})"
-                   "".format(','.join(self._sub for i in ids)))
-        else:
-            sql = "SELECT * FROM NODE"
-        self._cur.execute(sql, (ids))
-        nodes = self._cur.fetchall()
-        if not nodes:
-            return []
+    def _insert_nodes(self, rows):
+        sql = ('INSERT INTO NODE(USERNAME, PASSWORD, URL, NOTES, URLIDX) '
+               'VALUES %s RETURNING ID')
+        return [row[0] for row in execute_values(self._cur, sql, rows,
+                                                 fetch=True)]
 
-        nodes_w_tags = []
-        for node in nodes:
-            tags = [t.tobytes() for t in self._get_node_tags(node)]
-            nodes_w_tags.append([node[0]] + [item.tobytes() for item in node[1:]] + tags)
+    def _stream_cursor(self, con, batch_size):
+        # a named cursor keeps the result on the server
+        cur = con.cursor(name='pwman_' + uuid.uuid4().hex)
+        cur.itersize = batch_size
+        return cur
 
-        return nodes_w_tags
+    def _node_row(self, row):
+        tags = [t.tobytes() for t in row[5] if t is not None]
+        return [row[0]] + [item.tobytes() for item in row[1:5]] + tags
 
+    @pooled
     def listtags(self):
-        self._clean_orphans()
         get_tags = "select DATA from TAG"
         self._cur.execute(get_tags)
         tags = self._cur.fetchall()
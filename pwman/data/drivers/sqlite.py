@@ -21,12 +21,28 @@
 
 """SQLite Database implementation."""
 from __future__ import print_function
-from ..database import Database, __DB_FORMAT__
+from collections import OrderedDict
+import re
+from ..database import Database, DatabaseException, __DB_FORMAT__
 import sqlite3 as sqlite
 
 
 class SQLite(Database):
 
+    # the PRAGMAs set on every connection, the busy timeout comes first,
+    # so changing the journal mode waits for other connections.
+    # WAL lets readers and a writer share the file, and with WAL
+    # synchronous=NORMAL is safe, a crash can lose the last transactions
+    # but does not corrupt the database.
+    default_pragmas = (('busy_timeout', '5000'),
+                       ('journal_mode', 'wal'),
+                       ('synchronous', 'normal'),
+                       ('mmap_size', '268435456'),
+                       ('cache_size', '-16000'),
+                       ('temp_store', 'memory'))
+    # the PRAGMA data_version seen last, see _changes
+    _data_version = None
+
     @classmethod
     def check_db_version(cls, fname):
         """
@@ -52,22 +68,102 @@ class SQLite(Database):
         """Initialise SQLitePwmanDatabase instance."""
         self._filename = filename
         self.dbformat = dbformat
-        self._add_node_sql = ("INSERT INTO NODE(USER, PASSWORD, URL, NOTES)"
-                              "VALUES(?, ?, ?, ?)")
-        self._list_nodes_sql = "SELECT NODEID FROM LOOKUP WHERE TAGID = ? "
-        self._insert_tag_sql = "INSERT INTO TAG(DATA) VALUES(?)"
+        self._add_node_sql = ("INSERT INTO NODE(USER, PASSWORD, URL, NOTES, "
+                              "URLIDX) VALUES(?, ?, ?, ?, ?)")
+        self._insert_tag_sql = ("INSERT OR IGNORE INTO TAG(DATA, IDX) "
+                                "VALUES(?, ?)")
         self._sub = '?'
+        self._node_columns = ("NODE.ID, NODE.USER, NODE.PASSWORD, NODE.URL, "
+                              "NODE.NOTES")
+        self._tags_aggregate = "GROUP_CONCAT(HEX(TAG.DATA))"
         self._data_wrapper = lambda x: x
+        self.pragmas = OrderedDict(self.default_pragmas)
+
+    def configure(self, options):
+        super(SQLite, self).configure(options)
+        for name in self.pragmas:
+            if options.get(name):
+                self.pragmas[name] = options[name]
+
+    def _set_pragmas(self):
+        for name, value in self.pragmas.items():
+            value = str(value).strip()
+            if not re.match(r"^-?\w+$", value):
+                raise DatabaseException("Invalid value %s for %s" %
+                                        (value, name))
+            self._cur.execute("PRAGMA {} = {}".format(name, value))
+            self._cur.fetchall()
 
     def _open(self):
+        self._connect_file()
+        self._create_tables()
+        self._upgrade_schema()
+        self._data_version = self._get_data_version()
+
+    def _connect_file(self):
         try:
-            self._con = sqlite.connect(self._filename)
+            # the connection may be opened in the background by bootstrap
+            self._con = sqlite.connect(self._filename,
+                                       check_same_thread=False)
         except sqlite.OperationalError as E:
             print("could not open %s" % self._filename)
             raise E
 
         self._cur = self._con.cursor()
-        self._create_tables()
+        self._set_pragmas()
+        # SQLite checks foreign keys only when asked to, LOOKUP relies on
+        # them to drop the rows of removed nodes and tags
+        self._cur.execute("PRAGMA foreign_keys = ON")
+
+    def _background_db(self):
+        # a connection of its own keeps the transactions of the threads
+        # apart, the tables were created when this one was opened
+        db = type(self)(self._filename, self.dbformat)
+        db.pragmas = self.pragmas
+        db._connect_file()
+        return db
+
+    def _get_data_version(self):
+        return self._con.execute("PRAGMA data_version").fetchone()[0]
+
+    def _changes(self):
+        # data_version changes when another connection commits, it does
+        # not tell which nodes changed
+        version = self._get_data_version()
+        if version == self._data_version:
+            return []
+        self._data_version = version
+        return None
+
+    def _insert_nodes(self, rows):
+        # the ids of AUTOINCREMENT are consecutive in a transaction
+        self._cur.executemany(self._add_node_sql, rows)
+        self._cur.execute("SELECT last_insert_rowid()")
+        last = self._cur.fetchone()[0]
+        return list(range(last - len(rows) + 1, last + 1))
+
+    def _create_lookup_table(self, name='LOOKUP'):
+        # the primary key is the table, there is no need for a rowid
+        self._cur.execute("CREATE TABLE {} ("
+                          "nodeid INTEGER NOT NULL, "
+                          "tagid INTEGER NOT NULL, "
+                          "PRIMARY KEY (nodeid, tagid), "
+                          "FOREIGN KEY(nodeid) REFERENCES NODE(ID) "
+                          "ON DELETE CASCADE, "
+                          "FOREIGN KEY(tagid) REFERENCES TAG(ID) "
+                          "ON DELETE CASCADE) WITHOUT ROWID".format(name))
+        self._cur.execute("CREATE INDEX LOOKUP_TAGID ON {}(tagid)".format(
+            name))
+
+    def _create_version_table(self, version):
+        # check_db_version reads the default of the column
+        self._cur.execute("CREATE TABLE DBVERSION"
+                          "(VERSION TEXT NOT NULL DEFAULT '%s')" % version)
+        self._cur.execute("INSERT INTO DBVERSION VALUES('%s')" % version)
+
+    def _set_db_version(self, version):
+        self._cur.execute("DROP TABLE DBVERSION")
+        self._create_version_table(version)
 
     def _create_tables(self):
         self._cur.execute("PRAGMA TABLE_INFO(NODE)")
@@ -76,31 +172,29 @@ class SQLite(Database):
 
         self._cur.execute("CREATE TABLE NODE (ID INTEGER PRIMARY KEY "
                           "AUTOINCREMENT, "
-                          "USER TEXT NOT NULL, "
-                          "PASSWORD TEXT NOT NULL, "
-                          "URL TEXT NOT NULL,"
-                          "NOTES TEXT NOT NULL)")
+                          "USER BLOB NOT NULL, "
+                          "PASSWORD BLOB NOT NULL, "
+                          "URL BLOB NOT NULL,"
+                          "NOTES BLOB NOT NULL,"
+                          "URLIDX TEXT)")
+
+        self._cur.execute("CREATE INDEX NODE_URLIDX ON NODE(URLIDX)")
 
         self._cur.execute("CREATE TABLE TAG"
                           "(ID INTEGER PRIMARY KEY AUTOINCREMENT,"
-                          "DATA BLOB NOT NULL)")
+                          "DATA BLOB NOT NULL,"
+                          "IDX TEXT)")
 
-        self._cur.execute("CREATE TABLE LOOKUP ("
-                          "nodeid INTEGER NOT NULL, "
-                          "tagid INTEGER NOT NULL, "
-                          "FOREIGN KEY(nodeid) REFERENCES NODE(ID),"
-                          "FOREIGN KEY(tagid) REFERENCES TAG(ID))")
+        self._cur.execute("CREATE UNIQUE INDEX TAG_IDX ON TAG(IDX)")
+
+        self._create_lookup_table()
 
         self._cur.execute("CREATE TABLE CRYPTO"
                           "(SEED TEXT,"
                           " DIGEST TEXT)")
 
         # create a table to hold DB version info
-        self._cur.execute("CREATE TABLE DBVERSION"
-                          "(VERSION TEXT NOT NULL DEFAULT '%s')" %
-                          self.dbformat)
-        self._cur.execute("INSERT INTO DBVERSION VALUES('%s')" %
-                          self.dbformat)
+        self._create_version_table(self.dbformat)
         try:
             self._con.commit()
         except Exception as e:  # pragma: no cover
@@ -66,7 +66,7 @@ def check_db_version(dburi):
     dburi = urlparse(dburi)
     dbtype = dburi.scheme
     try:
-        cls = getattr(drivers, class_db_map[dbtype][0])
+        cls = drivers.load(class_db_map[dbtype][0])
         ver = cls.check_db_version(class_db_map[dbtype][1](dburi))
         return ver
     except AttributeError:
@@ -79,7 +79,9 @@ def createdb(dburi, version):
     dburi = urlparse(dburi)
     dbtype = dburi.scheme
     try:
-        cls = getattr(drivers, create_db_map[dbtype][0])
+        cls = drivers.load(create_db_map[dbtype][0])
+        if cls is None:
+            raise AttributeError(create_db_map[dbtype][0])
         return cls(create_db_map[dbtype][1](dburi))
     except AttributeError:
         raise DatabaseException(
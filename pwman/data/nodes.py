@@ -18,23 +18,33 @@
 # ============================================================================
 # Copyright (C) 2006 Ivan Kelly <ivan@ivankelly.net>
 # ============================================================================
-from builtins import bytes
 from colorama import Fore
-from pwman.util.crypto_engine import CryptoEngine
+from pwman.util.crypto_engine import CryptoEngine, is_record_v2
 import pwman.ui.tools
 
 
+def _record(value):
+    """
+    Return an encrypted record as read from the database as bytes.
+    Binary records are kept as they are, older records are base64 text.
+    """
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    value = bytes(value)
+    return value if is_record_v2(value) else value.strip()
+
+
 class Node(object):
 
     def __init__(self, clear_text=True, **kwargs):
         if clear_text:
             enc = CryptoEngine.get()
-            self._username = enc.encrypt(kwargs.get('username')).strip()
-            self._password = enc.encrypt(kwargs.get('password')).strip()
-            self._url = enc.encrypt(kwargs.get('url')).strip()
-            self._notes = enc.encrypt(kwargs.get('notes')).strip()
-            self._tags = [enc.encrypt(t).strip() for t in
-                          kwargs.get('tags', '')]
+            fields = [kwargs.get('username'), kwargs.get('password'),
+                      kwargs.get('url'), kwargs.get('notes')]
+            fields += list(kwargs.get('tags', ''))
+            fields = enc.encrypt_many(fields)
+            (self._username, self._password, self._url,
+             self._notes), self._tags = fields[:4], fields[4:]
 
     def __str__(self):
         tags = self.tags
@@ -73,6 +83,18 @@ class Node(object):
         d['tags'] = self._tags
         return d
 
+    def to_dict(self, secrets=True):
+        """
+        Return a dictionary of clear texts. The password and the notes
+        are left out unless secrets is True.
+        """
+        d = {'id': getattr(self, '_id', None), 'username': self.username,
+             'url': self.url, 'tags': [t.decode() for t in self.tags]}
+        if secrets:
+            d['password'] = self.password
+            d['notes'] = self.notes
+        return d
+
     @classmethod
     def from_encrypted_entries(cls, username, password, url, notes, tags):
         """
@@ -80,18 +102,11 @@ class Node(object):
         the encrypted entities from the database
         """
         node = Node(clear_text=False)
-        if type(username) == bytes:
-            node._username = username.strip()
-            node._password = password.strip()
-            node._url = url.strip()
-            node._notes = notes.strip()
-            node._tags = [t.strip() for t in tags]
-        else:
-            node._username = bytes(username, 'utf8').strip()
-            node._password = bytes(password, 'utf8').strip()
-            node._url = bytes(url, 'utf8').strip()
-            node._notes = bytes(notes, 'utf8').strip()
-            node._tags = [bytes(t, 'utf8').strip() for t in tags]
+        node._username = _record(username)
+        node._password = _record(password)
+        node._url = _record(url)
+        node._notes = _record(notes)
+        node._tags = [_record(t) for t in tags]
         return node
 
     def __iter__(self):
@@ -104,33 +119,33 @@ class Node(object):
     def password(self):
         """Get the current password."""
         enc = CryptoEngine.get()
-        p = enc.decrypt(self._password).strip()
+        p = enc.decrypt_cached(self._password).strip()
         return p.decode()
 
     @property
     def username(self):
         """Get the current username."""
         enc = CryptoEngine.get()
-        u = enc.decrypt(self._username).strip()
+        u = enc.decrypt_cached(self._username).strip()
         return u.decode()
 
     @username.setter
     def username(self, value):
         """Set the username."""
         enc = CryptoEngine.get()
-        self._username = enc.encrypt(value).strip()
+        self._username = enc.encrypt_cached(value)
 
     @password.setter
     def password(self, value):
         """Set the Notes."""
         enc = CryptoEngine.get()
-        self._password = enc.encrypt(value).strip()
+        self._password = enc.encrypt_cached(value)
 
     @property
     def tags(self):
         enc = CryptoEngine.get()
         try:
-            return [enc.decrypt(tag) for tag in
+            return [enc.decrypt_cached(tag) for tag in
                     filter(None, self._tags)]
         except Exception:
             return [tag for tag in filter(None, self._tags)]
@@ -138,30 +153,30 @@ class Node(object):
     @tags.setter
     def tags(self, value):
         enc = CryptoEngine.get()
-        self._tags = [enc.encrypt(tag).strip() for tag in value]
+        self._tags = enc.encrypt_many(value)
 
     @property
     def url(self):
         """Get the current url."""
         enc = CryptoEngine.get()
-        u = enc.decrypt(self._url).strip()
+        u = enc.decrypt_cached(self._url).strip()
         return u.decode()
 
     @url.setter
     def url(self, value):
         """Set the Notes."""
         enc = CryptoEngine.get()
-        self._url = enc.encrypt(value).strip()
+        self._url = enc.encrypt_cached(value)
 
     @property
     def notes(self):
         """Get the current notes."""
         enc = CryptoEngine.get()
-        n = enc.decrypt(self._notes).strip()
+        n = enc.decrypt_cached(self._notes).strip()
         return n.decode()
 
     @notes.setter
     def notes(self, value):
         """Set the Notes."""
         enc = CryptoEngine.get()
-        self._notes = enc.encrypt(value).strip()
+        self._notes = enc.encrypt_cached(value)
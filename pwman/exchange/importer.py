@@ -20,12 +20,20 @@
 A module to hold the importer class
 '''
 import csv
+import os
 import sys
+import time
+from itertools import islice
+
 from pwman.data.nodes import Node
 from pwman.util.crypto_engine import CryptoEngine
 from pwman.ui.tools import CLICallback
 
 
+class ImporterException(Exception):
+    pass
+
+
 class BaseImporter(object):  # pragma: no cover
 
     """
@@ -41,42 +49,90 @@ class CSVImporter(BaseImporter):
 
     """
     A reference implementation which imports a CSV to the pwman database
+
+    The file is read in chunks of batch_size rows, the rows of a chunk are
+    encrypted with CryptoEngine.encrypt_many, which spreads the work on
+    the worker pool of the engine, and written in one transaction. Only
+    one chunk is held in memory, so large exports can be imported.
+
+    Rows which can not be imported are written with their line number and
+    the reason to <file>.rejects. After each chunk the last imported line
+    is written to <file>.checkpoint, an import which was interrupted
+    continues after that line when it is started again.
     """
-    def __init__(self, args, config, db):
+    batch_size = 1000
+    columns = 5
+
+    def __init__(self, args, config, db, out=None):
         self.args = args
         self.config = config
         self._db = db
+        self.out = out or sys.stderr
+        self.imported = 0
+        self.rejected = 0
 
-    def _read_file(self):
-        """read the csv file, remove empty lines and the header"""
+    def _open_file(self):
+        """open the csv file, the file name and delimiter can be swapped"""
         try:
-            fh, delim = open(self.args.file_delim[0]), self.args.file_delim[1]
-            csv_f = csv.reader(fh, delimiter=delim)
+            fh, delim = (open(self.args.file_delim[0], newline=''),
+                         self.args.file_delim[1])
         except FileNotFoundError:
-            fh, delim = open(self.args.file_delim[1]), self.args.file_delim[0]
-            csv_f = csv.reader(fh, delimiter=delim)
-
-        lines = [line for line in csv_f]
-        lines = list(filter(None, lines))
-        fh.close()
-        return lines[1:]
+            fh, delim = (open(self.args.file_delim[1], newline=''),
+                         self.args.file_delim[0])
+        self.filename = fh.name
+        self.delimiter = delim
+        return fh
 
-    def _create_node(self, row):
-        """create a node object with encrypted properties"""
-        try:
-            n = {'clear_text': True,
-                 'username': row[0], 'password': row[2], 'url': row[1],
-                 'notes': row[3],
-                 'tags': row[4].split(',')}
-            node = Node(**n)
-        except IndexError as err:
-            print('{}\nDid you specify the correct delimiter?'.format(err))
-            sys.exit(1)
-        return node
-
-    def _insert_node(self, node):
-        "insert the node object to the database"
-        self._db.add_node(node)
+    def _iter_rows(self, after=0):
+        """
+        Yield the line number and the row of each line of the csv file,
+        empty lines, the header and the lines up to after are skipped
+        """
+        with self._open_file() as fh:
+            csv_f = csv.reader(fh, delimiter=self.delimiter)
+            header = True
+            for row in csv_f:
+                if not row:
+                    continue
+                if header:
+                    header = False
+                    continue
+                if csv_f.line_num > after:
+                    yield csv_f.line_num, row
+
+    def _check_row(self, row):
+        if len(row) < self.columns:
+            raise ImporterException(
+                "Expected {} columns, found {}. Did you specify the correct "
+                "delimiter?".format(self.columns, len(row)))
+
+    @staticmethod
+    def _row_fields(row):
+        """the clear text fields of a row, the tags come last"""
+        return [row[0], row[2], row[1], row[3]] + \
+            [t for t in row[4].split(',') if t]
+
+    def _create_nodes(self, rows):
+        """
+        Create the nodes of many rows, all fields are encrypted together so
+        the worker pool of the crypto engine is kept busy
+        """
+        fields = [self._row_fields(row) for row in rows]
+        ciphers = CryptoEngine.get().encrypt_many(
+            [f for row_fields in fields for f in row_fields], cache=False)
+        nodes = []
+        start = 0
+        for row_fields in fields:
+            end = start + len(row_fields)
+            record = ciphers[start:end]
+            nodes.append(Node.from_encrypted_entries(*record[:4],
+                                                     tags=record[4:]))
+            start = end
+        return nodes
+
+    def _insert_nodes(self, nodes):
+        "insert the node objects to the database in one transaction"
+        self._db.add_nodes(nodes, batch_size=max(len(nodes), 1))
 
     def _open_db(self):
         """
@@ -90,17 +146,88 @@ class CSVImporter(BaseImporter):
         self._db._con.commit()
         self._db.open()
 
+    def _load_checkpoint(self):
+        """return the last line of an interrupted import, or 0"""
+        try:
+            with open(self.filename + '.checkpoint') as fh:
+                return int(fh.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _save_checkpoint(self, line):
+        tmp = self.filename + '.checkpoint.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(str(line))
+        os.replace(tmp, self.filename + '.checkpoint')
+
+    def _open_rejects(self, append):
+        # the rejected rows hold passwords like the csv file
+        fd = os.open(self.filename + '.rejects',
+                     os.O_WRONLY | os.O_CREAT |
+                     (os.O_APPEND if append else os.O_TRUNC), 0o600)
+        return open(fd, 'w', newline='')
+
+    def _report(self, started, done=False):
+        elapsed = max(time.time() - started, 1e-6)
+        self.out.write("\rImported {} rows, rejected {} ({:.0f} rows/s)"
+                       "{}".format(self.imported, self.rejected,
+                                   self.imported / elapsed,
+                                   '\n' if done else ''))
+        self.out.flush()
+
+    def import_rows(self):
+        """
+        Import the rows of the csv file, return the number of imported
+        and rejected rows
+        """
+        # find the file and the delimiter
+        self._open_file().close()
+        after = self._load_checkpoint()
+        if after:
+            self.out.write("Resuming the import of {} after line {}\n".format(
+                self.filename, after))
+        started = time.time()
+        rows = self._iter_rows(after)
+        with self._open_rejects(append=bool(after)) as rejects_fh:
+            rejects = csv.writer(rejects_fh, delimiter=self.delimiter)
+            while True:
+                chunk = list(islice(rows, self.batch_size))
+                if not chunk:
+                    break
+                good = []
+                for line, row in chunk:
+                    try:
+                        self._check_row(row)
+                    except ImporterException as err:
+                        rejects.writerow([line, err] + row)
+                        self.rejected += 1
+                    else:
+                        good.append(row)
+                if good:
+                    self._insert_nodes(self._create_nodes(good))
+                    self.imported += len(good)
+                rejects_fh.flush()
+                self._save_checkpoint(chunk[-1][0])
+                self._report(started)
+        self._report(started, done=True)
+        if os.path.exists(self.filename + '.checkpoint'):
+            os.remove(self.filename + '.checkpoint')
+        if os.path.getsize(self.filename + '.rejects'):
+            self.out.write("The rejected rows were written to {}\n".format(
+                self.filename + '.rejects'))
+        else:
+            os.remove(self.filename + '.rejects')
+        return self.imported, self.rejected
+
     def run(self, callback=CLICallback):
 
         enc = CryptoEngine.get()
         enc.callback = callback()
         self._open_db()
-
-        for row in self._read_file():
-            node = self._create_node(row)
-            self._insert_node(node)
-
-        self._db.close()
+        try:
+            self.import_rows()
+        finally:
+            self._db.close()
 
 
 class Importer(object):
@@ -0,0 +1,332 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+An agent which keeps the vault unlocked, much like ssh-agent keeps keys.
+
+The agent holds the crypto engine and an open database, and listens on
+a Unix socket which only its owner can use. Requests and replies are
+JSON objects, one per line::
+
+    {"cmd": "get", "id": 3}
+    {"ok": true, "node": {"id": 3, "username": "alice", ...}}
+
+Failed requests are answered with {"ok": false, "error": "..."}.
+The vault is locked after lock_timeout seconds without requests, a
+locked agent answers only ping, unlock, lock and stop.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+
+from pwman import get_conf_options, get_crypto_engine, open_database
+from pwman.data.nodes import Node
+from pwman.ui.tools import CLICallback
+from pwman.util.callback import Callback
+from pwman.util.crypto_engine import CryptoEngine, CryptoException
+
+# the commands a locked agent answers
+UNLOCKED_COMMANDS = ('ping', 'unlock', 'lock', 'stop')
+
+
+class AgentException(Exception):
+    pass
+
+
+class LockedCallback(Callback):
+    """
+    The agent has no terminal to ask for the password, a locked vault
+    is unlocked only with the unlock command.
+    """
+
+    def getsecret(self, question):
+        raise CryptoException("The vault is locked")
+
+
+def get_socket_path(config):
+    """
+    Return the socket of the agent, the environment variable
+    PWMAN_AGENT_SOCK takes precedence over the configuration.
+    """
+    return os.environ.get('PWMAN_AGENT_SOCK',
+                          config.get_value('Agent', 'socket'))
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+
+    # drop clients which keep the connection open without using it,
+    # the agent serves one connection at a time
+    timeout = 10
+
+    def handle(self):
+        if not self.server.is_owner(self.request):
+            return
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                reply = self.server.agent.dispatch(line)
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+                self.wfile.flush()
+        except socket.timeout:
+            pass
+
+
+class AgentServer(socketserver.UnixStreamServer):
+
+    def __init__(self, path, agent):
+        self.agent = agent
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, AgentHandler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(path, 0o600)
+
+    def is_owner(self, sock):
+        """
+        Check that the peer runs as the same user as the agent, where the
+        platform can tell. The permission of the socket is checked anyway.
+        """
+        if not hasattr(socket, 'SO_PEERCRED'):  # pragma: no cover
+            return True
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+
+class Agent(object):
+    """
+    Answer requests for the nodes of an open database. The commands are
+    the methods named cmd_<command>, each gets the request and returns
+    the fields of the reply.
+    """
+
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self._stopped = False
+
+    @property
+    def locked(self):
+        return CryptoEngine.get().unlocked_cipher() is None
+
+    def dispatch(self, line):
+        try:
+            request = json.loads(line.decode('utf8'))
+            cmd = request.get('cmd')
+            handler = getattr(self, 'cmd_' + str(cmd), None)
+            if handler is None:
+                raise AgentException("Unknown command %s" % cmd)
+            if cmd not in UNLOCKED_COMMANDS and self.locked:
+                raise AgentException("The vault is locked")
+            reply = handler(request)
+            CryptoEngine.get().keep_alive()
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+        reply['ok'] = True
+        return reply
+
+    def _nodes(self, ids, secrets=False):
+        if not ids:
+            return []
+        nodes = []
+        for row in self._db.getnodes(ids):
+            node = Node.from_encrypted_entries(row[1], row[2], row[3],
+                                               row[4], row[5:])
+            node._id = row[0]
+            nodes.append(node)
+        fields = ['username', 'url', 'tags']
+        if secrets:
+            fields += ['password', 'notes']
+        ciphers = []
+        for node in nodes:
+            for field in fields:
+                value = getattr(node, '_' + field)
+                ciphers.extend(value if field == 'tags' else [value])
+        CryptoEngine.get().decrypt_many(filter(None, ciphers),
+                                        return_exceptions=True)
+        return [node.to_dict(secrets) for node in nodes]
+
+    def _node(self, request):
+        nid = int(request['id'])
+        nodes = self._nodes([nid], secrets=True)
+        if not nodes:
+            raise AgentException("No node with id %d" % nid)
+        return nodes[0]
+
+    def cmd_ping(self, request):
+        return {'locked': self.locked}
+
+    def cmd_unlock(self, request):
+        ce = CryptoEngine.get()
+        if not ce.authenticate(request.get('password', '').encode()):
+            raise AgentException("Wrong password")
+        return {}
+
+    def cmd_lock(self, request):
+        CryptoEngine.get().forget()
+        return {}
+
+    def cmd_stop(self, request):
+        self._stopped = True
+        return {}
+
+    def cmd_get(self, request):
+        return {'node': self._node(request)}
+
+    def cmd_list(self, request):
+        tag = request.get('tag')
+        if tag:
+            tag = CryptoEngine.get().encrypt(tag)
+        return {'nodes': self._nodes(self._db.listnodes(filter=tag))}
+
+    def cmd_lookup(self, request):
+        return {'nodes': self._nodes(self._db.lookup(request['url']))}
+
+    def cmd_add(self, request):
+        fields = {k: request.get(k, '') for k in
+                  ('username', 'password', 'url', 'notes')}
+        node = Node(clear_text=True, tags=request.get('tags', []), **fields)
+        return {'id': self._db.add_node(node)}
+
+    def cmd_edit(self, request):
+        node = self._node(request)
+        node.update({k: request[k] for k in node if k in request})
+        edited = Node(clear_text=True,
+                      **{k: v for k, v in node.items() if k != 'id'})
+        self._db.editnode(node['id'], **edited.to_encdict())
+        return {}
+
+    def serve(self, poll_interval=1):
+        """
+        Serve requests until the stop command, the vault is locked and
+        the clear texts are dropped after lock_timeout seconds without
+        requests.
+        """
+        server = AgentServer(self.path, self)
+        server.timeout = poll_interval
+        try:
+            while not self._stopped:
+                server.handle_request()
+                if self.locked:
+                    CryptoEngine.get().forget()
+        finally:
+            server.server_close()
+            os.remove(self.path)
+
+
+class AgentClient(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def request(self, cmd, **kwargs):
+        """
+        Send a request to the agent and return the reply, raise
+        AgentException if the request failed.
+        """
+        kwargs['cmd'] = cmd
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(kwargs).encode() + b'\n')
+            with sock.makefile('rb') as f:
+                reply = json.loads(f.readline().decode('utf8'))
+        except (OSError, ValueError) as e:
+            raise AgentException("Could not talk to the agent at %s: %s" %
+                                 (self.path, e))
+        finally:
+            sock.close()
+        if not reply.pop('ok'):
+            raise AgentException(reply['error'])
+        return reply
+
+
+def _prepare_socket(path):
+    """
+    Create the directory of the socket, and remove a socket which was
+    left behind by an agent which is not running anymore.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    if os.path.exists(path):
+        try:
+            AgentClient(path).request('ping')
+        except AgentException:
+            os.remove(path)
+        else:
+            raise AgentException("An agent is already listening on %s" %
+                                 path)
+
+
+def _daemonize():  # pragma: no cover
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+
+def main():  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        prog='pwman3-agent',
+        description="Keep a pwman3 vault unlocked for other processes")
+    parser.add_argument('-c', '--config', dest='cfile',
+                        default=os.path.expanduser("~/.pwman/config"),
+                        help='cofiguration file to read')
+    parser.add_argument('-d', '--database', dest='dbase')
+    parser.add_argument('-s', '--socket', dest='socket',
+                        help='the socket to listen on')
+    parser.add_argument('-f', '--foreground', action='store_true',
+                        help='do not detach from the terminal')
+    args = parser.parse_args()
+
+    _, _, config = get_conf_options(args, sys.platform == 'darwin')
+    path = args.socket or get_socket_path(config)
+    try:
+        _prepare_socket(path)
+    except AgentException as e:
+        sys.exit(str(e))
+
+    ce = get_crypto_engine(config)
+    if ce._timeout <= 0:
+        sys.exit("The agent needs a positive lock_timeout")
+    ce.callback = CLICallback()
+    db = open_database(config)
+    # unlock now, while there is a terminal to ask for the password
+    ce.encrypt(b'')
+    ce.callback = LockedCallback()
+
+    print("PWMAN_AGENT_SOCK={}; export PWMAN_AGENT_SOCK;".format(path))
+    sys.stdout.flush()
+    if not args.foreground:
+        _daemonize()
+    try:
+        Agent(db, path).serve()
+    finally:
+        db.close()
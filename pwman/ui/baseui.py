@@ -81,12 +81,22 @@ class HelpUIMixin(object):  # pragma: no cover
         print("Clear the Screen from information.")
 
     def help_list(self):
-        self._usage("list|ls <tag> ...")
+        self._usage("list|ls [tag] [--limit N] [--page N]")
         print("List nodes that match current or specified filter.",
-              " ls is an alias.")
+              " ls is an alias. One screen of nodes is listed at a time,",
+              " or N nodes with --limit. --page N skips to the Nth page.")
+
+    def help_next(self):
+        self._usage("next")
+        print("List the next page of nodes of the last list command.")
+
+    def help_lookup(self):
+        self._usage("lookup <domain|url>")
+        print("List nodes whose URL has the host name of the given domain,",
+              "or one of its parent domains.")
 
     def help_delete(self):
-        self._usage("delete|rm <ID|tag> ...")
+        self._usage("delete|rm <ID|tag|tag:TAG> ...")
         print("Deletes nodes.")
         self._mult_id_help()
 
@@ -182,6 +192,9 @@ class BaseUtilsMixin:
     directly
     """
 
+    # the filter, page size and last id of a listing which has more pages
+    _listing = None
+
     def _get_ids(self, args):
         """
         Each command can get a single ID or
@@ -208,6 +221,42 @@ class BaseUtilsMixin:
 
         return ids
 
+    def _get_selection(self, args):
+        """
+        Split args into ids, ranges of ids and tags, e.g. '2 5-9 foo'
+        selects node 2, the nodes 5 to 9 and the nodes tagged foo.
+        A tag no node has must be written tag:foo, so a mistyped id is
+        not taken for a tag. If any word is not valid, e.g. a range
+        which ends before it starts, nothing is selected.
+        The tags are returned encrypted, as listnodes expects them.
+        """
+        ids, ranges, tags, unknown, backwards = [], [], [], [], []
+        ce = CryptoEngine.get()
+        for token in args.split():
+            match = re.match(r"^(\d+)(?:-(\d+))?$", token)
+            if token.startswith('tag:') and len(token) > 4:
+                tags.append(ce.encrypt(token[4:]))
+            elif not match:
+                tag = ce.encrypt(token)
+                if self._db.listnodes(tag, limit=1):
+                    tags.append(tag)
+                else:
+                    unknown.append(token)
+            elif match.group(2) is None:
+                ids.append(int(match.group(1)))
+            elif int(match.group(2)) > int(match.group(1)):
+                ranges.append((int(match.group(1)), int(match.group(2))))
+            else:
+                backwards.append(token)
+        if backwards:
+            print("Start node should be smaller than end node: {}".format(
+                " ".join(backwards)))
+        if unknown:
+            print("Not an id, a range or a tag: {}".format(" ".join(unknown)))
+        if backwards or unknown:
+            return [], [], []
+        return ids, ranges, tags
+
     def _get_tags(self, default=None, reader=raw_input):
         """
         Read tags from user input.
@@ -265,6 +314,89 @@ class BaseUtilsMixin:
             _nodes_inst[-1]._id = node[0]
         return _nodes_inst
 
+    def _iter_nodes(self, nodeids, fields, batch_size=500):
+        """
+        Yield the nodes with nodeids, all of them if nodeids is None,
+        reading and decrypting the given fields one batch at a time.
+        """
+        batch = []
+        for row in self._db.iternodes(nodeids, batch_size=batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                nodes = self._db_entries_to_nodes(batch)
+                self._decrypt_nodes(nodes, *fields)
+                yield from nodes
+                batch = []
+        nodes = self._db_entries_to_nodes(batch)
+        self._decrypt_nodes(nodes, *fields)
+        yield from nodes
+
+    @staticmethod
+    def _parse_list_args(args, limit):
+        """
+        Return the tag, page size and page number of the list command,
+        raise ValueError for arguments it does not understand
+        """
+        tag, page = None, 1
+        tokens = args.split()
+        while tokens:
+            token = tokens.pop(0)
+            if token in ('--limit', '--page'):
+                value = int(tokens.pop(0)) if tokens else 0
+                if value < 1:
+                    raise ValueError("%s needs a positive number" % token)
+                if token == '--limit':
+                    limit = value
+                else:
+                    page = value
+            elif tag is None and not token.startswith('--'):
+                tag = token
+            else:
+                raise ValueError("Could not understand %s" % token)
+        return tag, limit, page
+
+    def _get_page(self, filter, limit, after_id=None, page=1):
+        """
+        Return the ids of a page of nodes, and whether more follow. The
+        pages before it are skipped by reading their ids only.
+        """
+        for _ in range(page - 1):
+            ids = self._db.listnodes(filter, limit=limit, after_id=after_id)
+            if not ids:
+                return [], False
+            after_id = ids[-1]
+        ids = self._db.listnodes(filter, limit=limit + 1, after_id=after_id)
+        return ids[:limit], len(ids) > limit
+
+    def _list_page(self, filter, limit, after_id=None, page=1):
+        rows, cols = self._prep_term()
+        nodeids, more = self._get_page(filter, limit, after_id, page)
+        self._list_nodes(nodeids, rows, cols)
+        if more:
+            self._listing = (filter, limit, nodeids[-1])
+            print("Type next to list more nodes")
+        else:
+            self._listing = None
+
+    def _list_nodes(self, nodeids, rows, cols):
+        head = self._format_line(cols - 32)
+        print(tools.typeset(head, Fore.YELLOW, False))
+        for node in self._iter_nodes(nodeids, ('username', 'url', 'tags')):
+            self._print_node_line(node, rows, cols)
+
+    def _decrypt_nodes(self, nodes, *fields):
+        """
+        Decrypt the given fields of all nodes in one batch, the clear texts
+        are kept in the session cache, so the nodes' properties are cheap.
+        """
+        ciphers = []
+        for node in nodes:
+            for field in fields:
+                value = getattr(node, '_' + field)
+                ciphers.extend(value if field == 'tags' else [value])
+        ce = CryptoEngine.get()
+        ce.decrypt_many(filter(None, ciphers), return_exceptions=True)
+
     def _get_input(self, prompt):
         print(prompt, end="")
         sys.stdout.flush()
@@ -288,9 +420,8 @@ class BaseUtilsMixin:
         self._db.add_node(node)
         return node
 
-    def _do_rm(self, nodes):
-        for i in nodes:
-            self._db.removenodes([i])
+    def _do_rm(self, nodes, ranges=(), tags=()):
+        self._db.removenodes(nodes, ranges, tags)
 
 
 class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
@@ -371,24 +502,21 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
 
         filename = args.get('filename', 'pwman-export.csv')
         delim = args.get('delimiter', ';')
-        nodeids = self._db.listnodes()
-        nodes = self._db.getnodes(nodeids)
+        nodes = self._iter_nodes(None, ('username', 'url', 'password',
+                                        'notes', 'tags'))
 
         with open(filename, 'w') as csvfile:
             writer = csv.writer(csvfile, delimiter=delim)
             writer.writerow(['Username', 'URL', 'Password', 'Notes',
                              'Tags'])
-            for node in nodes:
-                n = Node.from_encrypted_entries(node[1], node[2], node[3],
-                                                node[4],
-                                                node[5:])
+            for n in nodes:
                 tags = n.tags
                 tags = ','.join(t.strip().decode() for t in tags)
                 r = list([n.username, n.url, n.password, n.notes])
                 writer.writerow(r + [tags])
 
         with open(filename) as f:
-            for line in f.readlines():
+            for line in f:
                 print(line)
 
         print("Successfuly exported database to {}".format(
@@ -445,14 +573,39 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
         """
         list all existing nodes in database
         """
-        rows, cols = self._prep_term()
-        nodeids = self._get_node_ids(args)
-        raw_nodes = self._db.getnodes(nodeids)
-        _nodes_inst = self._db_entries_to_nodes(raw_nodes)
-        head = self._format_line(cols - 32)
-        print(tools.typeset(head, Fore.YELLOW, False))
-        for idx, node in enumerate(_nodes_inst):
-            self._print_node_line(node, rows, cols)
+        rows, cols = shutil.get_terminal_size()
+        try:
+            # the header, the hint for next and the prompt take 3 lines
+            tag, limit, page = self._parse_list_args(args, max(rows - 3, 1))
+        except ValueError as e:
+            print(e)
+            self.help_list()
+            return
+        filter = CryptoEngine.get().encrypt(tag) if tag else None
+        self._list_page(filter, limit, page=page)
+
+    def do_next(self, args):
+        """
+        list the next page of nodes
+        """
+        if self._listing is None:
+            print("No more nodes to list")
+            return
+        self._list_page(*self._listing)
+
+    def do_lookup(self, args):
+        """
+        list the nodes matching a domain, without decrypting the vault
+        """
+        if not args.strip():
+            self.help_lookup()
+            return
+        nodeids = self._db.lookup(args.split()[0])
+        if not nodeids:
+            print("No nodes found for %s" % args.split()[0])
+            return
+        rows, cols = shutil.get_terminal_size()
+        self._list_nodes(nodeids, rows, cols)
 
     def do_new(self, args):  # pragma: no cover
         # The cmd module stops if any of do_* return something
@@ -487,15 +640,20 @@ class BaseCommands(HelpUIMixin, AliasesMixin, BaseUtilsMixin):
         ce = CryptoEngine.get()
         ce.encrypt("")
 
-        ids = self._get_ids(args)
-        if not ids:
+        ids, ranges, tags = self._get_selection(args)
+        if not (ids or ranges or tags):
             return
+        single = len(ids) == 1 and not (ranges or tags)
         ans = tools.getinput("Are you sure you want to delete node{} {}"
-                             " [y/N]?".format("s" if len(ids) > 1 else "",
-                                              ",".join(ids) if len(ids) > 1 else ids[0]))  # noqa
+                             " [y/N]?".format("" if single else "s",
+                                              " ".join(args.split())))
         if ans.lower() == 'y':
-            self._do_rm(ids)
+            self._do_rm(ids, ranges, tags)
 
     def do_info(self, args):
         print("Currently connected to: {}".format(
               self.config.get_value("Database", "dburi")))
+        cache = self._db._cache
+        if cache is not None:
+            print("Row cache: {} entries, {} hits, {} misses".format(
+                len(cache), cache.hits, cache.misses))
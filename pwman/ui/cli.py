@@ -34,11 +34,15 @@ except ImportError as e:  # pragma: no cover
     _readline_available = True
 
 from pwman.ui.baseui import BaseCommands
-from pwman import (get_conf_options, get_db_version, version, website,
-                   parser_options, has_cryptography, calculate_client_info,
-                   is_latest_version)
+import pwman
+from pwman import (get_conf_options, get_db_version, parser_options,
+                   has_cryptography, check_version, get_crypto_engine,
+                   open_database)
+from pwman.ui.oneshot import (AgentCommands, OneShotCallback, OneShotCommands,
+                              find_agent, report_error)
 from pwman.ui.tools import CLICallback
 from pwman.data import factory
+from pwman.data.convertdb import RecordMigrator
 from pwman.exchange.importer import Importer
 from pwman.util.crypto_engine import CryptoEngine
 
@@ -56,7 +60,9 @@ class PwmanCli(cmd.Cmd, BaseCommands):
         connecion, see if we have xsel ...
         """
         super(PwmanCli, self).__init__(**kwargs)
-        self.intro = "%s %s (c) visit: %s" % ('pwman3', version, website)
+        meta = pwman.metadata()
+        self.intro = "%s %s (c) visit: %s" % ('pwman3', meta['version'],
+                                              meta['website'])
         self._historyfile = config_parser.get_value("Readline", "history")
         self.hasxsel = hasxsel
         self.config = config_parser
@@ -93,22 +99,40 @@ def get_ui_platform(platform):  # pragma: no cover
     return PwmanCli, OSX
 
 
+def run_command(args, config):
+    """
+    Run a command given on the command line, without the interactive
+    loop, and return the exit status.
+    """
+    agent = find_agent(config)
+    if agent is not None and args.command in AgentCommands.commands:
+        return AgentCommands(agent, ndjson=args.ndjson).run(args)
+    ce = get_crypto_engine(config)
+    ce.callback = OneShotCallback(args.password_file, args.password_fd)
+    try:
+        db = open_database(config)
+    except Exception as e:
+        # e.g. a wrong password, scripts read the error from stderr
+        report_error(e)
+        return 1
+    try:
+        return OneShotCommands(db, ndjson=args.ndjson).run(args)
+    finally:
+        db.close()
+
+
 def main():
     args = parser_options().parse_args()
     PwmanCli, OSX = get_ui_platform(sys.platform)
     xselpath, dbtype, config = get_conf_options(args, OSX)
     dburi = config.get_value('Database', 'dburi')
 
+    if args.command:
+        sys.exit(run_command(args, config))
+
     if config.get_value('Updater',
                         'supress_version_check').lower() != 'yes':
-        client_info = config.get_value('Updater', 'client_info')
-        if not client_info:
-            client_info = calculate_client_info()
-            config.set_value('Updater', 'client_info', client_info)
-
-        _, latest = is_latest_version(version, client_info)
-
-        if not latest:
+        if not check_version(config, pwman.metadata()['version']):
             print("A newer version of Pwman3 was release, you should consider updating")  # noqa
 
     if not has_cryptography:
@@ -121,19 +145,29 @@ def main():
                                                 colorama.Style.RESET_ALL))
 
     print(dburi)
-    dbver = get_db_version(config, args)
-    timeout = int(config.get_value('Global', 'lock_timeout'))
-    CryptoEngine.get(timeout)
-
-    db = factory.createdb(dburi, dbver)
+    ce = get_crypto_engine(config)
 
     if args.file_delim:
+        db = factory.createdb(dburi, get_db_version(config, args))
+        db.configure(dict(config.parser.items('Database')))
         importer = Importer((args, config, db))
         importer.run()
         sys.exit(0)
 
+    ce.callback = CLICallback()
+    db = open_database(config)
     cli = PwmanCli(db, xselpath, CLICallback, config)
 
+    if args.lookup:
+        cli.onecmd('lookup ' + args.lookup)
+        config.save()
+        sys.exit(0)
+
+    if (config.get_value('Crypto', 'migrate_records').lower() == 'yes' and
+            config.get_value('Crypto', 'migrated') != dburi):
+        RecordMigrator(db, on_migrated=lambda: config.set_value(
+            'Crypto', 'migrated', dburi)).start()
+
     try:
         cli.cmdloop()
     except KeyboardInterrupt as e:
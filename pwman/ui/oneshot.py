@@ -0,0 +1,287 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+Commands given on the command line, e.g. ``pwman3 get 3``.
+
+Unlike the interactive loop, these commands do not clear the screen or
+wait for the user, and write their results as JSON to stdout, so they
+can be used by scripts. Errors are written as JSON to stderr.
+
+When an unlocked pwman3-agent runs, the commands it knows are sent to it,
+otherwise the master password is read from --password-file or
+--password-fd, and asked for only if stdin is a terminal.
+"""
+import getpass
+import json
+import os
+import re
+import sys
+
+from pwman.data.nodes import Node
+from pwman.ui.agent import AgentClient, AgentException, get_socket_path
+from pwman.ui.baseui import BaseUtilsMixin
+from pwman.util.callback import Callback
+from pwman.util.crypto_engine import CryptoEngine, CryptoException
+
+
+class OneShotException(Exception):
+    pass
+
+
+def report_error(error):
+    """
+    Write error as JSON to stderr
+    """
+    sys.stderr.write(json.dumps({'error': str(error)}) + '\n')
+
+
+class OneShotCallback(Callback):
+    """
+    Read the master password from the first line of password_file or of
+    the file descriptor password_fd. Without either, ask for it if stdin
+    is a terminal, so the commands never wait for input in a script.
+    A wrong password fails the command, it can not be typed again.
+    """
+
+    def __init__(self, password_file=None, password_fd=None, stdin=None):
+        self.password_file = password_file
+        self.password_fd = password_fd
+        self.stdin = stdin or sys.stdin
+        self._password = None
+
+    def getsecret(self, question):
+        if self._password is not None:
+            # a file descriptor can be read only once
+            return self._password
+        if self.password_file is not None:
+            with open(self.password_file) as f:
+                self._password = f.readline().rstrip('\n')
+        elif self.password_fd is not None:
+            with os.fdopen(self.password_fd) as f:
+                self._password = f.readline().rstrip('\n')
+        elif self.stdin.isatty():  # pragma: no cover
+            return getpass.getpass(question + ":")
+        else:
+            raise CryptoException("The vault is locked, start pwman3-agent "
+                                  "or give --password-file or --password-fd")
+        return self._password
+
+    getnewsecret = getsecret
+
+    def error(self, error):
+        raise CryptoException(error)
+
+
+def find_agent(config):
+    """
+    Return an AgentClient of the running agent if its vault is unlocked,
+    else None
+    """
+    path = get_socket_path(config)
+    if not path or not os.path.exists(path):
+        return None
+    client = AgentClient(path)
+    try:
+        if client.request('ping')['locked']:
+            return None
+    except AgentException:
+        return None
+    return client
+
+
+class OneShotCommands(BaseUtilsMixin):
+    """
+    Run one command and write the result as a JSON array, or as one JSON
+    object per line if ndjson is True. The commands are the methods named
+    cmd_<command>, each gets the parsed arguments and returns a list.
+    """
+
+    def __init__(self, db, ndjson=False, stdout=None, stdin=None):
+        self._db = db
+        self.ndjson = ndjson
+        self.stdout = stdout or sys.stdout
+        self.stdin = stdin or sys.stdin
+
+    def run(self, args):
+        """
+        Run the command of args, return the exit status
+        """
+        try:
+            self._write(getattr(self, 'cmd_' + args.command)(args))
+        except Exception as e:
+            report_error(e)
+            return 1
+        return 0
+
+    def _write(self, items):
+        if self.ndjson:
+            for item in items:
+                self.stdout.write(json.dumps(item) + '\n')
+        else:
+            self.stdout.write(json.dumps(list(items)) + '\n')
+        self.stdout.flush()
+
+    @staticmethod
+    def _parse_ids(tokens):
+        """
+        Return the ids and the inclusive ranges (begin, end) of tokens,
+        which are ids or ranges like 1-3. Ranges are not expanded, they
+        may span many more ids than there are nodes.
+        """
+        ids, ranges = [], []
+        for token in tokens:
+            match = re.match(r"^(\d+)(?:-(\d+))?$", token)
+            if not match:
+                raise OneShotException("Could not understand %s" % token)
+            begin = int(match.group(1))
+            if match.group(2) is None:
+                ids.append(begin)
+                continue
+            end = int(match.group(2))
+            if end < begin:
+                raise OneShotException("Start node should be smaller than "
+                                       "end node")
+            ranges.append((begin, end))
+        return ids, ranges
+
+    def _range_ids(self, begin, end, batch_size=500):
+        """
+        Return the ids of the existing nodes from begin to end, reading
+        one page of ids at a time
+        """
+        ids, after = [], begin - 1
+        while True:
+            page = self._db.listnodes(limit=batch_size, after_id=after)
+            ids.extend(nid for nid in page if nid <= end)
+            if len(page) < batch_size or page[-1] >= end:
+                return ids
+            after = page[-1]
+
+    def _check_ids(self, ids, found):
+        missing = set(ids) - set(found)
+        if missing:
+            raise OneShotException("No node with id %s" % ", ".join(
+                str(i) for i in sorted(missing)))
+
+    def _read_password(self):
+        if self.stdin.isatty():  # pragma: no cover
+            return getpass.getpass("Password:")
+        return self.stdin.readline().rstrip('\n')
+
+    def _nodes(self, nodeids, secrets=False):
+        """
+        Yield the nodes with nodeids as dicts, all of them if nodeids is
+        None, without reading all of them at once
+        """
+        fields = ['username', 'url', 'tags']
+        if secrets:
+            fields += ['password', 'notes']
+        for node in self._iter_nodes(nodeids, fields):
+            yield node.to_dict(secrets)
+
+    def cmd_get(self, args):
+        ids, ranges = self._parse_ids(args.ids)
+        nodes = list(self._nodes(ids, secrets=True))
+        self._check_ids(ids, [node['id'] for node in nodes])
+        for begin, end in ranges:
+            nodes.extend(self._nodes(
+                [i for i in self._range_ids(begin, end) if i not in ids],
+                secrets=True))
+        return sorted(nodes, key=lambda node: node['id'])
+
+    def cmd_ls(self, args):
+        filter = CryptoEngine.get().encrypt(args.tag) if args.tag else None
+        if args.limit is not None:
+            if args.limit < 1 or (args.page or 1) < 1:
+                raise OneShotException("--limit and --page need a positive "
+                                       "number")
+            ids, _ = self._get_page(filter, args.limit, args.after,
+                                    args.page or 1)
+        elif args.page:
+            raise OneShotException("--page needs --limit")
+        elif filter or args.after:
+            ids = self._db.listnodes(filter, after_id=args.after)
+        else:
+            ids = None
+        return self._nodes(ids)
+
+    def cmd_add(self, args):
+        node = Node(clear_text=True, username=args.username,
+                    password=self._read_password(), url=args.url,
+                    notes=args.notes, tags=args.tags)
+        return [{'id': self._db.add_node(node)}]
+
+    def cmd_rm(self, args):
+        ids, ranges = self._parse_ids(args.ids)
+        return [{'id': i} for i in self._db.removenodes(ids, ranges=ranges)]
+
+    def cmd_tags(self, args):
+        ce = CryptoEngine.get()
+        return [t.decode() for t in
+                ce.decrypt_many(self._db.listtags())]
+
+    def cmd_export(self, args):
+        return self._nodes(None, secrets=True)
+
+
+class AgentCommands(OneShotCommands):
+    """
+    Run the commands which pwman3-agent knows with the agent, so the
+    vault is not unlocked again
+    """
+
+    commands = ('get', 'ls', 'add')
+
+    def __init__(self, agent, ndjson=False, stdout=None, stdin=None):
+        super(AgentCommands, self).__init__(None, ndjson=ndjson,
+                                            stdout=stdout, stdin=stdin)
+        self.agent = agent
+
+    def _list(self, tag=None):
+        return self.agent.request('list', tag=tag)['nodes']
+
+    def cmd_get(self, args):
+        ids, ranges = self._parse_ids(args.ids)
+        ids = set(ids)
+        if ranges:
+            ids.update(node['id'] for node in self._list()
+                       if any(b <= node['id'] <= e for b, e in ranges))
+        return [self.agent.request('get', id=nid)['node']
+                for nid in sorted(ids)]
+
+    def cmd_ls(self, args):
+        nodes = self._list(args.tag)
+        if args.after:
+            nodes = [node for node in nodes if node['id'] > args.after]
+        if args.limit is not None:
+            if args.limit < 1 or (args.page or 1) < 1:
+                raise OneShotException("--limit and --page need a positive "
+                                       "number")
+            start = ((args.page or 1) - 1) * args.limit
+            nodes = nodes[start:start + args.limit]
+        elif args.page:
+            raise OneShotException("--page needs --limit")
+        return nodes
+
+    def cmd_add(self, args):
+        nid = self.agent.request('add', username=args.username,
+                                 password=self._read_password(),
+                                 url=args.url, notes=args.notes,
+                                 tags=args.tags)['id']
+        return [{'id': nid}]
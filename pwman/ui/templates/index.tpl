@@ -113,6 +113,11 @@
      <button class="button button-clear button-tag">learning</button>  
     </div>
   </section>
+  % if next_after is not None:
+  <section class="container">
+    <a class="button button-outline float-right" href="/?after={{next_after}}">Next page</a>
+  </section>
+  % end
 
 </main>
 
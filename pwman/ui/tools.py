@@ -272,6 +272,9 @@ class CLICallback(Callback):  # pragma: no cover
     def getinput(self, question):
         return raw_input(question)
 
+    def error(self, error):
+        print(error, file=sys.stderr)
+
     def getsecret(self, question):
         return getpass.getpass(question + ":")
 
@@ -20,6 +20,7 @@
 # ============================================================================
 import sys
 import os
+import threading
 
 if sys.version_info.major > 2:  # pragma: no cover
     from configparser import (ConfigParser, ParsingError, NoOptionError,
@@ -37,12 +38,23 @@ default_config = {'Global': {'umask': '0100', 'colors': 'yes',
                              },
                   'Database': {
                       'dburi': 'sqlite://' + os.path.join(config_dir,
-                                                          'pwman.db')},
+                                                          'pwman.db'),
+                      'journal_mode': 'wal', 'synchronous': 'normal',
+                      'mmap_size': '268435456', 'cache_size': '-16000',
+                      'busy_timeout': '5000', 'temp_store': 'memory',
+                      'pool_min': '1', 'pool_max': '5', 'pool_timeout': '30',
+                      'reconnect_tries': '5', 'row_cache_size': '1000',
+                      'row_cache_ttl': '30'},
                   'Readline': {'history': os.path.join(config_dir,
                                                        'history')},
-                  'Crypto': {'supress_warning': 'no'},
-
-                  'Updater': {'supress_version_check': 'no'}
+                  'Crypto': {'supress_warning': 'no', 'workers': '0',
+                             'pool': 'thread', 'kdf': 'scrypt',
+                             'unlock_time': '0.5', 'migrate_records': 'yes'},
+
+                  'Agent': {'socket': os.path.join(config_dir,
+                                                   'agent.sock')},
+                  'Updater': {'supress_version_check': 'no',
+                              'check_interval': '86400'}
                   }
 
 if 'win' in sys.platform:
@@ -65,6 +77,9 @@ class ConfigNoConfigException(ConfigException):
 
 class Config(object):
 
+    # the update check saves the configuration from a thread of its own
+    _save_lock = threading.Lock()
+
     def __init__(self, filename=None, defaults=None, **kwargs):
 
         self.filename = filename
@@ -113,7 +128,7 @@ class Config(object):
 
     def save(self):
         if "False" not in self.get_value("Global", "Save"):
-            with open(self.filename, "w") as fp:
+            with self._save_lock, open(self.filename, "w") as fp:
                 self.parser.write(fp)
 
 
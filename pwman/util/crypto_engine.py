@@ -21,18 +21,27 @@ from __future__ import print_function
 import base64
 import binascii
 import ctypes
+import hashlib
+import hmac
 import os
 import random
 import string
 import sys
+import threading
 import time
+from collections import OrderedDict
+import concurrent.futures
+from itertools import repeat
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 from pwman.util.callback import Callback
+from pwman.util.kdf import (DEFAULT, LEGACY, calibrate, get_kdf, join_seed,
+                            split_seed)
 
 if sys.version_info.major > 2:  # pragma: no cover
     raw_input = input
@@ -52,6 +61,101 @@ def decode_AES(cipher, encoded_text):
     return cipher.decrypt(encoded_text).rstrip()
 
 
+# Records in format v2 are binary: a version byte, a 12 bytes nonce and
+# the AES-GCM cipher text with its tag. The older format is a base64
+# encoded Fernet token, which always starts with a printable character.
+RECORD_V2 = b'\x02'
+NONCE_SIZE = 12
+
+
+def _as_bytes(data):
+    if isinstance(data, str):
+        return data.encode()
+    return bytes(data)
+
+
+def is_record_v2(record):
+    return _as_bytes(record)[:1] == RECORD_V2
+
+
+def encode_record(cipher, clear_text):
+    return cipher.encrypt(clear_text)
+
+
+def decode_record(cipher, record):
+    return cipher.decrypt(record)
+
+
+class RecordCipher(object):
+    """
+    The cipher of an unlocked vault.
+
+    New records are encrypted with AES-GCM in the binary format v2, with
+    a key derived from the master key. Records in the older format are
+    still decrypted with Fernet.
+    """
+
+    def __init__(self, key):
+        self._key = key
+        self.fernet = Fernet(key)
+        self._aead = AESGCM(self.subkey(b'pwman3 record v2'))
+        self._index_keys = {}
+
+    def __getstate__(self):
+        return {'key': self._key}
+
+    def __setstate__(self, state):
+        self.__init__(state['key'])
+
+    def subkey(self, info):
+        """derive a key for the purpose named by info from the master key"""
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                    info=info, backend=default_backend())
+        return hkdf.derive(base64.urlsafe_b64decode(self._key))
+
+    def blind_index(self, purpose, value):
+        """
+        Return a keyed hash of value, which allows looking up records by
+        equality without decrypting them. Each purpose has its own key, so
+        indexes of different columns can not be correlated.
+        """
+        if purpose not in self._index_keys:
+            self._index_keys[purpose] = self.subkey(
+                b'pwman3 blind index ' + purpose.encode())
+        return hmac.new(self._index_keys[purpose], _as_bytes(value),
+                        hashlib.sha256).hexdigest()
+
+    def encrypt(self, clear_text):
+        if not isinstance(clear_text, bytes):
+            clear_text = clear_text.encode()
+        nonce = os.urandom(NONCE_SIZE)
+        return (RECORD_V2 + nonce +
+                self._aead.encrypt(nonce, clear_text, RECORD_V2))
+
+    def decrypt(self, record):
+        record = _as_bytes(record)
+        if record[:1] != RECORD_V2:
+            return decode_AES(self.fernet, record)
+        nonce = record[1:1 + NONCE_SIZE]
+        return self._aead.decrypt(nonce, record[1 + NONCE_SIZE:], RECORD_V2)
+
+
+def _map_cipher(func, cipher, items):
+    """
+    Apply func(cipher, item) to each item, errors are returned in place
+    of the failed item, so a single bad token does not spoil a batch.
+    This is a module level function, so it can be sent to worker processes.
+    """
+    results = []
+    for item in items:
+        try:
+            results.append(func(cipher, item))
+        except Exception as E:
+            results.append(CryptoException("{}: {}".format(
+                E.__class__.__name__, E)))
+    return results
+
+
 def generate_password(pass_len=8, uppercase=True, lowercase=True, digits=True,
                       special_chars=True):
     allowed = ''
@@ -83,27 +187,23 @@ class CryptoException(Exception):
     pass
 
 
-def get_digest(password, salt):
+def get_digest(password, salt, kdf=None):
     """
-    Get a digest based on clear text password
+    Get a digest based on clear text password, kdf is one of the key
+    derivation functions from pwman.util.kdf, by default the one used
+    by vaults which do not specify a KDF.
     """
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=5000,
-        backend=default_backend()
-    )
-    key = base64.urlsafe_b64encode(kdf.derive(password))
+    kdf = kdf or LEGACY
+    key = base64.urlsafe_b64encode(kdf.derive(password, salt))
     return key
 
 
-def get_cipher(password, salt):
+def get_cipher(password, salt, kdf=None):
     """
     Create a chiper object from a hashed password
     """
-    dig = get_digest(password, salt)
-    return Fernet(dig)
+    dig = get_digest(password, salt, kdf)
+    return RecordCipher(dig)
 
 
 def prepare_data(text, block_size):
@@ -116,9 +216,64 @@ def prepare_data(text, block_size):
     return text.ljust(newdatasize)
 
 
+class FieldCache(object):
+    """
+    A bounded LRU mapping of cipher texts to their clear text.
+
+    The cache belongs to a CryptoEngine and lives as long as the
+    engine's session, it is wiped when the key is forgotten or the
+    lock timeout expires. Values larger than max_item bytes are never
+    cached, and the least recently used entries are evicted once the
+    total size of the cached values exceeds max_bytes. The database
+    drivers and the web UI use the cache from several threads.
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, max_item=4096):
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_item or self.max_bytes <= 0:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._data[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+
+def _cache_key(cipher_text):
+    return _as_bytes(cipher_text)
+
+
 class CryptoEngine(object):  # pagma: no cover
     _instance = None
     _callback = None
+    _executors = {}
 
     @classmethod
     def get(cls, timeout=-1):
@@ -136,20 +291,32 @@ class CryptoEngine(object):  # pagma: no cover
         self._algo = algorithm
         self._digest = digest if digest else None
         self._salt = salt if salt else None
+        self._kdf = None
         self._timeout = timeout
         self._expires_at = -1
         self._cipher = None
         self._reader = reader
         self._callback = None
         self._getsecret = None  # This is set in callback.setter
+        self._cache = FieldCache()
+        # workers and pool control encrypt_many and decrypt_many,
+        # workers=None means use all the cores
+        self.workers = None
+        self.pool = 'thread'
+        self.chunksize = 256
+        # the KDF of new passwords, if unlock_time is set the cost of the
+        # KDF is calibrated, so unlocking takes about unlock_time seconds
+        self.kdf_name = DEFAULT
+        self.unlock_time = None
 
     def authenticate(self, password):
         """
         salt and digest are stored in a file or a database
         """
-        dig = get_digest(password, self._salt)
+        dig = get_digest(password, self._salt, self._kdf)
         if binascii.hexlify(dig) == self._digest or dig == self._digest:
-            self._cipher = get_cipher(password, self._salt)
+            # the digest is the key, there is no need to derive it again
+            self._cipher = RecordCipher(dig)
             if self._timeout > 0:
                 self._expires_at = int(time.time()) + self._timeout
             return True
@@ -170,33 +337,154 @@ class CryptoEngine(object):  # pagma: no cover
             if self.authenticate(passwd):
                 return passwd, salt
 
-            print("You entered a wrong password...")
+            self._callback.error("You entered a wrong password...")
             tries += 1
         raise CryptoException("You entered wrong password 5 times..")
 
     def encrypt(self, text):
-        if not self._is_authenticated():
-            p, s = self._auth()
-            cipher = get_cipher(p, s)
-            self._cipher = cipher
-            del(p)
-
-        return encode_AES(self._cipher, text)
+        self._ensure_cipher()
+        return encode_record(self._cipher, text)
 
     def decrypt(self, cipher_text):
+        self._ensure_cipher()
+        return decode_record(self._cipher, cipher_text)
+
+    def decrypt_cached(self, cipher_text):
+        """
+        Like decrypt, but remember the clear text for the rest of the
+        session, so decrypting the same cipher text again is free.
+        """
+        self._ensure_cipher()
+        key = _cache_key(cipher_text)
+        clear_text = self._cache.get(key)
+        if clear_text is None:
+            clear_text = decode_record(self._cipher, cipher_text)
+            self._cache.put(key, clear_text)
+        return clear_text
+
+    def encrypt_cached(self, text):
+        """
+        Encrypt text and remember the clear text of the new cipher text
+        """
+        cipher_text = self.encrypt(text)
+        if not isinstance(text, bytes):
+            text = text.encode()
+        self._cache.put(_cache_key(cipher_text), text)
+        return cipher_text
+
+    def encrypt_many(self, texts, return_exceptions=False, cache=True):
+        """
+        Encrypt an iterable of texts, the password is checked only once and
+        the work is spread across a thread or process pool. The cipher
+        texts are returned in the same order as the texts, and are added to
+        the session cache unless cache is False.
+        """
+        texts = [t if isinstance(t, bytes) else t.encode() for t in texts]
+        self._ensure_cipher()
+        results = self._map(encode_record, texts)
+        for text, cipher_text in zip(texts, results):
+            if cache and not isinstance(cipher_text, Exception):
+                self._cache.put(_cache_key(cipher_text), text)
+        return self._check_results(results, return_exceptions)
+
+    def decrypt_many(self, cipher_texts, return_exceptions=False,
+                     cache=True):
+        """
+        Decrypt an iterable of cipher texts, in the same manner as
+        encrypt_many. Clear texts already in the session cache are not
+        decrypted again, and new clear texts are added to it unless
+        cache is False.
+        """
+        keys = [_cache_key(c) for c in cipher_texts]
+        # authenticate before looking in the cache, it might have expired
+        self._ensure_cipher()
+        results = [self._cache.get(k) for k in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        decrypted = self._map(decode_record, [keys[i] for i in missing])
+        for i, clear_text in zip(missing, decrypted):
+            results[i] = clear_text
+            if cache and not isinstance(clear_text, Exception):
+                self._cache.put(keys[i], clear_text)
+        return self._check_results(results, return_exceptions)
+
+    def _ensure_cipher(self):
         if not self._is_authenticated():
+            # _auth sets the cipher when the password is correct
             p, s = self._auth()
-            cipher = get_cipher(p, s)
-            self._cipher = cipher
-            del(p)
+            del p
+
+    def _map(self, func, items):
+        if not items:
+            return []
+        cipher = self._cipher
+        chunks = [items[i:i + self.chunksize]
+                  for i in range(0, len(items), self.chunksize)]
+        workers = self.workers or os.cpu_count() or 1
+        if workers < 2 or len(chunks) < 2:
+            parts = [_map_cipher(func, cipher, c) for c in chunks]
+        else:
+            executor = self._get_executor(self.pool, workers)
+            parts = executor.map(_map_cipher, repeat(func), repeat(cipher),
+                                 chunks)
+        return [r for part in parts for r in part]
 
-        return decode_AES(self._cipher, cipher_text)
+    @classmethod
+    def _get_executor(cls, pool, workers):
+        if (pool, workers) not in cls._executors:
+            if pool == 'process':
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers)
+            elif pool == 'thread':
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers)
+            else:
+                raise CryptoException("Unknown pool type %s" % pool)
+            cls._executors[(pool, workers)] = executor
+        return cls._executors[(pool, workers)]
+
+    @staticmethod
+    def _check_results(results, return_exceptions):
+        if return_exceptions:
+            return results
+        failed = [str(i) for i, r in enumerate(results)
+                  if isinstance(r, Exception)]
+        if failed:
+            raise CryptoException("Could not process items: %s" %
+                                  ", ".join(failed))
+        return results
+
+    def blind_index(self, value, purpose='tag'):
+        """
+        Return the blind index of a clear text value, see
+        RecordCipher.blind_index
+        """
+        self._ensure_cipher()
+        return self._cipher.blind_index(purpose, value)
+
+    def unlocked_cipher(self):
+        """
+        Return the cipher if the vault is unlocked, or None.
+        Unlike encrypt and decrypt this never asks for the password, so it
+        is safe to use from background threads.
+        """
+        if self._cipher is None or int(time.time()) > self._expires_at:
+            return None
+        return self._cipher
+
+    def keep_alive(self):
+        """
+        Extend the session of an unlocked vault, so it is locked only
+        after timeout seconds without use.
+        """
+        if self.unlocked_cipher() is not None and self._timeout > 0:
+            self._expires_at = int(time.time()) + self._timeout
 
     def forget(self):
         """
-        discard cipher
+        discard cipher and all the clear texts cached with it
         """
         self._cipher = None
+        self._cache.clear()
 
     def _is_authenticated(self):
         if self._is_timedout():
@@ -210,16 +498,17 @@ class CryptoEngine(object):  # pagma: no cover
     def _is_timedout(self):
         if int(time.time()) > self._expires_at:
             self._cipher = None
+            self._cache.clear()
             return True
         return False
 
-    def changepassword(self, reader=raw_input):
-        if self._callback is None:
+    def changepassword(self, reader=raw_input, password=None):
+        if self._callback is None and password is None:
             raise CryptoException("No callback class has been specified")
 
         # if you change the password of the database you have to Change
         # all the cipher texts in the databse!!!
-        self._keycrypted = self._create_password()
+        self._keycrypted = self._create_password(password)
         self.set_cryptedkey(self._keycrypted)
         return self._keycrypted
 
@@ -238,25 +527,40 @@ class CryptoEngine(object):  # pagma: no cover
         else:
             raise Exception("callback must be an instance of Callback!")
 
-    def _create_password(self):
+    def _create_password(self, passwd=None):
         """
         Create a secret password as a hash and the salt used for this hash.
         Change reader to manipulate how input is given.
         """
         salt = base64.b64encode(os.urandom(32))
-        passwd = self._getsecret("Please type in the master password")
+        if passwd is None:
+            passwd = self._getsecret("Please type in the master password")
         if not isinstance(passwd, bytes):
             passwd = passwd.encode()
-        key = get_digest(passwd, salt)
-        hpk = salt+'$6$'.encode('utf8')+binascii.hexlify(key)
+        kdf = self._new_kdf()
+        key = get_digest(passwd, salt, kdf)
+        hpk = (join_seed(kdf, salt).encode() + '$6$'.encode('utf8') +
+               binascii.hexlify(key))
         self._digest = key
         self._salt = salt
-        self._cipher = get_cipher(passwd, salt)
+        self._kdf = kdf
+        self._cipher = RecordCipher(key)
+        # the new password unlocks the vault
+        if self._timeout > 0:
+            self._expires_at = int(time.time()) + self._timeout
         return hpk.decode('utf-8')
 
+    def _new_kdf(self):
+        if self.unlock_time:
+            return calibrate(self.kdf_name, self.unlock_time)
+        return get_kdf(self.kdf_name)
+
     def set_cryptedkey(self, key):
         # TODO: rename this method!
-        salt, digest = key.split('$6$')
+        if isinstance(key, bytes):
+            key = key.decode()
+        seed, digest = key.split('$6$')
+        self._kdf, salt = split_seed(seed)
         self._digest = digest.encode('utf-8')
         self._salt = salt.encode('utf-8')
 
@@ -265,4 +569,5 @@ class CryptoEngine(object):  # pagma: no cover
         """
         return _keycrypted
         """
-        return self._salt.decode() + u'$6$' + self._digest.decode()
+        return (join_seed(self._kdf, self._salt) + u'$6$' +
+                self._digest.decode())
@@ -0,0 +1,192 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+Key derivation functions used to turn the master password into a key.
+
+A vault stores the KDF and its parameters in front of the salt, e.g.::
+
+    scrypt:n=32768,r=8,p=1|<salt>$6$<digest>
+
+Vaults created before the KDF could be chosen store only the salt, those
+are read with PBKDF2 and 5000 iterations.
+"""
+import abc
+import math
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt as _Scrypt
+
+
+class KDFException(Exception):
+    pass
+
+
+class KDF(abc.ABC):
+    """
+    Base class for key derivation functions.
+
+    Sub classes define a name, the parameters they accept and how to
+    derive a key of 32 bytes from a password and a salt.
+    """
+    name = None
+    params = ()
+
+    def __init__(self, **kwargs):
+        for param in self.params:
+            setattr(self, param, int(kwargs.get(param,
+                                                self.defaults[param])))
+
+    @property
+    def spec(self):
+        return "{}:{}".format(self.name, ",".join(
+            "{}={}".format(p, getattr(self, p)) for p in self.params))
+
+    def __eq__(self, other):
+        return isinstance(other, KDF) and self.spec == other.spec
+
+    def __repr__(self):
+        return "<KDF {}>".format(self.spec)
+
+    @abc.abstractmethod
+    def derive(self, password, salt):
+        """return a key of 32 bytes"""
+
+    @abc.abstractmethod
+    def scaled(self, factor):
+        """return a copy of the KDF whose cost is multiplied by factor"""
+
+
+class PBKDF2(KDF):
+
+    name = 'pbkdf2'
+    params = ('i',)
+    defaults = {'i': 100000}
+    minimum = {'i': 100000}
+
+    def derive(self, password, salt):
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt,
+                         iterations=self.i, backend=default_backend())
+        return kdf.derive(password)
+
+    def scaled(self, factor):
+        return PBKDF2(i=max(int(self.i * factor), 1))
+
+
+class Scrypt(KDF):
+
+    name = 'scrypt'
+    params = ('n', 'r', 'p')
+    defaults = {'n': 2 ** 15, 'r': 8, 'p': 1}
+    minimum = {'n': 2 ** 14, 'r': 8, 'p': 1}
+    max_n = 2 ** 20
+
+    def derive(self, password, salt):
+        kdf = _Scrypt(salt=salt, length=32, n=self.n, r=self.r, p=self.p,
+                      backend=default_backend())
+        return kdf.derive(password)
+
+    def scaled(self, factor):
+        # n must be a power of 2, round down so we do not overshoot
+        n = 2 ** int(math.log(max(self.n * factor, 2), 2))
+        return Scrypt(n=min(n, self.max_n), r=self.r, p=self.p)
+
+
+KDFS = {PBKDF2.name: PBKDF2, Scrypt.name: Scrypt}
+
+# the KDF of new vaults, unless the kdf option chooses another
+DEFAULT = Scrypt.name
+
+# the KDF of vaults which store no KDF specification
+LEGACY = PBKDF2(i=5000)
+
+
+def get_kdf(name, **kwargs):
+    try:
+        return KDFS[name](**kwargs)
+    except KeyError:
+        raise KDFException("Unknown key derivation function %s" % name)
+
+
+def from_spec(spec):
+    """
+    Create a KDF from a specification like 'scrypt:n=16384,r=8,p=1'
+    """
+    name, _, params = spec.partition(':')
+    try:
+        kwargs = dict(p.split('=') for p in params.split(',') if p)
+    except ValueError:
+        raise KDFException("Could not parse KDF specification %s" % spec)
+    return get_kdf(name, **kwargs)
+
+
+def split_seed(seed):
+    """
+    Split a seed as stored in the database into a KDF and the salt
+    """
+    is_bytes = isinstance(seed, bytes)
+    if is_bytes:
+        seed = seed.decode()
+    if '|' in seed:
+        spec, salt = seed.split('|', 1)
+        kdf = from_spec(spec)
+    else:
+        kdf, salt = LEGACY, seed
+    return kdf, salt.encode() if is_bytes else salt
+
+
+def join_seed(kdf, salt):
+    """
+    The inverse of split_seed, legacy vaults keep their format
+    """
+    if isinstance(salt, bytes):
+        salt = salt.decode()
+    if kdf is None or kdf == LEGACY:
+        return salt
+    return kdf.spec + '|' + salt
+
+
+def calibrate(name='scrypt', target=0.5, timer=time.perf_counter):
+    """
+    Find the cost of the KDF name, for which deriving a key takes about
+    target seconds on this machine. The cost is never lower than the
+    minimum of the KDF.
+    """
+    kdf = get_kdf(name, **KDFS[name].minimum)
+    floor = kdf
+    while True:
+        start = timer()
+        kdf.derive(b'calibrate', b'pwman3-calibrate')
+        elapsed = max(timer() - start, 1e-6)
+        # measure again with a higher cost if the measurement is too short
+        # to extrapolate from.
+        if elapsed > target / 4:
+            break
+        bigger = kdf.scaled(2)
+        if bigger == kdf:  # the KDF reached its maximal cost
+            return kdf
+        kdf = bigger
+
+    kdf = kdf.scaled(target / elapsed)
+    for param in kdf.params:
+        if getattr(kdf, param) < getattr(floor, param):
+            return floor
+    return kdf
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+Compare the PRAGMAs pwman3 sets on SQLite databases with the defaults of
+SQLite, e.g.::
+
+    python scripts/bench_sqlite.py -n 2000
+
+Each profile writes n nodes with one transaction per node, as adding and
+editing nodes does, reads them back, and then writes while another
+connection keeps reading, as the web UI and the CLI do when they share
+a database. The records are random bytes, nothing is encrypted.
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from pwman.data.drivers.sqlite import SQLite
+
+# the PRAGMAs of a connection which sets none
+SQLITE_DEFAULTS = (('busy_timeout', '0'),
+                   ('journal_mode', 'delete'),
+                   ('synchronous', 'full'),
+                   ('mmap_size', '0'),
+                   ('cache_size', '-2000'),
+                   ('temp_store', 'default'))
+
+PROFILES = (('sqlite defaults', SQLITE_DEFAULTS),
+            ('pwman3 defaults', SQLite.default_pragmas))
+
+
+def open_db(path, pragmas):
+    db = SQLite(path)
+    db.configure(dict(pragmas))
+    db._open()
+    return db
+
+
+def record():
+    return os.urandom(96)
+
+
+def bench_writes(db, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        db._cur.execute(db._add_node_sql,
+                        [record() for _ in range(4)] + [None])
+        db._con.commit()
+    return count / (time.perf_counter() - start)
+
+
+def bench_reads(db, rounds=5):
+    ids = db.listnodes()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for i in range(0, len(ids), 100):
+            db.getnodes(ids[i:i + 100])
+    return rounds * len(ids) / (time.perf_counter() - start)
+
+
+def bench_shared(path, pragmas, count):
+    """
+    Write count nodes while a second connection reads, return the
+    writes per second and the number of reads and writes which failed
+    because the database was locked.
+    """
+    writer = open_db(path, pragmas)
+    reader = open_db(path, pragmas)
+    done = threading.Event()
+    locked = [0]
+
+    def read():
+        while not done.is_set():
+            try:
+                reader._cur.execute("BEGIN")
+                reader._cur.execute("SELECT * FROM NODE")
+                reader._cur.fetchall()
+                time.sleep(0.005)
+                reader._con.commit()
+            except sqlite3.OperationalError:
+                reader._con.rollback()
+                locked[0] += 1
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    written = 0
+    start = time.perf_counter()
+    try:
+        for _ in range(count):
+            try:
+                writer._cur.execute(writer._add_node_sql,
+                                    [record() for _ in range(4)] + [None])
+                writer._con.commit()
+                written += 1
+            except sqlite3.OperationalError:
+                writer._con.rollback()
+                locked[0] += 1
+    finally:
+        elapsed = time.perf_counter() - start
+        done.set()
+        thread.join()
+        writer._con.close()
+        reader._con.close()
+    return written / elapsed, locked[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', type=int, default=2000,
+                        help='number of nodes to write')
+    parser.add_argument('-d', '--directory', default=None,
+                        help='directory of the databases, e.g. on the disk '
+                        'of your vault, by default a temporary directory')
+    args = parser.parse_args()
+
+    print("{:<16} {:>12} {:>12} {:>14} {:>8}".format(
+        "profile", "writes/s", "reads/s", "shared writes/s", "locked"))
+    for name, pragmas in PROFILES:
+        with tempfile.TemporaryDirectory(dir=args.directory) as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            db = open_db(path, pragmas)
+            writes = bench_writes(db, args.n)
+            reads = bench_reads(db)
+            db._con.close()
+            shared, locked = bench_shared(path, pragmas, args.n // 4)
+        print("{:<16} {:>12.0f} {:>12.0f} {:>14.0f} {:>8}".format(
+            name, writes, reads, shared, locked))
+
+
+if __name__ == '__main__':
+    main()
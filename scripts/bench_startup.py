@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+"""
+Measure how long importing pwman3 takes, and which modules are slowest
+to import, e.g.::
+
+    python scripts/bench_startup.py -n 20
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+def import_time(module):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'import ' + module])
+    return time.perf_counter() - start
+
+
+def slowest_imports(module, count):
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                          'import ' + module],
+                         stderr=subprocess.PIPE, check=True).stderr
+    rows = []
+    for line in out.decode().splitlines()[1:]:
+        _, self_us, total_us, name = [f.strip() for f in
+                                      line.replace(':', '|', 1).split('|')]
+        rows.append((int(total_us), name))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', type=int, default=10,
+                        help='number of runs')
+    parser.add_argument('-m', '--module', default='pwman.ui.cli')
+    args = parser.parse_args()
+
+    times = [import_time(args.module) for _ in range(args.n)]
+    print("import {}: median {:.1f} ms, min {:.1f} ms ({} runs)".format(
+        args.module, statistics.median(times) * 1000, min(times) * 1000,
+        args.n))
+    print("slowest imports (cumulative):")
+    for total_us, name in slowest_imports(args.module, 15):
+        print("{:>10.1f} ms  {}".format(total_us / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
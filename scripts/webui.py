@@ -36,6 +36,8 @@ statics = [resource_filename('pwman', 'ui/templates/static')][0]
 AUTHENTICATED = False
 TAGS = None
 DB = None
+# the number of nodes on a page of the index
+PAGE_SIZE = 50
 
 # BUG: Error: SQLite: Incorrect number of bindings supplied.
 # The current statement uses 2, and there are 1 supplied.
@@ -62,7 +64,6 @@ def require_auth(fn):
 @require_auth
 def view_node(no):
     global DB
-    node = DB.getnodes([no])
     node = DB.getnodes([no])[0]
     node = Node.from_encrypted_entries(node[1],
                                        node[2],
@@ -169,21 +170,26 @@ def listnodes(apply=['require_login']):
         if _filter == 'None':
             DB._filtertags = []
 
-    nodeids = DB.listnodes()
-    raw_nodes = DB.getnodes(nodeids)
-    _nodes_inst = []
-    for node in raw_nodes:
-        _nodes_inst.append(Node.from_encrypted_entries(
-            node[1],
-            node[2],
-            node[3],
-            node[4],
-            node[5:]))
-        _nodes_inst[-1]._id = node[0]
-    nodesd = _nodes_inst
+    # a page is found by the id of the last node of the previous one
+    after = request.query.get('after')
+    after = int(after) if after and after.isdigit() else None
+    nodeids = DB.listnodes(limit=PAGE_SIZE + 1, after_id=after)
+    next_after = nodeids[PAGE_SIZE - 1] if len(nodeids) > PAGE_SIZE else None
+
+    def iternodes():
+        # the nodes are read while the page is rendered
+        for node in DB.iternodes(nodeids[:PAGE_SIZE]):
+            node_inst = Node.from_encrypted_entries(node[1], node[2],
+                                                    node[3], node[4],
+                                                    node[5:])
+            node_inst._id = node[0]
+            yield node_inst
+
+    nodesd = iternodes()
     ce = CryptoEngine.get()
     tags = [ce.decrypt(t).decode() for t in DB.listtags()]
     html_nodes = template("index.tpl", nodes=nodesd, tags=tags, request=request,
+                          next_after=next_after,
                           template_lookup=[resource_filename('pwman',
                                                              'ui/templates')])
     return html_nodes
@@ -206,6 +212,7 @@ class Pwman3WebDaemon(object):
         args = parser_options().parse_args()
         xselpath, dburi, configp = get_conf_options(args, OSX)
         DB = pwman.data.factory.createdb(dburi, None)
+        DB.configure(dict(configp.parser.items('Database')))
         DB.open()
         print(dburi)
         print(dir(DB))
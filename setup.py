@@ -341,6 +341,7 @@ setup(name='pwman3',
       include_package_data=True,
       zip_safe=False,
       install_requires=install_requires,
+      python_requires='>=3.5',
       keywords="password-manager crypto cli",
       classifiers=['Environment :: Console',
                    'Intended Audience :: End Users/Desktop',
@@ -351,16 +352,15 @@ setup(name='pwman3',
                    'Operating System :: OS Independent',
                    'Programming Language :: Python',
                    'Programming Language :: Python :: 3',
-                   'Programming Language :: Python :: 3.2',
-                   'Programming Language :: Python :: 3.3',
-                   'Programming Language :: Python :: 3.4',
                    'Programming Language :: Python :: 3.5',
+                   'Programming Language :: Python :: 3.6',
                    ],
       cmdclass={
           'build_manpage': BuildManPage,
           'test': TestCommand
       },
       entry_points={
-          'console_scripts': ['pwman3 = pwman.ui.cli:main']
+          'console_scripts': ['pwman3 = pwman.ui.cli:main',
+                              'pwman3-agent = pwman.ui.agent:main']
           }
       )
@@ -0,0 +1,142 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import json
+import os
+import stat
+import threading
+import time
+import unittest
+from io import StringIO
+from unittest import mock
+
+from pwman import parser_options
+from pwman.data.drivers.sqlite import SQLite
+from pwman.ui.agent import Agent, AgentClient, AgentException
+from pwman.ui.oneshot import AgentCommands, find_agent
+from pwman.util.crypto_engine import CryptoEngine
+from .test_crypto_engine import DummyCallback
+
+agentdb = os.path.join(os.path.dirname(__file__), 'agent.db')
+agentsock = os.path.join(os.path.dirname(__file__), 'agent.sock')
+
+
+class TestAgent(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ce = CryptoEngine.get()
+        ce.callback = DummyCallback()
+        cls._timeout = ce._timeout
+        ce._timeout = 600
+
+        def serve():
+            db = SQLite(agentdb)
+            db.open()
+            try:
+                Agent(db, agentsock).serve(poll_interval=0.1)
+            finally:
+                db.close()
+
+        cls.thread = threading.Thread(target=serve)
+        cls.thread.start()
+        while not os.path.exists(agentsock):
+            time.sleep(0.05)
+        cls.client = AgentClient(agentsock)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.request('stop')
+        cls.thread.join()
+        ce = CryptoEngine.get()
+        ce._timeout = cls._timeout
+        ce._expires_at = -1
+        os.remove(agentdb)
+
+    def test_1_socket_permission(self):
+        mode = stat.S_IMODE(os.stat(agentsock).st_mode)
+        self.assertEqual(mode, 0o600)
+
+    def test_2_unlock(self):
+        self.client.request('lock')
+        self.assertTrue(self.client.request('ping')['locked'])
+        self.assertRaises(AgentException, self.client.request, 'list')
+        self.assertRaises(AgentException, self.client.request, 'unlock',
+                          password='wrong')
+        self.client.request('unlock', password='12345')
+        self.assertFalse(self.client.request('ping')['locked'])
+
+    def test_3_add_get(self):
+        rv = self.client.request('add', username='alice', password='secret',
+                                 url='https://example.com/login',
+                                 notes='notes', tags=['foo', 'bar'])
+        node = self.client.request('get', id=rv['id'])['node']
+        self.assertEqual(node['username'], 'alice')
+        self.assertEqual(node['password'], 'secret')
+        self.assertEqual(sorted(node['tags']), ['bar', 'foo'])
+
+    def test_4_list_lookup(self):
+        nodes = self.client.request('list', tag='foo')['nodes']
+        self.assertEqual([n['username'] for n in nodes], ['alice'])
+        self.assertNotIn('password', nodes[0])
+        nodes = self.client.request('lookup', url='mail.example.com')['nodes']
+        self.assertEqual([n['username'] for n in nodes], ['alice'])
+        self.assertEqual(self.client.request('list', tag='baz')['nodes'], [])
+
+    def test_5_edit(self):
+        nid = self.client.request('list')['nodes'][0]['id']
+        self.client.request('edit', id=nid, password='newsecret')
+        node = self.client.request('get', id=nid)['node']
+        self.assertEqual(node['password'], 'newsecret')
+        self.assertEqual(node['username'], 'alice')
+
+    def test_6_errors(self):
+        self.assertRaisesRegex(AgentException, 'Unknown command',
+                               self.client.request, 'foo')
+        self.assertRaisesRegex(AgentException, 'No node',
+                               self.client.request, 'get', id=1000)
+
+    def test_7_oneshot_commands(self):
+        config = mock.Mock()
+        config.get_value.return_value = agentsock
+        agent = find_agent(config)
+        self.assertIsNotNone(agent)
+
+        def run(*argv, **kwargs):
+            args = parser_options().parse_args(argv)
+            out = StringIO()
+            commands = AgentCommands(agent, stdout=out, stdin=StringIO(
+                kwargs.get('stdin', '')))
+            self.assertEqual(commands.run(args), kwargs.get('status', 0))
+            return json.loads(out.getvalue()) if out.getvalue() else None
+
+        nid = run('add', '--username', 'bob', stdin='hunter2\n')[0]['id']
+        self.assertEqual([n['password'] for n in run('get', '1-%d' % nid)],
+                         ['newsecret', 'hunter2'])
+        self.assertEqual([n['username'] for n in run('ls', '--limit', '1',
+                                                     '--page', '2')],
+                         ['bob'])
+        self.assertIsNone(run('get', '1000', status=1))
+        # a locked agent is not used
+        self.client.request('lock')
+        self.assertIsNone(find_agent(config))
+        self.client.request('unlock', password='12345')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
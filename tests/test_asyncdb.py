@@ -0,0 +1,107 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import asyncio
+import os
+import threading
+import unittest
+
+from pwman.data.asyncdb import AsyncDatabase
+from pwman.data.drivers.sqlite import SQLite
+from pwman.util.crypto_engine import CryptoEngine
+from .test_crypto_engine import DummyCallback
+from .test_pool import PooledSQLite
+
+asyncdb = os.path.join(os.path.dirname(__file__), 'async.db')
+
+
+class TestAsyncDatabase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        CryptoEngine.get().callback = DummyCallback()
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(asyncdb + suffix):
+                os.remove(asyncdb + suffix)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_1_operations(self):
+        db = SQLite(asyncdb)
+        db.open()
+        adb = AsyncDatabase(db)
+        ce = CryptoEngine.get()
+
+        async def work():
+            ids = await asyncio.gather(*[
+                adb.new_node(username='user%d' % i, password='secret',
+                             url='example.com', notes='', tags=['async'])
+                for i in range(10)])
+            self.assertEqual(sorted(ids), list(range(1, 11)))
+            tag, = await adb.encrypt_many(['async'])
+            self.assertEqual(await adb.listnodes(tag, limit=3), [1, 2, 3])
+            self.assertEqual(sorted(await adb.lookup('www.example.com')),
+                             sorted(ids))
+            nodes = await adb.getnodes(ids[:2])
+            users = await adb.decrypt_many(n[1] for n in nodes)
+            self.assertEqual(sorted(users), [b'user0', b'user1'])
+            await adb.editnode(1, user=ce.encrypt('alice'))
+            node, = await adb.getnodes([1])
+            self.assertEqual(ce.decrypt(node[1]), b'alice')
+            self.assertEqual(await adb.removenodes(ranges=[(2, 10)]),
+                             list(range(2, 11)))
+            self.assertEqual(len(await adb.listtags()), 1)
+            await adb.close()
+
+        self.run_async(work())
+
+    def test_2_concurrent(self):
+        db = PooledSQLite(asyncdb)
+        db.configure({'pool_max': '3'})
+        db.open()
+        adb = AsyncDatabase(db)
+        self.assertEqual(adb._executor._max_workers, 3)
+        # three operations wait for each other, so they run in parallel
+        barrier = threading.Barrier(3)
+
+        def listnodes(*args, **kwargs):
+            barrier.wait(5)
+            return []
+
+        db.listnodes = listnodes
+
+        async def work():
+            results = await asyncio.gather(*[adb.listnodes()
+                                             for _ in range(3)])
+            self.assertEqual(results, [[], [], []])
+            await adb.close()
+
+        self.run_async(work())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -44,7 +44,8 @@ class TestBaseUI(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        for item in (testdb, 'foo.csv', 'pwman-export.csv'):
+        for item in (testdb, testdb + '-wal', testdb + '-shm', 'foo.csv',
+                     'pwman-export.csv'):
             try:
                 os.unlink(item)
             except OSError:
@@ -96,6 +97,40 @@ class TestBaseUI(unittest.TestCase):
         sys.stdout = sys.__stdout__
         self.output.getvalue()
 
+    def test_2b_do_list_pages(self):
+        db = self.tester.cli._db
+        nid = db.add_node(Node(clear_text=True, username='bob',
+                               password='secret', url='', notes='',
+                               tags=['paged']))
+        v = StringIO()
+        sys.stdout = v
+        self.tester.cli.do_list('--limit 1')
+        first = v.getvalue()
+        self.tester.cli.do_next('')
+        second = v.getvalue()[len(first):]
+        self.tester.cli.do_next('')
+        self.tester.cli.do_list('--page 2 --limit 1')
+        third = v.getvalue()[len(first) + len(second):]
+        self.tester.cli.do_list('--limit')
+        sys.stdout = sys.__stdout__
+        db.removenodes([nid])
+        self.assertIn('alice', first)
+        self.assertIn('Type next', first)
+        self.assertIn('bob', second)
+        self.assertNotIn('Type next', second)
+        self.assertIn('No more nodes', third)
+        self.assertIn('bob', third)
+        self.assertIn('Usage', v.getvalue())
+
+    def test_2a_do_lookup(self):
+        v = StringIO()
+        sys.stdout = v
+        self.tester.cli.do_lookup('https://www.example.com/login')
+        self.tester.cli.do_lookup('example.org')
+        sys.stdout = sys.__stdout__
+        self.assertIn('alice', v.getvalue())
+        self.assertIn('No nodes found for example.org', v.getvalue())
+
     def test_3_do_export(self):
         self.tester.cli.do_export("{'filename':'foo.csv'}")
         with open('foo.csv') as f:
@@ -177,6 +212,32 @@ class TestBaseUI(unittest.TestCase):
         self.assertNotIn('alice', sys.stdout.getvalue())
         sys.stdout = sys.__stdout__
 
+    def test_9a_do_delete_tag(self):
+        db = self.tester.cli._db
+        added = db.add_nodes(Node(clear_text=True, username='svc%d' % i,
+                                  password='x', url='', notes='',
+                                  tags=['expired']) for i in range(3))
+        ids, ranges, tags = self.tester.cli._get_selection('2 4-6 expired')
+        self.assertEqual((ids, ranges, len(tags)), ([2], [(4, 6)], 1))
+        # a mistyped id is no tag, nothing is selected
+        sys.stdout = StringIO()
+        self.assertEqual(self.tester.cli._get_selection('2 1O'),
+                         ([], [], []))
+        self.assertIn('1O', sys.stdout.getvalue())
+        # neither is anything selected along with a backwards range
+        self.assertEqual(self.tester.cli._get_selection('3 9-5'),
+                         ([], [], []))
+        self.assertIn('9-5', sys.stdout.getvalue())
+        sys.stdout = sys.__stdout__
+        ids, ranges, tags = self.tester.cli._get_selection('tag:unused')
+        self.assertEqual(len(tags), 1)
+        sys.stdin = StringIO("y\n")
+        self.tester.cli.do_rm('expired')
+        sys.stdin = sys.__stdin__
+        ce = CryptoEngine.get()
+        self.assertEqual(db.listnodes(ce.encrypt('expired')), [])
+        self.assertFalse(set(added) & set(db.listnodes()))
+
     def test_10_do_info(self):
         self.output = StringIO()
         sys.stdout = self.output
@@ -39,8 +39,9 @@ class Ferrum(unittest.TestCase):
             os.remove('test-chg_passwd.log')
         #os.remove(backup)
         db = os.path.join(os.path.dirname(__file__), 'foo.baz.db')
-        if os.path.exists(db):
-            os.remove(db)
+        for item in (db, db + '-wal', db + '-shm'):
+            if os.path.exists(item):
+                os.remove(item)
 
     @unittest.skip("obsolete")
     def test_b_run_convert(self):
@@ -20,9 +20,12 @@ import unittest
 import os
 import time
 import string
+import threading
+from unittest import mock
 from pwman.util.callback import Callback
 from pwman.util.crypto_engine import (CryptoEngine, CryptoException,
-                                      generate_password)
+                                      FieldCache, generate_password,
+                                      encode_AES, is_record_v2)
 
 # set cls_timout to negative number (e.g. -1) to disable
 default_config = {'Global': {'umask': '0100', 'colors': 'yes',
@@ -140,5 +143,95 @@ class CryptoEngineTest(unittest.TestCase):
         decrypt = ce.decrypt(secret)
         self.assertEqual(decrypt.decode(), "topsecret")
 
+    def test_h_decrypt_cached(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        secret = ce.encrypt_cached(b"topsecret")
+        ce._expires_at = int(time.time()) + 600
+        self.assertEqual(ce.decrypt_cached(secret), b"topsecret")
+        self.assertEqual(len(ce._cache), 1)
+        ce._expires_at = time.time() - 2
+        self.assertTrue(ce._is_timedout())
+        self.assertEqual(len(ce._cache), 0)
+
+    def test_i_encrypt_decrypt_many(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        ce.chunksize = 2
+        texts = [str(i).encode() for i in range(7)]
+        for pool in ('thread', 'process'):
+            ce.pool, ce.workers = pool, 2
+            # not cached, so the workers of the pool decrypt them
+            secrets = ce.encrypt_many(texts, cache=False)
+            executor = ce._get_executor(pool, 2)
+            with mock.patch.object(executor, 'map',
+                                   wraps=executor.map) as pool_map:
+                self.assertEqual(ce.decrypt_many(secrets), texts)
+            self.assertEqual(pool_map.call_count, 1)
+        ce.pool, ce.workers, ce.chunksize = 'thread', None, 256
+
+    def test_j_decrypt_many_errors(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        secrets = ce.encrypt_many([b'foo', b'bar'])
+        secrets.insert(1, b'notatoken')
+        self.assertRaises(CryptoException, ce.decrypt_many, secrets)
+        rv = ce.decrypt_many(secrets, return_exceptions=True)
+        self.assertEqual(rv[0], b'foo')
+        self.assertIsInstance(rv[1], CryptoException)
+        self.assertEqual(rv[2], b'bar')
+
+    def test_k_record_format(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        record = ce.encrypt(b"topsecret ")
+        self.assertTrue(is_record_v2(record))
+        # version byte, nonce and tag
+        self.assertEqual(len(record), len(b"topsecret ") + 29)
+        self.assertEqual(ce.decrypt(record), b"topsecret ")
+        # records in the older format are still readable
+        legacy = encode_AES(ce._cipher.fernet, b"topsecret")
+        self.assertFalse(is_record_v2(legacy))
+        self.assertEqual(ce.decrypt(legacy), b"topsecret")
+        self.assertEqual(ce.decrypt(legacy.decode()), b"topsecret")
+
+
+class TestFieldCache(unittest.TestCase):
+
+    def test_evict_lru(self):
+        cache = FieldCache(max_bytes=8, max_item=4)
+        cache.put(b'a', b'1234')
+        cache.put(b'b', b'5678')
+        self.assertEqual(cache.get(b'a'), b'1234')
+        cache.put(b'c', b'90')
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), b'1234')
+        self.assertEqual(cache.get(b'c'), b'90')
+
+    def test_max_item(self):
+        cache = FieldCache(max_bytes=8, max_item=4)
+        cache.put(b'a', b'12345')
+        self.assertIsNone(cache.get(b'a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_threads(self):
+        cache = FieldCache(max_bytes=64, max_item=4)
+
+        def work(n):
+            for i in range(2000):
+                key = b'%d' % ((n + i) % 50)
+                cache.put(key, b'1234')
+                cache.get(key)
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache._size, 4 * len(cache))
+        self.assertLessEqual(cache._size, cache.max_bytes)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2, failfast=True)
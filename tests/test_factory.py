@@ -49,7 +49,7 @@ class TestFactory(unittest.TestCase):
         self.tester.create()
 
     def test_factory_check_db_ver(self):
-        self.assertEqual(factory.check_db_version('sqlite://'+testdb), u"'0.6'")
+        self.assertEqual(factory.check_db_version('sqlite://'+testdb), u"'0.7'")
 
     @unittest.skip("not supported at the moment")
     def test_factory_check_db_file(self):
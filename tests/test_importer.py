@@ -21,9 +21,10 @@ import unittest
 import sys
 
 from collections import namedtuple
+from io import StringIO
 import pwman.data.factory
 from pwman.util.crypto_engine import CryptoEngine
-from pwman.exchange.importer import CSVImporter, Importer
+from pwman.exchange.importer import CSVImporter, Importer, ImporterException
 from pwman.data.drivers.sqlite import SQLite
 from .test_crypto_engine import give_key, DummyCallback
 
@@ -33,6 +34,15 @@ alice;wonderland.com;secert;scratch;foo,bar
 hatman;behindthemirror.com;pa33w0rd;scratch;foo,bar
 """
 
+import_rejects = """Username;URL;Password;Notes;Tags
+alice;wonderland.com;secert;scratch;foo,bar
+hatman;behindthemirror.com;pa33w0rd
+queen;castle.com;off;with;
+king;castle.com;heads;scratch;foo
+
+knave;castle.com;tarts;scratch;
+"""
+
 
 class TestImporter(unittest.TestCase):
 
@@ -45,11 +55,13 @@ class TestImporter(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         for item in ('import_file.csv', 'test-importer.db',
-                     'testfile.conf', 'importdummy.db'):
-            try:
-                os.unlink(item)
-            except OSError:
-                continue
+                     'testfile.conf', 'importdummy.db', 'import_rejects.csv',
+                     'import_rejects.csv.rejects', 'rejects.db'):
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.unlink(item + suffix)
+                except OSError:
+                    continue
 
     def setUp(self):
         config = {}
@@ -59,25 +71,32 @@ class TestImporter(unittest.TestCase):
         self.importer = CSVImporter(args,
                                     config, db)
 
-    def test_1_read_file(self):
-        lines = self.importer._read_file()
-        self.assertNotIn(["Username", "URL", "Password", "Notes", " Tags"],
-                         lines)
+    def test_1_iter_rows(self):
+        lines = list(self.importer._iter_rows())
+        # the header and the empty first line are skipped
+        self.assertEqual([line for line, _ in lines], [3, 4])
+        self.assertNotIn(["Username", "URL", "Password", "Notes", "Tags"],
+                         [row for _, row in lines])
+        self.assertEqual([line for line, _ in self.importer._iter_rows(3)],
+                         [4])
 
-    def test_2_create_node(self):
+    def test_2_create_nodes(self):
         # create a node , should be encrypted, but not yet inserted to db
         n = "alice;wonderland.com;secert;scratch;foo,bar".split(";")
-        node = self.importer._create_node(n)
+        node, = self.importer._create_nodes([n])
         ce = CryptoEngine.get()
         self.assertEqual(ce.decrypt(node._username).decode(), u'alice')
         self.assertEqual([b'foo', b'bar'], [t for t in node.tags])
 
-    def test_3_insert_node(self):
+    def test_3_insert_nodes(self):
         self.importer._open_db()
+        before = len(self.importer._db.listnodes())
         n = "alice;wonderland.com;secert;scratch;foo,bar".split(";")
-        node = self.importer._create_node(n)
-        # do the actual insert of the node to the databse
-        self.importer._insert_node(node)
+        nodes = self.importer._create_nodes([n, n])
+        # do the actual insert of the nodes to the databse
+        self.importer._insert_nodes(nodes)
+        self.assertEqual(len(self.importer._db.listnodes()), before + 2)
+        self.importer._db.close()
 
     def test_4_runner(self):
         # test the whole procees:
@@ -106,6 +125,64 @@ class TestImporter(unittest.TestCase):
         importer = Importer((args, '', db))
         importer.importer.run(callback=DummyCallback)
 
+    def test_5_check_bad_row(self):
+        self.assertRaises(ImporterException, self.importer._check_row,
+                          ['alice', 'wonderland.com'])
+
+    def _rejects_importer(self):
+        # each test starts without the files of the others
+        for item in ('import_rejects.csv.rejects',
+                     'import_rejects.csv.checkpoint', 'rejects.db'):
+            if os.path.exists(item):
+                os.unlink(item)
+        with open('import_rejects.csv', 'w') as f:
+            f.write(import_rejects)
+        Args = namedtuple('Args', 'file_delim')
+        args = Args(file_delim=['import_rejects.csv', ';'])
+        importer = CSVImporter(args, {}, SQLite('rejects.db'), out=StringIO())
+        importer.batch_size = 2
+        return importer
+
+    def test_6_rejects(self):
+        importer = self._rejects_importer()
+        importer.run(callback=DummyCallback)
+        self.assertEqual((importer.imported, importer.rejected), (4, 1))
+        with open('import_rejects.csv.rejects') as f:
+            self.assertTrue(f.read().startswith('3;Expected 5 columns'))
+        self.assertFalse(os.path.exists('import_rejects.csv.checkpoint'))
+        self.assertIn('Imported 4 rows, rejected 1', importer.out.getvalue())
+        db = SQLite('rejects.db')
+        db.open()
+        ce = CryptoEngine.get()
+        nodes = db.getnodes(db.listnodes())
+        self.assertEqual([ce.decrypt(n[1]) for n in nodes],
+                         [b'alice', b'queen', b'king', b'knave'])
+        self.assertEqual([len(n[5:]) for n in nodes], [2, 0, 1, 0])
+        db.close()
+        os.unlink('rejects.db')
+
+    def test_7_resume(self):
+        importer = self._rejects_importer()
+        # an earlier import rejected the row of hatman and stopped after
+        # the row of queen
+        with open('import_rejects.csv.rejects', 'w') as f:
+            f.write('3;Expected 5 columns;hatman;behindthemirror.com;'
+                    'pa33w0rd\n')
+        with open('import_rejects.csv.checkpoint', 'w') as f:
+            f.write('4')
+        importer.run(callback=DummyCallback)
+        self.assertEqual((importer.imported, importer.rejected), (2, 0))
+        self.assertFalse(os.path.exists('import_rejects.csv.checkpoint'))
+        # the rows rejected before the checkpoint are kept
+        with open('import_rejects.csv.rejects') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        db = SQLite('rejects.db')
+        db.open()
+        ce = CryptoEngine.get()
+        self.assertEqual([ce.decrypt(n[1]) for n in
+                          db.getnodes(db.listnodes())], [b'king', b'knave'])
+        db.close()
+
 
 if __name__ == '__main__':
 
@@ -18,15 +18,19 @@
 # ============================================================================
 import os
 import os.path
+import subprocess
+import threading
 import unittest
 import sys
+from unittest import mock
 
 from collections import namedtuple
 
 from pwman import set_xsel
 from pwman.data import factory
 from pwman.data.database import __DB_FORMAT__
-from pwman import (get_conf, get_conf_options, get_db_version)
+from pwman import (get_conf, get_conf_options, get_db_version,
+                   check_version, metadata)
 from .test_tools import SetupTester
 
 dummyfile = """
@@ -62,7 +66,7 @@ class TestInit(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        for item in ('dummy.cfg', testdb):
+        for item in ('dummy.cfg', testdb, testdb + '-wal', testdb + '-shm'):
             try:
                 os.unlink(item)
             except (OSError, PermissionError):
@@ -85,9 +89,9 @@ class TestInit(unittest.TestCase):
 
     def test_get_db_version(self):
         v = get_db_version(self.tester.configp, 'sqlite')
-        self.assertEqual(v, u"'0.6'")
+        self.assertEqual(v, u"'0.7'")
         v = get_db_version(self.tester.configp, 'sqlite')
-        self.assertEqual(v, u"'0.6'")
+        self.assertEqual(v, u"'0.7'")
 
     def test_set_xsel(self):
         Args = namedtuple('args', 'cfile, dbase, algo')
@@ -107,6 +111,64 @@ class TestInit(unittest.TestCase):
         xsel, dburi, configp = get_conf_options(args, 'True')
         self.assertEqual(dburi, 'dummy.db')
 
+    def test_lazy_imports(self):
+        # starting pwman3 with a SQLite database must not import the other
+        # drivers, pkg_resources or the HTTP client
+        code = ("import sys\n"
+                "import pwman.ui.cli\n"
+                "from pwman.data import factory\n"
+                "factory.createdb('sqlite:///:memory:', None)\n"
+                "print(' '.join(m for m in ('psycopg2', 'pymysql', 'pymongo',"
+                " 'pkg_resources', 'urllib.request') if m in sys.modules))")
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.decode().strip(), '')
+        # the package itself imports neither the databases nor the crypto
+        code = ("import sys\n"
+                "import pwman\n"
+                "print(' '.join(m for m in ('pwman.data.database', "
+                "'pwman.util.crypto_engine', 'cryptography') "
+                "if m in sys.modules))")
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.decode().strip(), '')
+
+    def test_metadata(self):
+        meta = metadata()
+        self.assertTrue(meta['version'])
+        self.assertTrue(meta['website'])
+
+    def test_check_version(self):
+        configp = self.tester.configp
+        configp.set_value('Updater', 'client_info', 'foo')
+        configp.set_value('Updater', 'check_interval', '3600')
+        saved = threading.Event()
+
+        def save():
+            if configp.get_value('Updater', 'is_latest'):
+                saved.set()
+
+        with mock.patch('pwman.is_latest_version',
+                        return_value=(None, False)) as is_latest, \
+                mock.patch.object(configp, 'save',
+                                  side_effect=save) as save_conf:
+            # nothing is known yet, the check runs in the background and
+            # saves its result
+            self.assertTrue(check_version(configp, '0.1'))
+            # the attempt is saved before the check, a one-shot run may
+            # end before it
+            self.assertTrue(save_conf.called)
+            self.assertTrue(configp.get_value('Updater', 'last_check'))
+            self.assertEqual(configp.get_value('Updater', 'checked_version'),
+                             '0.1')
+            self.assertTrue(saved.wait(5))
+            self.assertEqual(is_latest.call_count, 1)
+            # the result is cached, there is no need to check again
+            self.assertFalse(check_version(configp, '0.1'))
+            self.assertEqual(is_latest.call_count, 1)
+            # a cached result of another version is not used
+            saved.clear()
+            self.assertTrue(check_version(configp, '0.2'))
+            self.assertTrue(saved.wait(5))
+
 
 if __name__ == '__main__':
 
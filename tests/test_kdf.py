@@ -0,0 +1,72 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import unittest
+
+from pwman.util import kdf
+from pwman.util.crypto_engine import CryptoEngine
+from .test_crypto_engine import DummyCallback
+
+
+class TestKDF(unittest.TestCase):
+
+    def test_spec(self):
+        scrypt = kdf.from_spec('scrypt:n=16384,r=8,p=1')
+        self.assertEqual(scrypt, kdf.Scrypt(n=16384))
+        self.assertEqual(kdf.from_spec(scrypt.spec), scrypt)
+        self.assertEqual(kdf.from_spec('pbkdf2:i=5000'), kdf.LEGACY)
+        self.assertRaises(kdf.KDFException, kdf.from_spec, 'bcrypt:c=12')
+        self.assertRaises(kdf.KDFException, kdf.from_spec, 'scrypt:n')
+
+    def test_seed(self):
+        self.assertEqual(kdf.split_seed(b'c2FsdA=='),
+                         (kdf.LEGACY, b'c2FsdA=='))
+        self.assertEqual(kdf.join_seed(kdf.LEGACY, b'c2FsdA=='), 'c2FsdA==')
+        seed = kdf.join_seed(kdf.Scrypt(), 'c2FsdA==')
+        self.assertEqual(seed, 'scrypt:n=32768,r=8,p=1|c2FsdA==')
+        self.assertEqual(kdf.split_seed(seed), (kdf.Scrypt(), 'c2FsdA=='))
+
+    def test_scaled(self):
+        self.assertEqual(kdf.Scrypt(n=2 ** 14).scaled(3).n, 2 ** 15)
+        self.assertEqual(kdf.Scrypt(n=2 ** 20).scaled(2).n, 2 ** 20)
+        self.assertEqual(kdf.PBKDF2(i=1000).scaled(2.5).i, 2500)
+
+    def test_calibrate(self):
+        pbkdf2 = kdf.calibrate('pbkdf2', target=0.05)
+        self.assertGreaterEqual(pbkdf2.i, kdf.PBKDF2.minimum['i'])
+        scrypt = kdf.calibrate('scrypt', target=0.001)
+        self.assertEqual(scrypt, kdf.Scrypt(**kdf.Scrypt.minimum))
+
+    def test_engine_roundtrip(self):
+        ce = CryptoEngine(timeout=600)
+        ce.callback = DummyCallback()
+        self.assertEqual(ce.kdf_name, kdf.DEFAULT)
+        key = ce.changepassword()
+        self.assertTrue(key.startswith('scrypt:n=32768,r=8,p=1|'))
+        secret = ce.encrypt(b'topsecret')
+
+        other = CryptoEngine(timeout=600)
+        other.set_cryptedkey(key)
+        self.assertFalse(other.authenticate(b'wrong'))
+        self.assertTrue(other.authenticate(b'12345'))
+        self.assertEqual(other.decrypt(secret), b'topsecret')
+        self.assertEqual(other.get_cryptedkey(), key)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2, failfast=True)
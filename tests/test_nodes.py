@@ -16,6 +16,7 @@
 # ============================================================================
 # Copyright (C) 2014-2017 Oz Nahum Tiram <oz.tiram@gmail.com>
 # ============================================================================
+import time
 import unittest
 from pwman.util.crypto_engine import CryptoEngine
 from pwman.data.nodes import Node
@@ -53,6 +54,33 @@ class TestNode(unittest.TestCase):
         self.assertEqual(bytearray(getattr(self.node, 'password'), 'utf-8'), new_node['password'])
         self.assertEqual(getattr(self.node, 'tags'), new_node['tags'])
 
+    def test_decrypt_once(self):
+        ce = CryptoEngine.get()
+        ce.encrypt(b'')
+        ce._expires_at = int(time.time()) + 600
+        node = Node.from_encrypted_entries(*list(self.node))
+
+        class CountingCipher(object):
+
+            def __init__(self, cipher):
+                self.cipher = cipher
+                self.calls = 0
+
+            def decrypt(self, token):
+                self.calls += 1
+                return self.cipher.decrypt(token)
+
+        counter = CountingCipher(ce._cipher)
+        ce._cipher = counter
+        ce._cache.clear()
+        for _ in range(3):
+            str(node)
+        # username, password, url, notes and two tags
+        self.assertEqual(counter.calls, 6)
+        ce.forget()
+        self.assertEqual(len(ce._cache), 0)
+        ce._expires_at = -1
+
 
 if __name__ == '__main__':
     ce = CryptoEngine.get()
@@ -0,0 +1,146 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import json
+import os
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+from pwman import parser_options
+from pwman.data.drivers.sqlite import SQLite
+from pwman.ui.oneshot import OneShotCallback, OneShotCommands
+from pwman.util.crypto_engine import CryptoEngine, CryptoException
+from .test_crypto_engine import DummyCallback
+
+oneshotdb = os.path.join(os.path.dirname(__file__), 'oneshot.db')
+
+
+class TestOneShot(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        CryptoEngine.get().callback = DummyCallback()
+        cls.db = SQLite(oneshotdb)
+        cls.db.open()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        os.remove(oneshotdb)
+
+    def run_command(self, *argv, **kwargs):
+        args = parser_options().parse_args(argv)
+        out = StringIO()
+        commands = OneShotCommands(self.db, ndjson=args.ndjson, stdout=out,
+                                   stdin=StringIO(kwargs.get('stdin', '')))
+        self.assertEqual(commands.run(args), kwargs.get('status', 0))
+        return out.getvalue()
+
+    def test_1_add(self):
+        out = self.run_command('add', '--username', 'alice', '--url',
+                               'example.com', '--tags', 'foo', 'bar',
+                               stdin='secret\n')
+        self.assertEqual(json.loads(out), [{'id': 1}])
+        self.run_command('add', '--username', 'bob', '--tags', 'foo',
+                         stdin='hunter2\n')
+
+    def test_2_get(self):
+        node, = json.loads(self.run_command('get', '1'))
+        self.assertEqual(node['username'], 'alice')
+        self.assertEqual(node['password'], 'secret')
+        self.assertEqual(sorted(node['tags']), ['bar', 'foo'])
+        self.assertEqual(len(json.loads(self.run_command('get', '1-2'))), 2)
+        # ranges are not expanded, they select the nodes which exist
+        nodes = json.loads(self.run_command('get', '2', '1-1000000'))
+        self.assertEqual([n['id'] for n in nodes], [1, 2])
+        self.assertEqual(self.run_command('get', '3', status=1), '')
+        self.assertEqual(self.run_command('get', 'x', status=1), '')
+
+    def test_3_ls(self):
+        lines = self.run_command('ls', '--ndjson').splitlines()
+        nodes = [json.loads(line) for line in lines]
+        self.assertEqual([n['username'] for n in nodes], ['alice', 'bob'])
+        self.assertNotIn('password', nodes[0])
+        nodes = json.loads(self.run_command('ls', 'bar'))
+        self.assertEqual([n['username'] for n in nodes], ['alice'])
+        nodes = json.loads(self.run_command('ls', '--limit', '1'))
+        self.assertEqual([n['id'] for n in nodes], [1])
+        nodes = json.loads(self.run_command('ls', '--limit', '1',
+                                            '--page', '2'))
+        self.assertEqual([n['id'] for n in nodes], [2])
+        nodes = json.loads(self.run_command('ls', 'foo', '--after', '1'))
+        self.assertEqual([n['id'] for n in nodes], [2])
+        self.run_command('ls', '--page', '2', status=1)
+
+    def test_4_tags_export(self):
+        tags = json.loads(self.run_command('tags'))
+        self.assertEqual(sorted(tags), ['bar', 'foo'])
+        nodes = json.loads(self.run_command('export'))
+        self.assertEqual([n['password'] for n in nodes],
+                         ['secret', 'hunter2'])
+
+    def test_5_rm(self):
+        self.assertEqual(json.loads(self.run_command('rm', '2', '5')),
+                         [{'id': 2}])
+        self.assertEqual(self.db.listnodes(), [1])
+        self.assertEqual(json.loads(self.run_command('rm', '1-1000000')),
+                         [{'id': 1}])
+
+    def test_6_password_sources(self):
+        path = oneshotdb + '.pass'
+        with open(path, 'w') as f:
+            f.write('12345\n')
+        try:
+            callback = OneShotCallback(password_file=path)
+            self.assertEqual(callback.getsecret('Password'), '12345')
+        finally:
+            os.remove(path)
+        read, write = os.pipe()
+        os.write(write, b'12345\n')
+        os.close(write)
+        callback = OneShotCallback(password_fd=read)
+        self.assertEqual(callback.getsecret('Password'), '12345')
+        # read once, asked for again when the vault locks
+        self.assertEqual(callback.getsecret('Password'), '12345')
+        # no terminal to ask
+        callback = OneShotCallback(stdin=StringIO())
+        self.assertRaisesRegex(CryptoException, 'pwman3-agent',
+                               callback.getsecret, 'Password')
+
+    def test_7_wrong_password(self):
+        path = oneshotdb + '.pass'
+        with open(path, 'w') as f:
+            f.write('wrong\n')
+        ce = CryptoEngine.get()
+        ce.callback = OneShotCallback(password_file=path)
+        ce.forget()
+        out = StringIO()
+        try:
+            # the first wrong password fails, nothing is written to stdout
+            with redirect_stdout(out):
+                self.assertRaisesRegex(CryptoException, 'wrong password',
+                                       ce.encrypt, 'secret')
+            self.assertEqual(out.getvalue(), '')
+        finally:
+            os.remove(path)
+            ce.callback = DummyCallback()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
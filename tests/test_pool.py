@@ -0,0 +1,144 @@
+# ============================================================================
+# This file is part of Pwman3.
+#
+# Pwman3 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2
+# as published by the Free Software Foundation;
+#
+# Pwman3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pwman3; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+# ============================================================================
+# Copyright (C) 2018 Oz Nahum Tiram <oz.tiram@gmail.com>
+# ============================================================================
+import os
+import sqlite3
+import threading
+import unittest
+
+from pwman.data.database import (ConnectionPool, DatabaseException,
+                                 PooledDatabase, pooled)
+from pwman.data.drivers.sqlite import SQLite
+from pwman.util.crypto_engine import CryptoEngine
+from .test_crypto_engine import DummyCallback
+
+pooldb = os.path.join(os.path.dirname(__file__), 'pool.db')
+
+
+class PooledSQLite(PooledDatabase, SQLite):
+    """
+    The SQLite driver with the connections of the server drivers
+    """
+
+    def _connect(self):
+        return sqlite3.connect(self._filename, check_same_thread=False)
+
+    def _open(self):
+        self._open_pool()
+        self._create_tables()
+
+    @pooled
+    def connection_id(self):
+        return id(self._con)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+    def tearDown(self):
+        for con in self.connections:
+            con.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(pooldb + suffix):
+                os.remove(pooldb + suffix)
+
+    def connect(self):
+        con = sqlite3.connect(':memory:', check_same_thread=False)
+        self.connections.append(con)
+        return con
+
+    def test_1_sizes(self):
+        pool = ConnectionPool(self.connect, minsize=2, maxsize=3, timeout=0.1)
+        self.assertEqual(len(self.connections), 2)
+        cons = [pool.get() for _ in range(3)]
+        self.assertEqual(len(set(map(id, cons))), 3)
+        self.assertRaisesRegex(DatabaseException, 'No free connection',
+                               pool.get)
+        pool.put(cons.pop())
+        cons.append(pool.get())
+        self.assertEqual(len(self.connections), 3)
+
+    def test_2_broken_connection(self):
+        pool = ConnectionPool(self.connect, check_after=0)
+        broken = pool.get()
+        pool.put(broken)
+        broken.close()
+        con = pool.get()
+        self.assertIsNot(con, broken)
+        self.assertTrue(pool.is_alive(con))
+
+    def test_3_error_in_connection(self):
+        pool = ConnectionPool(self.connect, maxsize=1)
+        with self.assertRaises(sqlite3.OperationalError):
+            with pool.connection() as con:
+                con.execute("SELECT * FROM NOTHERE")
+        # the connection still works, so it is kept
+        self.assertIs(pool.get(), con)
+
+    def test_4_reconnect(self):
+        failures = [2]
+
+        def connect():
+            if failures[0]:
+                failures[0] -= 1
+                raise sqlite3.OperationalError("server is down")
+            return self.connect()
+
+        pool = ConnectionPool(connect, minsize=0, tries=3, backoff=0.01)
+        self.assertTrue(pool.is_alive(pool.get()))
+        failures[0] = 3
+        pool = ConnectionPool(connect, minsize=0, tries=3, backoff=0.01)
+        self.assertRaisesRegex(DatabaseException, 'after 3 tries', pool.get)
+        # the failed connection does not take a place in the pool
+        self.assertEqual(pool._size, 0)
+
+    def test_5_threads(self):
+        CryptoEngine.get().callback = DummyCallback()
+        db = PooledSQLite(pooldb)
+        db.configure({'pool_min': '2', 'pool_max': '2'})
+        db.open()
+        barrier = threading.Barrier(2)
+        seen = []
+
+        @pooled
+        def borrow(db):
+            # keep the connection until the other thread has one too
+            seen.append(db.connection_id())
+            barrier.wait(5)
+
+        threads = [threading.Thread(target=borrow, args=(db,))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(seen)), 2)
+        self.assertNotIn(id(db._default_con), seen)
+        self.assertEqual(db.listnodes(), [])
+        db.close()
+
+    def test_6_configure(self):
+        db = PooledSQLite(pooldb)
+        self.assertRaises(DatabaseException, db.configure,
+                          {'pool_max': 'many'})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
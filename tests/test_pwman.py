@@ -21,8 +21,10 @@
 import os
 import sys
 import unittest
-from .test_crypto_engine import CryptoEngineTest, TestPassGenerator
+from .test_crypto_engine import (CryptoEngineTest, TestPassGenerator,
+                                 TestFieldCache)
 from .test_config import TestConfig
+from .test_kdf import TestKDF
 from .test_sqlite import TestSQLite
 from .test_postgresql import TestPostGresql
 from .test_mysql import TestMySQLDatabase
@@ -32,6 +34,10 @@ from .test_factory import TestFactory
 from .test_base_ui import TestBaseUI
 from .test_init import TestInit
 from .test_nodes import TestNode
+from .test_agent import TestAgent
+from .test_oneshot import TestOneShot
+from .test_pool import TestConnectionPool
+from .test_asyncdb import TestAsyncDatabase
 
 
 if 'win' not in sys.platform:
@@ -50,7 +56,9 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(loader.loadTestsFromTestCase(CryptoEngineTest))
     suite.addTest(loader.loadTestsFromTestCase(TestPassGenerator))
+    suite.addTest(loader.loadTestsFromTestCase(TestFieldCache))
     suite.addTest(loader.loadTestsFromTestCase(TestConfig))
+    suite.addTest(loader.loadTestsFromTestCase(TestKDF))
     suite.addTest(loader.loadTestsFromTestCase(TestSQLite))
     suite.addTest(loader.loadTestsFromTestCase(TestPostGresql))
     suite.addTest(loader.loadTestsFromTestCase(TestMySQLDatabase))
@@ -60,6 +68,10 @@ def suite():
     suite.addTest(loader.loadTestsFromTestCase(TestBaseUI))
     suite.addTest(loader.loadTestsFromTestCase(TestInit))
     suite.addTest(loader.loadTestsFromTestCase(TestNode))
+    suite.addTest(loader.loadTestsFromTestCase(TestAgent))
+    suite.addTest(loader.loadTestsFromTestCase(TestOneShot))
+    suite.addTest(loader.loadTestsFromTestCase(TestConnectionPool))
+    suite.addTest(loader.loadTestsFromTestCase(TestAsyncDatabase))
     if 'win' not in sys.platform:
         suite.addTest(loader.loadTestsFromTestCase(Ferrum))
     return suite
@@ -17,10 +17,17 @@
 # Copyright (C) 2012-2017 Oz Nahum Tiram <nahumoz@gmail.com>
 # ============================================================================
 import os
+import sqlite3
+import time
 import unittest
+from unittest import mock
+from pwman.data import database
+from pwman.data.convertdb import RecordMigrator
+from pwman.data.database import (DatabaseException, RowCache, hostname,
+                                 parent_domains)
 from pwman.data.drivers.sqlite import SQLite
 from pwman.data.nodes import Node
-from pwman.util.crypto_engine import CryptoEngine
+from pwman.util.crypto_engine import CryptoEngine, encode_AES, is_record_v2
 from .test_crypto_engine import give_key, DummyCallback
 
 
@@ -29,7 +36,8 @@ class TestSQLite(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         cls.db.close()
-        for item in ('test.db',):
+        # the WAL files are left when connections are not closed
+        for item in ('test.db', 'test.db-wal', 'test.db-shm'):
             try:
                 os.remove(item)
             except OSError:
@@ -50,6 +58,26 @@ class TestSQLite(unittest.TestCase):
     def test_1a_create_tables(self):
         self.db._create_tables()
 
+    def test_1b_pragmas(self):
+        self.db._cur.execute("PRAGMA journal_mode")
+        self.assertEqual(self.db._cur.fetchone()[0], 'wal')
+        db = SQLite('pragmas.db')
+        db.configure({'journal_mode': 'delete', 'synchronous': 'full',
+                      'dburi': 'sqlite:///pragmas.db'})
+        try:
+            db._open()
+            for pragma, value in (('journal_mode', 'delete'),
+                                  ('synchronous', 2),
+                                  ('busy_timeout', 5000),
+                                  ('temp_store', 2)):
+                db._cur.execute("PRAGMA " + pragma)
+                self.assertEqual(db._cur.fetchone()[0], value)
+            db._con.close()
+            db.configure({'cache_size': '1; DROP TABLE NODE'})
+            self.assertRaises(DatabaseException, db._open)
+        finally:
+            os.remove('pragmas.db')
+
     def test_2_crypto_info(self):
         self.db._create_tables()
         self.db.save_crypto_info("foo", "bar")
@@ -111,9 +139,163 @@ class TestSQLite(unittest.TestCase):
         rv = self.db.listnodes(tag)
         self.assertEqual(len(rv), 1)
 
+    def test_7_listnodes_pages(self):
+        ce = CryptoEngine.get()
+        self.assertEqual(self.db.listnodes(limit=1), [1])
+        self.assertEqual(self.db.listnodes(limit=5, after_id=1), [2])
+        self.assertEqual(self.db.listnodes(after_id=2), [])
+        tag = ce.encrypt(b'bar')
+        self.assertEqual(self.db.listnodes(tag, limit=1, after_id=1), [2])
+
+    def test_7a_index_old_tags(self):
+        ce = CryptoEngine.get()
+        # tags of older databases are stored without a blind index
+        self.db._cur.execute("INSERT INTO TAG(DATA) VALUES(?)",
+                             (ce.encrypt(b'qux'),))
+        self.db._con.commit()
+        tid = self.db._cur.lastrowid
+        self.assertEqual(tid, self.db._get_tag(ce.encrypt(b'qux')))
+        self.db._cur.execute("SELECT IDX FROM TAG WHERE ID = ?", (tid,))
+        self.assertEqual(self.db._cur.fetchone()[0], ce.blind_index(b'qux'))
+        self.db._cur.execute("DELETE FROM TAG WHERE ID = ?", (tid,))
+        self.db._con.commit()
+
+    def test_7b_lookup(self):
+        # the nodes of test_3_add_node and test_6_listnodes
+        self.assertEqual(len(self.db.lookup('wonderland.com')), 2)
+        rv = self.db.lookup('https://login.WWW.Wonderland.com:443/x')
+        self.assertEqual(len(rv), 2)
+        self.assertEqual(self.db.lookup('example.com'), [])
+        self.assertEqual(self.db.lookup(''), [])
+
+    def test_7c_hostname(self):
+        self.assertEqual(hostname('https://WWW.Example.com:8080/login'),
+                         'example.com')
+        self.assertEqual(hostname(b'example.com/path'), 'example.com')
+        self.assertEqual(hostname(''), '')
+        self.assertEqual(parent_domains('a.b.example.com'),
+                         ['a.b.example.com', 'b.example.com', 'example.com'])
+        self.assertEqual(parent_domains('localhost'), ['localhost'])
+        self.assertEqual(parent_domains(''), [])
+        # public suffixes are not parents
+        self.assertEqual(parent_domains('evil.co.uk'), ['evil.co.uk'])
+        self.assertEqual(parent_domains('a.shop.com.au'),
+                         ['a.shop.com.au', 'shop.com.au'])
+        self.assertEqual(parent_domains('10.0.0.1'), ['10.0.0.1'])
+
+    def test_7d_lookup_public_suffix(self):
+        ids = self.db.add_nodes(
+            Node(clear_text=True, username='u', password='p', url=url,
+                 notes='', tags=[])
+            for url in ('https://co.uk', 'https://bank.co.uk/login'))
+        self.assertEqual(self.db.lookup('evil.co.uk'), [])
+        self.assertEqual(self.db.lookup('www.bank.co.uk'), [ids[1]])
+        self.assertEqual(self.db.lookup('co.uk'), [ids[0]])
+        self.db.removenodes(ids)
+
     def test_8_getnodes(self):
         nodes = self.db.getnodes([1, 2])
         self.assertEqual(len(nodes), 2)
+        ce = CryptoEngine.get()
+        self.assertEqual(ce.decrypt(nodes[0][1]), b'alice')
+        self.assertEqual(sorted(ce.decrypt(t) for t in nodes[0][5:]),
+                         [b'bar', b'foo'])
+
+    def test_8a_getnodes_query_count(self):
+        # getnodes runs one query, no matter how many nodes there are
+        rows = [(b'u', b'p', b'url', b'n', None)] * 50
+        self.db._cur.executemany(self.db._add_node_sql, rows)
+        queries = []
+        self.db._con.set_trace_callback(queries.append)
+        self.assertEqual(len(self.db.getnodes([1])), 1)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(self.db.getnodes([])), 52)
+        self.assertEqual(len(queries), 2)
+        self.db._con.set_trace_callback(None)
+        self.db._con.rollback()
+
+    def test_8b_iternodes(self):
+        rows = [(b'u', b'p', b'url', b'n', None)] * 50
+        self.db._cur.executemany(self.db._add_node_sql, rows)
+        nodes = self.db.iternodes(batch_size=7)
+        self.assertEqual(next(nodes), self.db.getnodes([1])[0])
+        self.assertEqual([n[0] for n in nodes],
+                         [n[0] for n in self.db.getnodes([])][1:])
+        self.assertEqual(list(self.db.iternodes([2, 1], batch_size=1)),
+                         self.db.getnodes([1, 2]))
+        # unlike getnodes, no ids are no nodes
+        self.assertEqual(list(self.db.iternodes([])), [])
+        self.db._con.rollback()
+
+    def test_8c_row_cache(self):
+        ce = CryptoEngine.get()
+        self.db.configure({'row_cache_size': '10'})
+        queries = []
+
+        def trace(query):
+            # the changes of other connections are polled with a PRAGMA
+            if not query.startswith('PRAGMA'):
+                queries.append(query)
+
+        self.db._con.set_trace_callback(trace)
+        nodes = self.db.getnodes([1, 2])
+        self.assertEqual(self.db.getnodes([2, 1]), nodes)
+        self.assertEqual(self.db.getnodes([1]), nodes[:1])
+        self.assertEqual(len(queries), 1)
+        self.db.listnodes(ce.encrypt(b'bar'))
+        self.db.listnodes(ce.encrypt(b'bar'))
+        self.assertEqual(self.db._cache.hits, 4)
+        self.db._con.set_trace_callback(None)
+        # the edited node is read again, the other one is not
+        self.db.editnode(2, user=ce.encrypt(b'bob'))
+        self.db._con.set_trace_callback(trace)
+        del queries[:]
+        self.assertEqual(ce.decrypt(self.db.getnodes([1, 2])[1][1]), b'bob')
+        self.assertEqual(len(queries), 1)
+        self.assertIn('WHERE NODE.ID IN (2)', queries[0])
+        self.db._con.set_trace_callback(None)
+        self.db.editnode(2, user=nodes[1][1])
+        # lists of ids are dropped when nodes are added
+        nid = self.db.add_node(Node(clear_text=True, username='carol',
+                                    password='', url='', notes='',
+                                    tags=['bar']))
+        self.assertIn(nid, self.db.listnodes(ce.encrypt(b'bar')))
+        self.assertEqual(self.db.removenodes([nid]), [nid])
+        self.assertEqual(self.db.getnodes([nid]), [])
+        self.assertNotIn(nid, self.db.listnodes(ce.encrypt(b'bar')))
+        self.db.configure({})
+        self.assertIsNone(self.db._cache)
+
+    def test_8c_row_cache_other_connection(self):
+        ce = CryptoEngine.get()
+        self.db.configure({'row_cache_size': '10', 'row_cache_ttl': '60'})
+        changes = []
+        self.db.subscribe(changes.append)
+        user = self.db.getnodes([1])[0][1]
+        # another process edits the node
+        other = SQLite('test.db')
+        other._open()
+        other.editnode(1, user=ce.encrypt(b'mallory'))
+        self.assertEqual(ce.decrypt(self.db.getnodes([1])[0][1]),
+                         b'mallory')
+        self.assertEqual(changes, [None])
+        # its own changes are not reported
+        self.db.editnode(1, user=user)
+        self.assertEqual(self.db.getnodes([1])[0][1], user)
+        self.assertEqual(changes, [None])
+        other.close()
+        self.db.configure({})
+
+    def test_8d_row_cache_expires(self):
+        cache = RowCache(size=2, ttl=0)
+        cache.put(('node', 1), (1,))
+        self.assertIsNone(cache.get(('node', 1)))
+        cache.ttl = 30
+        for i in range(3):
+            cache.put(('node', i), (i,))
+        self.assertIsNone(cache.get(('node', 0)))
+        self.assertEqual(cache.get(('node', 2)), (2,))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
 
     def test_9_editnode(self):
         # delibertly insert clear text into the database
@@ -127,21 +309,26 @@ class TestSQLite(unittest.TestCase):
         self.assertEqual(rv, ('transparent', 'notsecret'))
         node = {'user': 'modify', 'password': 'notsecret',
                 'tags': tags}
-        # now the tags bank and baz are orphan ...
-        # what happens? it should be completely removed.
-        # To spare IO we only delete orphand tags when
-        # db.close is called.
+        # now the tag baz is orphan, editnode removes it
         self.db.editnode('2', **node)
+        self.assertIsNone(self.db._get_tag(ce.encrypt(b'baz')))
 
     def test_9_test_no_orphans(self):
-        self.db._clean_orphans()
-        self.db._con.commit()
         ce = CryptoEngine.get()
         tags = None
         while not tags:
             tags = self.db._cur.execute('SELECT * FROM tag').fetchall()
         tags_clear = [ce.decrypt(tag[1]) for tag in tags]
         self.assertNotIn(b"baz", tags_clear)
+        # listing the tags does not write, clean_orphans removes all the
+        # tags without nodes
+        self.db._cur.execute("INSERT INTO TAG(DATA) VALUES(?)",
+                             (ce.encrypt(b'qux'),))
+        self.db._con.commit()
+        self.assertEqual(len(self.db.listtags()), 4)
+        self.assertFalse(self.db._con.in_transaction)
+        self.db.clean_orphans()
+        self.assertEqual(len(self.db.listtags()), 3)
 
     def test_a10_test_listtags(self):
         """there should be only 3 tags left"""
@@ -154,6 +341,196 @@ class TestSQLite(unittest.TestCase):
         rv = self.db._cur.execute("select * from node").fetchall()
         self.assertListEqual(rv, [])
 
+    def test_a11a_migrate_records(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        ce.encrypt(b'')
+        legacy = [encode_AES(ce._cipher.fernet, v) for v in
+                  (b'legacy', b'secret', b'example.com', b'notes')]
+        self.db._cur.execute(self.db._add_node_sql, legacy + [None])
+        self.db._con.commit()
+        ce._expires_at = int(time.time()) + 600
+        try:
+            converted = sum(self.db.migrate_records(batch_size=1))
+        finally:
+            ce._expires_at = -1
+        self.assertEqual(converted, 1)
+        row = self.db._cur.execute("select * from node").fetchall()[-1]
+        self.assertTrue(all(is_record_v2(v) for v in row[1:5]))
+        self.assertEqual(ce.decrypt(row[1]), b'legacy')
+        self.db.removenodes([row[0]])
+
+    def test_a11a_migrate_edited_record(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        ce.encrypt(b'')
+        legacy = [encode_AES(ce._cipher.fernet, v) for v in
+                  (b'legacy', b'secret', b'example.com', b'notes')]
+        self.db._cur.execute(self.db._add_node_sql, legacy + [None])
+        self.db._con.commit()
+        nid = self.db._cur.lastrowid
+        other = self.db._background_db()
+        decode = database.decode_record
+        edited = []
+
+        def decode_and_edit(cipher, value):
+            # the user edits the node while it is converted
+            if not edited:
+                edited.append(nid)
+                other.editnode(nid, user=ce.encrypt(b'edited'))
+            return decode(cipher, value)
+
+        ce._expires_at = int(time.time()) + 600
+        try:
+            with mock.patch('pwman.data.database.decode_record',
+                            decode_and_edit):
+                converted = sum(self.db.migrate_records(batch_size=10))
+        finally:
+            ce._expires_at = -1
+        other.close()
+        # the edited row was read again and converted
+        self.assertEqual(converted, 1)
+        row = self.db._cur.execute("select * from node where id = ?",
+                                   (nid,)).fetchone()
+        self.assertTrue(all(is_record_v2(v) for v in row[1:5]))
+        self.assertEqual(ce.decrypt(row[1]), b'edited')
+        self.assertEqual(ce.decrypt(row[2]), b'secret')
+        self.db.removenodes([nid])
+
+    def test_a11a_record_migrator(self):
+        ce = CryptoEngine.get()
+        ce._getsecret = lambda x: b'12345'
+        migrated = []
+        ce._expires_at = int(time.time()) + 600
+        try:
+            # all records are converted, the migrator says so
+            RecordMigrator(self.db, pause=0,
+                           on_migrated=lambda: migrated.append(1)).run()
+        finally:
+            ce._expires_at = -1
+        self.assertEqual(migrated, [1])
+
+    def test_a11b_bootstrap(self):
+        ce = CryptoEngine.get()
+        key = ce.get_cryptedkey()
+        try:
+            # a new database gets the key of the password
+            db = SQLite('bootstrap.db')
+            db.bootstrap(lambda: '54321')
+            self.assertIsNotNone(db.loadkey())
+            self.assertTrue(ce.authenticate(b'54321'))
+            db.close()
+            # an existing database is unlocked with the password
+            db = SQLite('bootstrap.db')
+            ce._cipher = None
+            db.bootstrap(lambda: b'54321')
+            self.assertIsNotNone(ce._cipher)
+            db.open()  # nothing to do, the database is open
+            db.close()
+        finally:
+            ce.set_cryptedkey(key)
+            os.remove('bootstrap.db')
+
+    def test_a11c_add_nodes(self):
+        nodes = [Node(clear_text=True, username=u"user%d" % i,
+                      password=u"secret", url=u"bulk%d.com" % (i % 2),
+                      notes=u"", tags=[u'bulk', u'foo'])
+                 for i in range(5)]
+        ids = self.db.add_nodes(iter(nodes), batch_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(ids, list(range(ids[0], ids[0] + 5)))
+        ce = CryptoEngine.get()
+        rows = self.db.getnodes(ids)
+        self.assertEqual([ce.decrypt(r[1]) for r in rows],
+                         [b'user%d' % i for i in range(5)])
+        self.assertEqual(sorted(ce.decrypt(t) for t in rows[4][5:]),
+                         [b'bulk', b'foo'])
+        self.assertEqual(sorted(self.db.listnodes(ce.encrypt(b'bulk'))), ids)
+        self.assertEqual(self.db.lookup('bulk1.com'), ids[1::2])
+        self.assertEqual(self.db.removenodes([ids[0], 1000],
+                                             [(ids[1], ids[2])]), ids[:3])
+        self.assertEqual(self.db.removenodes(tags=[ce.encrypt(b'bulk')]),
+                         ids[3:])
+        self.assertIsNone(self.db._get_tag(ce.encrypt(b'bulk')))
+        self.assertEqual(self.db.removenodes(ids), [])
+
+    def test_a11d_upgrade_schema(self):
+        # a database of format 0.6, whose LOOKUP has no keys and indexes
+        con = sqlite3.connect('legacy.db')
+        con.executescript("""
+            CREATE TABLE NODE (ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                USER BLOB NOT NULL, PASSWORD BLOB NOT NULL,
+                URL BLOB NOT NULL, NOTES BLOB NOT NULL);
+            CREATE TABLE TAG (ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                DATA BLOB NOT NULL);
+            CREATE TABLE LOOKUP (nodeid INTEGER NOT NULL,
+                tagid INTEGER NOT NULL,
+                FOREIGN KEY(nodeid) REFERENCES NODE(ID),
+                FOREIGN KEY(tagid) REFERENCES TAG(ID));
+            CREATE TABLE CRYPTO (SEED TEXT, DIGEST TEXT);
+            CREATE TABLE DBVERSION (VERSION TEXT NOT NULL DEFAULT '0.6');
+            INSERT INTO DBVERSION VALUES('0.6');
+            INSERT INTO NODE VALUES(1, 'u', 'p', 'url', 'n');
+            INSERT INTO TAG VALUES(1, 'foo');
+            INSERT INTO TAG VALUES(2, 'bar');
+            INSERT INTO TAG VALUES(3, 'foo');
+            INSERT INTO LOOKUP VALUES(1, 1);
+            INSERT INTO LOOKUP VALUES(1, 3);
+            INSERT INTO LOOKUP VALUES(1, 1);
+            INSERT INTO LOOKUP VALUES(1, 2);
+            INSERT INTO LOOKUP VALUES(2, 2);
+        """)
+        con.commit()
+        con.close()
+        try:
+            self.assertEqual(SQLite.check_db_version('legacy.db'), "'0.6'")
+            db = SQLite('legacy.db')
+            db._open()
+            self.assertEqual(SQLite.check_db_version('legacy.db'), "'0.7'")
+            self.assertEqual(db._get_db_version(), 0.7)
+            cur = db._cur
+            # the blind index is unique, a duplicate tag is merged
+            db._index_tags()
+            cur.execute("SELECT ID FROM TAG ORDER BY ID")
+            self.assertEqual(cur.fetchall(), [(1,), (2,)])
+            cur.execute("SELECT nodeid, tagid FROM LOOKUP ORDER BY tagid")
+            self.assertEqual(cur.fetchall(), [(1, 1), (1, 2)])
+            cur.execute("SELECT sql FROM sqlite_master WHERE name='LOOKUP'")
+            self.assertIn('WITHOUT ROWID', cur.fetchone()[0])
+            cur.execute("EXPLAIN QUERY PLAN SELECT nodeid FROM LOOKUP "
+                        "WHERE tagid = 2")
+            self.assertIn('LOOKUP_TAGID', str(cur.fetchall()))
+            cur.execute("SELECT URLIDX FROM NODE")
+            # removing a node removes its rows in LOOKUP
+            cur.execute("DELETE FROM NODE WHERE ID = 1")
+            cur.execute("SELECT COUNT(*) FROM LOOKUP")
+            self.assertEqual(cur.fetchone()[0], 0)
+            db._con.close()
+        finally:
+            os.remove('legacy.db')
+
+    def test_a11e_unique_tag_index(self):
+        ce = CryptoEngine.get()
+        tid = self.db._get_or_create_tag(ce.encrypt(b'race'))
+        index = self.db._tag_index(ce.encrypt(b'race'))
+        self.assertRaises(sqlite3.IntegrityError, self.db._cur.execute,
+                          "INSERT INTO TAG(DATA, IDX) VALUES(?, ?)",
+                          (b'race', index))
+        select_tags = self.db._select_tags
+        calls = []
+
+        def created_meanwhile(indexes, lock=''):
+            # another connection creates the tag after it was looked up
+            calls.append(indexes)
+            return {} if len(calls) == 1 else select_tags(indexes, lock)
+
+        with mock.patch.object(self.db, '_select_tags', created_meanwhile):
+            tids = self.db._get_or_create_tags([ce.encrypt(b'race')])
+        self.assertEqual(tids, {index: tid})
+        self.assertEqual(len(calls), 2)
+        self.db._cur.execute("DELETE FROM TAG WHERE ID = ?", (tid,))
+        self.db._con.commit()
+
     def test_a12_test_savekey(self):
         ce = CryptoEngine.get()
         self.db.savekey(ce.get_cryptedkey())
@@ -117,8 +117,9 @@ class SetupTester(object):
             if os.path.exists(dbfile):
                 os.remove(dbfile)
 
-            if os.path.exists(dburi):
-                os.remove(dburi)
+            for item in (dburi, dburi + '-wal', dburi + '-shm'):
+                if os.path.exists(item):
+                    os.remove(item)
         except PermissionError:
             pass
 